@@ -0,0 +1 @@
+# Benchmarks, run from the src directory, e.g. `python -m benchmarks.bench_dtdl2graph`
@@ -0,0 +1,78 @@
+"""Scaling benchmark of the publisher/subscriber matching in dtdl2graph.
+
+Generates a building with twin_generator (heater, controller and sensors per zone, plus two wildcard
+subscribers) and compares the topic index against the former subscriber x topic x publisher loop.
+The stream column parses the serialized document incrementally instead of matching a decoded tree.
+
+    python -m benchmarks.bench_dtdl2graph --zones 100 1000 5000
+    python -m benchmarks.bench_dtdl2graph --zones 1000 --topology multi_floor --floors 5 --sensors-per-zone 3
+"""
+import argparse
+import io
+import json
+import time
+import dtdl2graph
+import twin_generator
+
+
+def generate_twin(zones, topology="corridor", sensors_per_zone=1, floors=1):
+    """DTDL contents of a generated building plus two wildcard subscribers."""
+    document, _ = twin_generator.generate_building(topology, zones, sensors_per_zone, floors)
+    return document["contents"] + [
+        twin_generator.component("dtmi:building:logger", "Logger", "Logger", [twin_generator.telemetry("AllSensors", "Subscriber", "sensor/+")]),
+        twin_generator.component("dtmi:building:recorder", "Recorder", "Recorder", [twin_generator.telemetry("Everything", "Subscriber", "#")])]
+
+
+def count_telemetry(contents):
+    return sum(len(item["contents"]) for item in contents)
+
+
+def legacy_match(contents):
+    """The former matching: every subscriber x every topic x every publisher, exact topics only."""
+    publisher_map = {}
+    subscriber_map = {}
+    for item in contents:
+        for entry in item["contents"]:
+            realization = entry["realization"]
+            target = publisher_map if realization["@type"].endswith("Publisher") else subscriber_map
+            target.setdefault(item["name"], set()).add(realization["topic"])
+    connections = {}
+    for subscriber, topics in subscriber_map.items():
+        for topic in topics:
+            for publisher, publisher_topics in publisher_map.items():
+                if topic in publisher_topics:
+                    connections.setdefault(subscriber, []).append(publisher)
+    return connections
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--zones", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--topology", choices=twin_generator.TOPOLOGIES, default="corridor")
+    parser.add_argument("--sensors-per-zone", type=int, default=1)
+    parser.add_argument("--floors", type=int, default=1, help="multi_floor only")
+    parser.add_argument("--legacy-limit", type=int, default=1000, help="largest zone count timed with the legacy loop")
+    args = parser.parse_args()
+
+    print(f"{'zones':>7} {'telemetry':>10} {'edges':>8} {'index [s]':>10} {'stream [s]':>11} {'legacy [s]':>11}")
+    for zones in args.zones:
+        contents = generate_twin(zones, args.topology, args.sensors_per_zone, args.floors)
+        index_time, connections = timed(dtdl2graph.extract_mqtt_connections, contents)
+        edges = sum(len(publishers) for publishers in connections.values())
+        document = json.dumps({"contents": contents})
+        stream_time, _ = timed(dtdl2graph.extract_mqtt_connections_from_stream, io.StringIO(document))
+        legacy = "-"
+        if zones <= args.legacy_limit:
+            legacy_time, _ = timed(legacy_match, contents)
+            legacy = f"{legacy_time:.4f}"
+        print(f"{zones:>7} {count_telemetry(contents):>10} {edges:>8} {index_time:>10.4f} {stream_time:>11.4f} {legacy:>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""End-to-end benchmark of the FDIR loop: simulation -> controller -> monitor -> identification.
+
+All components run in this process, on the in-process bus or on the MQTT broker of config.Mqtt, for
+buildings of twin_generator (corridors, grids or several floors). A heater breaks after --fault-step
+steps so the monitor raises alerts and the identification diagnoses them. Reported per twin size:
+  steps/s and the step time of the controller,
+  per hop (topic -> component): delivery latency from publish to the start of the handler and handler time,
+  alert-to-diagnosis latency, from the monitor's alert to the end of the identification's handler,
+  CPU seconds per component (thread CPU time of its handlers, the controller's loop) and the process RSS.
+All components share one process, so the RSS is not split per component; --trace-memory adds the
+Python allocations grouped by the source file of the component.
+
+The results are written as JSON, tagged with the git commit, and can be compared with an earlier run:
+
+    python -m benchmarks.bench_end_to_end --zones 3 30 300 3000 10000
+    python -m benchmarks.bench_end_to_end --zones 3 300 --compare bench_end_to_end_<commit>.json
+    python -m benchmarks.bench_end_to_end --topology multi_floor --floors 4 --sensors-per-zone 2 --zones 400
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import config
+import controller
+import controller_simulation
+import dtdl2graph
+import identification
+import monitor
+import simulation
+import transport
+import twin_generator
+import wire
+from mqtt_rpc import RpcClient
+
+SERVICES = {'simulation': simulation, 'controller_simulation': controller_simulation,
+            'monitor': monitor, 'identification': identification}
+PERCENTILES = [50, 90, 99]
+
+
+def use_building(topology, zones, sensors_per_zone, floors, directory):
+    """Writes a generated building, points the configuration at it and resets the state of the components."""
+    document, parameters = twin_generator.generate_building(topology, zones, sensors_per_zone, floors)
+    twin_generator.use_building(twin_generator.load_building(
+        twin_generator.write_building(document, parameters, os.path.join(directory, f'{topology}_{zones}'))))
+    wire._default_layout = None
+    monitor.detector = None
+    identification.diagnosis_cache.clear()
+    identification.diagnoser_sessions.clear()
+    return parameters
+
+
+class Probe:
+    """Times the messages of instrumented clients.
+
+    Every publish gets a sequence number per topic. Each topic has one publisher and ordered delivery, so
+    the n-th message a component receives on a topic is the n-th one published on it. The publish
+    time is kept until every instrumented subscriber of the topic received the message.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.published = {}  # (topic, sequence number) -> [publish time, deliveries still expected]
+        self.sequence = {}  # topic -> messages published
+        self.received = {}  # (topic, component) -> messages received
+        self.subscriptions = {}  # component -> topic filters
+        self.latency = {}  # (topic, component) -> seconds from publish to the start of the handler
+        self.handling = {}  # (topic, component) -> seconds in the handler
+        self.done = {}  # (topic, component) -> seconds from publish to the end of the handler
+        self.cpu = {}  # component -> thread CPU seconds in handlers
+        self.last_activity = time.perf_counter()
+
+    def subscribers(self, topic):
+        return sum(any(dtdl2graph.topic_matches(topic_filter, topic) for topic_filter in filters)
+                   for filters in self.subscriptions.values())
+
+    def instrument(self, component, client):
+        publish, subscribe, on_message = client.publish, client.subscribe, client.on_message
+
+        def recorded_subscribe(topic, *args, **kwargs):
+            topics = [topic] if isinstance(topic, str) else [entry[0] for entry in topic]
+            with self.lock:
+                self.subscriptions.setdefault(component, set()).update(topics)
+            return subscribe(topic, *args, **kwargs)
+
+        def timed_publish(topic, payload=None, *args, **kwargs):
+            with self.lock:
+                sequence = self.sequence.get(topic, 0)
+                self.sequence[topic] = sequence + 1
+                subscribers = self.subscribers(topic)
+                if subscribers:
+                    self.published[(topic, sequence)] = [time.perf_counter(), subscribers]
+            return publish(topic, payload, *args, **kwargs)
+
+        def timed_on_message(client, userdata, msg):
+            start, cpu_start = time.perf_counter(), time.thread_time()
+            hop = (msg.topic, component)
+            with self.lock:
+                sequence = self.received.get(hop, 0)
+                self.received[hop] = sequence + 1
+                entry = self.published.get((msg.topic, sequence))
+                sent = None
+                if entry is not None:
+                    sent = entry[0]
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        del self.published[(msg.topic, sequence)]
+            try:
+                on_message(client, userdata, msg)
+            finally:
+                end = time.perf_counter()
+                with self.lock:
+                    self.handling.setdefault(hop, []).append(end - start)
+                    if sent is not None:
+                        self.latency.setdefault(hop, []).append(start - sent)
+                        self.done.setdefault(hop, []).append(end - sent)
+                    self.cpu[component] = self.cpu.get(component, 0.0) + time.thread_time() - cpu_start
+                    self.last_activity = end
+
+        client.publish = timed_publish
+        client.subscribe = recorded_subscribe
+        client.on_message = timed_on_message
+        return client
+
+
+def summary(values):
+    """Count, mean and percentiles in milliseconds."""
+    if not values:
+        return {'count': 0}
+    values = np.asarray(values) * 1e3
+    result = {'count': len(values), 'mean_ms': float(values.mean()), 'max_ms': float(values.max())}
+    result.update({f'p{p}_ms': float(np.percentile(values, p)) for p in PERCENTILES})
+    return result
+
+
+def memory_mb():
+    """Current and peak resident set size of the process in MB, None where the platform does not tell."""
+    current = peak = None
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if peak is None:
+        try:
+            import resource  # Unix only, None on other platforms
+        except ImportError:
+            return current, None
+        # kB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if platform.system() != 'Darwin' else 2 ** 20)
+    return current, peak
+
+
+def allocations_by_file(snapshot):
+    """Python allocations (MB) per source file of the repository."""
+    source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sizes = {}
+    for statistic in snapshot.statistics('filename'):
+        filename = statistic.traceback[0].filename
+        if os.path.isfile(filename) and os.path.abspath(filename).startswith(source):
+            sizes[os.path.relpath(filename, source)] = statistic.size / 2 ** 20
+    return dict(sorted(sizes.items(), key=lambda item: -item[1]))
+
+
+def wait_until_idle(probe, backend, quiet_time=0.5, timeout=60):
+    """Lets the monitor and the identification finish the messages that are still under way."""
+    if backend == 'memory':
+        transport.default_broker.join()
+        return
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and time.perf_counter() - probe.last_activity < quiet_time:
+        time.sleep(quiet_time / 5)
+
+
+def run(zones, steps, fault_step, mode, backend, directory, trace_memory=False, topology='corridor',
+        sensors_per_zone=1, floors=1):
+    """Runs the loop for one building size and returns its measurements."""
+    parameters = use_building(topology, zones, sensors_per_zone, floors, directory)
+    config.Transport.BACKEND = backend
+    probe = Probe()
+    if trace_memory:
+        tracemalloc.start()
+
+    clients = {name: probe.instrument(name, service.start()) for name, service in SERVICES.items()}
+    for client in clients.values():
+        if backend == 'memory':
+            # handles the connect, so the subscriptions exist before the first step
+            client.loop(0)
+        client.loop_start()
+    if backend != 'memory':
+        time.sleep(0.5)
+
+    delta_t = controller.DELTA_T
+    temperature_controller = controller.TemperatureController(config.Controller.TARGET_TEMP, {'Z1': fault_step * delta_t},
+                                                              steps * delta_t)
+    temperature_controller.set_adjustment_mode(mode)
+    temperature_controller.rpc = RpcClient(config.Controller.REQUEST_TIMEOUT)
+    probe.instrument('controller', temperature_controller.rpc.client)
+    adjust = getattr(temperature_controller, f'adjust_heater_status_{mode}')
+    unconnected = transport.create_client(backend)
+
+    step_times = []
+    cpu_start, start = time.thread_time(), time.perf_counter()
+    for _ in range(steps):
+        step_start = time.perf_counter()
+        adjust(unconnected)
+        step_times.append(time.perf_counter() - step_start)
+    elapsed = time.perf_counter() - start
+    probe.cpu['controller'] = probe.cpu.get('controller', 0.0) + time.thread_time() - cpu_start
+
+    temperature_controller.close()
+    wait_until_idle(probe, backend)
+    for client in clients.values():
+        client.disconnect()
+        client.loop_stop()
+
+    current_rss, peak_rss = memory_mb()
+    result = {
+        'zones': zones,
+        'sensors': len(parameters['SENSOR_ZONES']),
+        'steps': steps,
+        'seconds': elapsed,
+        'steps_per_s': steps / elapsed,
+        'step': summary(step_times),
+        'hops': {f'{topic} -> {component}': {'latency': summary(probe.latency.get((topic, component), [])),
+                                             'handler': summary(handling)}
+                 for (topic, component), handling in sorted(probe.handling.items())},
+        'alert_to_diagnosis': summary(probe.done.get(('monitor/alert', 'identification'), [])),
+        'cpu_s': dict(sorted(probe.cpu.items())),
+        'rss_mb': current_rss,
+        'peak_rss_mb': peak_rss,
+    }
+    if trace_memory:
+        result['allocations_mb'] = allocations_by_file(tracemalloc.take_snapshot())
+        tracemalloc.stop()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result):
+    step, alert = result['step'], result['alert_to_diagnosis']
+    print(f"{result['zones']:>6} zones {result['sensors']:>6} sensors: {result['steps_per_s']:>8.1f} steps/s, "
+          f"step p50 {step['p50_ms']:.2f} ms p99 {step['p99_ms']:.2f} ms, RSS {result['rss_mb'] or 0:.0f} MB "
+          f"(peak {result['peak_rss_mb'] or 0:.0f} MB)")
+    for hop, times in result['hops'].items():
+        latency = times['latency']
+        latency = f"p50 {latency['p50_ms']:8.3f} p99 {latency['p99_ms']:8.3f} ms" if latency['count'] else f"{'-':>27}"
+        print(f"    {hop:<55} {times['handler']['count']:>6} msgs, latency {latency}, handler mean {times['handler']['mean_ms']:8.3f} ms")
+    if alert['count']:
+        print(f"    alert to diagnosis: {alert['count']} alerts, p50 {alert['p50_ms']:.2f} ms p99 {alert['p99_ms']:.2f} ms")
+    print("    CPU [s]: " + ", ".join(f"{component} {seconds:.3f}" for component, seconds in result['cpu_s'].items()))
+    for filename, size in list(result.get('allocations_mb', {}).items())[:8]:
+        print(f"    {filename:<40} {size:8.2f} MB allocated")
+
+
+def compare(results, baseline):
+    """Prints the change of the main figures against an earlier result file."""
+    earlier = {run['zones']: run for run in baseline['runs']}
+    print(f"compared with {baseline.get('commit')}:")
+    for result in results:
+        before = earlier.get(result['zones'])
+        if before is None:
+            continue
+        changes = [f"steps/s x{result['steps_per_s'] / before['steps_per_s']:.2f}",
+                   f"step p99 x{result['step']['p99_ms'] / before['step']['p99_ms']:.2f}"]
+        if result['alert_to_diagnosis']['count'] and before['alert_to_diagnosis']['count']:
+            changes.append(f"alert to diagnosis p50 x{result['alert_to_diagnosis']['p50_ms'] / before['alert_to_diagnosis']['p50_ms']:.2f}")
+        print(f"{result['zones']:>6} zones: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--zones", type=int, nargs="+", default=[3, 30, 300, 3000, 10000])
+    parser.add_argument("--topology", choices=twin_generator.TOPOLOGIES, default="corridor")
+    parser.add_argument("--sensors-per-zone", type=int, default=1)
+    parser.add_argument("--floors", type=int, default=1, help="multi_floor only")
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--fault-step", type=int, default=10, help="step from which heater H1 (zone Z1) is broken")
+    parser.add_argument("--mode", choices=["simple", "advanced", "mpc"], default="simple")
+    parser.add_argument("--transport", choices=transport.TRANSPORTS, default="memory")
+    parser.add_argument("--wire", choices=wire.FORMATS, default=config.Wire.FORMAT)
+    parser.add_argument("--batch-size", type=int, default=config.Batching.BATCH_SIZE)
+    parser.add_argument("--trace-memory", action="store_true", help="Python allocations per source file (slower)")
+    parser.add_argument("--output", help="result file, default bench_end_to_end_<commit>.json")
+    parser.add_argument("--compare", help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    config.Wire.FORMAT = args.wire
+    config.Batching.BATCH_SIZE = args.batch_size
+    commit = git_commit()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for zones in args.zones:
+            # the components print every step
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                result = run(zones, args.steps, args.fault_step, args.mode, args.transport, directory, args.trace_memory,
+                             args.topology, args.sensors_per_zone, args.floors)
+            results.append(result)
+            print_result(result)
+
+    output = args.output or f"bench_end_to_end_{commit or 'unknown'}.json"
+    with open(output, 'w') as file:
+        json.dump({'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                   'topology': args.topology, 'sensors_per_zone': args.sensors_per_zone, 'floors': args.floors,
+                   'transport': args.transport, 'wire': args.wire, 'batch_size': args.batch_size, 'mode': args.mode,
+                   'fault_step': args.fault_step, 'runs': results}, file, indent=2)
+    print(f"results written to {output}")
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
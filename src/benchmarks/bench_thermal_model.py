@@ -0,0 +1,54 @@
+"""Dense vs sparse (CSR) step time and memory of the thermal model.
+
+    python -m benchmarks.bench_thermal_model --zones 3 300 3000 50000 --topology grid
+    python -m benchmarks.bench_thermal_model --zones 3000 50000 --topology multi_floor --floors 10
+"""
+import argparse
+import time
+import numpy as np
+import thermal_model
+import twin_generator
+from thermal_model import ThermalModel
+
+
+def time_steps(model, steps):
+    temperatures = np.full(len(model.zones), 15.0)
+    heating = np.zeros(len(model.zones))
+    start = time.perf_counter()
+    for _ in range(steps):
+        temperatures = model.step(temperatures, heating, 15.0)
+    return (time.perf_counter() - start) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--zones", type=int, nargs="+", default=[3, 30, 300, 3000, 10000, 50000])
+    parser.add_argument("--topology", choices=twin_generator.TOPOLOGIES, default="corridor")
+    parser.add_argument("--floors", type=int, default=1, help="multi_floor only")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--dense-limit-mb", type=float, default=2048, help="skip dense matrices larger than this")
+    args = parser.parse_args()
+
+    backends = ["dense"] + (["sparse"] if thermal_model.sparse is not None else [])
+    print(f"{'zones':>7} {'backend':>7} {'build [ms]':>11} {'step [us]':>10} {'memory [kB]':>12} {'auto':>7}")
+    for zones in args.zones:
+        _, parameters = twin_generator.generate_building(args.topology, zones, floors=args.floors)
+        capacity, heat_transfer_external = parameters['HEAT_CAPACITY'], parameters['HEAT_TRANSFER_EXTERNAL']
+        heat_transfer_zones, sensor_zones = parameters['HEAT_TRANSFER_ZONES'], parameters['SENSOR_ZONES']
+        auto = ThermalModel(sensor_zones)
+        auto.set_parameters(capacity, heat_transfer_external, heat_transfer_zones, 200)
+        for backend in backends:
+            if backend == "dense" and zones * zones * 8 / 2 ** 20 > args.dense_limit_mb:
+                print(f"{zones:>7} {backend:>7} {'-':>11} {'-':>10} {'-':>12}")
+                continue
+            model = ThermalModel(sensor_zones, backend)
+            start = time.perf_counter()
+            model.set_parameters(capacity, heat_transfer_external, heat_transfer_zones, 200)
+            build = time.perf_counter() - start
+            step = time_steps(model, args.steps)
+            chosen = "*" if model.sparse == auto.sparse else ""
+            print(f"{zones:>7} {backend:>7} {build * 1e3:>11.2f} {step * 1e6:>10.2f} {model.memory_bytes() / 1024:>12.1f} {chosen:>7}")
+
+
+if __name__ == "__main__":
+    main()
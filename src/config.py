@@ -4,14 +4,57 @@ class Mqtt:
     MQTT_SERVER_USER=None
     MQTT_SERVER_PASS=None
 
+class Transport:
+    BACKEND="mqtt" # mqtt (broker of class Mqtt) or memory (in-process bus, all components in one process)
+
 class Controller:
-    ADJUSTMENT_MODE="simple"
+    ADJUSTMENT_MODE="simple" # simple, advanced or mpc
     SIM_STOP_TIME=5000
-    SIM_DELTA_T=200
+    SIM_DELTA_T=200 # keep small with the euler discretization, exact allows e.g. 1000 and more
     TARGET_TEMP=20
     BROKEN_HEATER_TIMES={'Z1': 1500, 'Z2': 2000}
+    REQUEST_TIMEOUT=10 # seconds to wait for the reply of a simulation request
+    EXECUTION="sync" # sync or asyncio (overlaps the prediction with the real system step)
+    ESTIMATOR="least_squares" # refit of the controller simulation: least_squares (Levenberg-Marquardt), gradient_descent or rls (online, every step)
+    ESTIMATION_WINDOW=5 # steps of history used by the least squares fit, short because the real system drifts
+    RLS_DRIFT=0.05 # expected relative change of the constants per step, for the online estimator (rls)
+    RLS_NOISE=0.01 # standard deviation of a measured temperature change in K (rls)
+    PREDICTION_CACHE_SIZE=256 # controller simulation replies kept in the LRU cache, 0 disables it
+    PREDICTION_CACHE_TOLERANCE=0.0 # K, temperatures closer than this share cache entries; 0 caches identical requests only
+    HEATER_POWER=10000 # W of a heater that is on
+    MPC_HORIZON=2 # steps the mpc mode looks ahead; the heater combination is held, so long horizons overshoot with strong heaters
+    MPC_ENERGY_WEIGHT=0.01 # cost of one heater on for one step, relative to 1 K^2 of tracking error
+    MPC_MAX_EXHAUSTIVE_ZONES=12 # up to this many heaters all 2^Z combinations are evaluated, above a greedy search
     
+class History:
+    LENGTH=10000 # samples kept per series by the controller and the plots (ring buffers, memory stays flat)
+
+class Batching:
+    BATCH_SIZE=1 # time steps per frame for the monitor and the plots; 1 keeps one message per step and no frames
+    FLUSH_INTERVAL=0.5 # seconds, a partly filled frame is published at the latest after this time
+
+class Wire:
+    FORMAT="json" # json or binary (packed float64 arrays for the per-step messages, the receivers read both)
+    KEYFRAME_INTERVAL=100 # binary: the constants are sent when they change and at least every this many messages
+
+class Diagnosis:
+    MODE="minimal" # minimal (all minimal diagnoses) or top_k (ranked by cost, MaxSAT)
+    STRATEGY="hs_tree" # hs_tree or brute_force
+    TOP_K=5
+    TIME_BUDGET=1.0 # seconds, for the top_k enumeration
+    FAULT_PRIORS={} # component name -> fault probability, e.g. {'H1': 0.05}; empty ranks by cardinality
+    DEFAULT_FAULT_PRIOR=0.01 # for components missing in FAULT_PRIORS
+    SESSION_CACHE_SIZE=64 # solver sessions kept (LRU), one per strategy, twin and independent part of the graph
+    SOLVER_REBUILD_AFTER=1000 # retired observation sets after which a session reloads its solver
+
+class Dtdl2Graph:
+    CACHE_DIR=".dtdl_cache" # compiled graphs and system descriptions, keyed by the DTDL content hash; relative to src/
+    STREAMING_MIN_BYTES=16 * 1024 * 1024 # DTDL files from this size on are parsed incrementally
+
 class Model:
+    DTDL_FILE="heating_twin.dtdl" # the twin of the building, its zones and sensors match the constants below
+    BACKEND="auto" # matrices of the thermal model: auto, dense or sparse (scipy)
+    DISCRETIZATION="euler" # euler (explicit) or exact (matrix exponential, stable for large SIM_DELTA_T)
     ENVIRONMENT_TEMP=15
     HEAT_CAPACITY={'Z1': 1e6, 'Z2': 1e6, 'Z3': 1e6}
     HEAT_TRANSFER_EXTERNAL={'Z1': 1000, 'Z2': 500, 'Z3': 1042}
@@ -19,4 +62,11 @@ class Model:
             'Z1': {'Z2': 500},
             'Z2': {'Z1': 500, 'Z3': 500},
             'Z3': {'Z2': 500}
-        }
\ No newline at end of file
+        }
+    # sensor -> observed zones with weights, the rows of the observation matrix
+    SENSOR_ZONES={
+            'TA': {'Z1': 1.0},
+            'TB': {'Z1': 0.5, 'Z2': 0.5},
+            'TC': {'Z2': 0.5, 'Z3': 0.5},
+            'TD': {'Z3': 1.0}
+        }
@@ -1,10 +1,65 @@
-import paho.mqtt.client as mqtt
+import asyncio
 import json
-import threading
+import hashlib
+import copy
 import math
 import numpy as np
 import random
 import config
+import transport
+from collections import OrderedDict, deque
+from estimation import LeastSquaresEstimator, RecursiveEstimator
+from frames import BatchPublisher
+from mqtt_rpc import RemoteError, RpcClient, TimeoutError
+from ring_buffer import RingBuffer
+from thermal_model import ThermalModel
+
+
+class PredictionCache:
+    """LRU cache of controller simulation replies, keyed by a hash of the request payload."""
+    def __init__(self, size, tolerance=0.0):
+        """Temperatures are rounded to multiples of tolerance (in K) for the key, 0 only reuses identical requests."""
+        self.size = size
+        self.tolerance = tolerance
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, topic, message):
+        """Hash of the topic and the payload with quantized temperatures."""
+        if self.tolerance > 0:
+            message = dict(message)
+            for field in ('current_temperatures',):
+                if field in message:
+                    message[field] = {name: round(value / self.tolerance) for name, value in message[field].items()}
+        payload = json.dumps([topic, message], sort_keys=True)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def get(self, key):
+        """The cached reply (a copy) or None."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return dict(self.entries[key])
+        self.misses += 1
+        return None
+
+    def put(self, key, reply):
+        if self.size <= 0 or not reply:
+            return
+        reply = {name: value for name, value in reply.items() if name != 'correlation_id'}
+        self.entries[key] = reply
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def cache_info(self):
+        """Hit and miss counts and the fill level."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.size}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
 
 
 class TemperatureController:
@@ -14,19 +69,25 @@ class TemperatureController:
         self.target_temperature = target_temperature
         self.broken_heaters = broken_heaters
         self.stop_time = stop_time
-        self.current_temperatures = {**{f'Z{i}': 15 for i in range(1, 4)}, **{f'T{i}': 0 for i in 'ABCD'}}
-        self.temperature_history = {zone: [] for zone in self.current_temperatures}
-        self.heater_status = {f'Z{i}': 0 for i in range(1, 4)}
-        self.time_history = []
+        # zones and sensors of the building, from the model configuration
+        self.zones = list(config.Model.HEAT_CAPACITY)
+        self.sensors = list(config.Model.SENSOR_ZONES)
+        self.current_temperatures = {**{zone: 15 for zone in self.zones}, **{sensor: 0 for sensor in self.sensors}}
+        # readings of all zones and sensors, one column each in the order of current_temperatures, NaN if not received
+        self.temperature_columns = {key: column for column, key in enumerate(self.current_temperatures)}
+        self.temperature_history = RingBuffer(config.History.LENGTH, width=len(self.temperature_columns))
+        self.heater_status = {zone: 0 for zone in self.zones}
+        self.time_history = RingBuffer(config.History.LENGTH)
+        self.steps = 0  # the clock of the controller, time_history only keeps the recent steps
         self.adjustment_mode = config.Controller.ADJUSTMENT_MODE  # Default mode
         self.environment_temperature = config.Model.ENVIRONMENT_TEMP
-        self.comparison_temperatures = {**{f'Z{i}': 15 for i in range(1, 4)}, **{f'T{i}': 0 for i in 'ABCD'}}
-        self.zone_sensor_map = {
-            'Z1': ('TA', 'TB'),
-            'Z2': ('TB', 'TC'),
-            'Z3': ('TC', 'TD')
-        }
-        self.predicted_temperatures_history = [{'TA': 0, 'TB': 0, 'TC': 0, 'TD': 0} ]
+        self.comparison_temperatures = {**{zone: 15 for zone in self.zones}, **{sensor: 0 for sensor in self.sensors}}
+        # the sensors observing each zone, e.g. 'Z1': ('TA', 'TB')
+        self.zone_sensor_map = {zone: tuple(sensor for sensor in self.sensors if zone in config.Model.SENSOR_ZONES[sensor])
+                                for zone in self.zones}
+        # predicted sensor readings, one column per sensor in the order of self.sensors
+        self.predicted_temperatures_history = RingBuffer(config.History.LENGTH, width=len(self.sensors))
+        self.predicted_temperatures_history.append(np.zeros(len(self.sensors)))
         # constants for the _real_ system
         self.capacity = dict(config.Model.HEAT_CAPACITY)
         self.heat_transfer_external = dict(config.Model.HEAT_TRANSFER_EXTERNAL)
@@ -36,15 +97,35 @@ class TemperatureController:
         self.heat_transfer_external_controller_simulation = dict(config.Model.HEAT_TRANSFER_EXTERNAL)
         self.heat_transfer_zones_controller_simulation = dict(config.Model.HEAT_TRANSFER_ZONES)
         self.RMSE = 0
+        # in-process model of the controller simulation for the mpc mode
+        self.model = ThermalModel(config.Model.SENSOR_ZONES, config.Model.BACKEND, config.Model.DISCRETIZATION)
+        self.rpc = None  # persistent MQTT session for the requests, connected on first use
+        self.frames = None  # batched steps for the monitor and the plots, on the session of the requests
+        self.prediction_cache = PredictionCache(config.Controller.PREDICTION_CACHE_SIZE, config.Controller.PREDICTION_CACHE_TOLERANCE)
+        self.estimator = config.Controller.ESTIMATOR
+        self.least_squares = LeastSquaresEstimator(config.Model.SENSOR_ZONES, config.Model.DISCRETIZATION)
+        # recent steps (state, heating, environment, measured sensors) for the least squares fit
+        self.step_history = deque(maxlen=config.Controller.ESTIMATION_WINDOW)
+        self.rls = RecursiveEstimator(self.capacity_controller_simulation, self.heat_transfer_external_controller_simulation,
+                                      self.heat_transfer_zones_controller_simulation, config.Controller.RLS_DRIFT,
+                                      config.Controller.RLS_NOISE)
 
     def set_adjustment_mode(self, mode):
         """Sets the heating adjustment mode."""
-        valid_modes = ['simple', 'advanced']
+        valid_modes = ['simple', 'advanced', 'mpc']
         if mode in valid_modes:
             self.adjustment_mode = mode
         else:
             raise ValueError(f"Invalid mode. Available modes are: {valid_modes}")
 
+    def set_estimator(self, estimator):
+        """Sets the method that refits the controller simulation's constants."""
+        valid_estimators = ['gradient_descent', 'least_squares', 'rls']
+        if estimator in valid_estimators:
+            self.estimator = estimator
+        else:
+            raise ValueError(f"Invalid estimator. Available estimators are: {valid_estimators}")
+
     def on_connect(self, client, userdata, flags, rc):
         """Handles MQTT connection setup."""
         print(f"Connected with result code {rc}")
@@ -57,87 +138,218 @@ class TemperatureController:
         environment_temp = data.pop('environment')
         self.environment_temperature.append(environment_temp)
 
-        for key, temp in data.items():
-            if key in self.current_temperatures:
-                self.current_temperatures[key] = temp
-                self.temperature_history[key].append(temp)
-
-        self.time_history.append(len(self.time_history) * DELTA_T)
+        self.record_temperatures(data)
 
          # adjust the heater status based on the current mode
         getattr(self, f'adjust_heater_status_{self.adjustment_mode}')(client)
 
-        if len(self.time_history) * DELTA_T >= self.stop_time:
+        if self.steps * DELTA_T >= self.stop_time:
             client.disconnect()
 
+    def record_temperatures(self, temperatures):
+        """Takes over the readings of one step, appends them to the histories and advances the clock."""
+        row = np.full(len(self.temperature_columns), np.nan)
+        for key, temp in temperatures.items():
+            column = self.temperature_columns.get(key)
+            if column is not None:
+                self.current_temperatures[key] = temp
+                row[column] = temp
+        self.temperature_history.append(row)
+        self.time_history.append(self.steps * DELTA_T)
+        self.steps += 1
+
+    def temperature_series(self, key):
+        """The recorded readings of one zone or sensor, oldest first."""
+        return self.temperature_history.values()[:, self.temperature_columns[key]]
+
     def send_initial_request(self, client):
         """Sends an initial request to set all heaters off."""
         self.publish_heater_status(client, {zone: 0 for zone in self.heater_status})
 
     def adjust_heater_status_simple(self, client):
         """Adjusts heater status based on simple average calculations of neighboring sensors."""
-        zone_sensor_map = {
-            'Z1': ('TA', 'TB'), 'Z2': ('TB', 'TC'), 'Z3': ('TC', 'TD')
-        }
-        for zone, (sensor1, sensor2) in zone_sensor_map.items():
-            if all(sensor in self.current_temperatures for sensor in (sensor1, sensor2)):
-                avg_temp = (self.current_temperatures[sensor1] + self.current_temperatures[sensor2]) / 2
-                self.heater_status[zone] = 10000 if avg_temp < self.target_temperature else 0
+        for zone, sensors in self.zone_sensor_map.items():
+            if sensors and all(sensor in self.current_temperatures for sensor in sensors):
+                avg_temp = sum(self.current_temperatures[sensor] for sensor in sensors) / len(sensors)
+                self.heater_status[zone] = config.Controller.HEATER_POWER if avg_temp < self.target_temperature else 0
             # If a heater is broken, set the heater status to 0 from the time of fault
-            if zone in self.broken_heaters and len(self.time_history) * DELTA_T >= self.broken_heaters[zone]:
+            if zone in self.broken_heaters and self.steps * DELTA_T >= self.broken_heaters[zone]:
                 self.heater_status[zone] = 0
         temperatures = self.real_system(client)
-        for key, temp in temperatures.items():
-            if key in self.current_temperatures:
-                self.current_temperatures[key] = temp
-                self.temperature_history[key].append(temp)
         self.environment_temperature = temperatures['environment']
-        self.time_history.append(len(self.time_history) * DELTA_T)
+        self.record_temperatures(temperatures)
 
     def adjust_heater_status_advanced(self, client):
         # Get the predicted temperatures without heating
         # self.heater_status = {zone: 0 for zone in self.heater_status}
         predicted_temperatures = self.predict_heater_effects(client)  # Get the predicted temperatures
+        self.decide_heater_status(predicted_temperatures)
 
-        # Use the class attribute for sensor-zone mapping and predicted temperatures
-        for zone, (sensor1, sensor2) in self.zone_sensor_map.items():
-            if sensor1 in predicted_temperatures and sensor2 in predicted_temperatures:
-                average_temp = (predicted_temperatures[sensor1] + predicted_temperatures[sensor2]) / 2
-                self.heater_status[zone] = 10000 if average_temp < self.target_temperature else 0
-        
         predicted_temperatures = self.predict_heater_effects(client)  # Get the predicted temperatures with new heater settings
         real_temperatures = self.real_system(client)
-
+        self.process_step(client, predicted_temperatures, real_temperatures)
+
+    async def adjust_heater_status_advanced_async(self, client):
+        """Same control step as adjust_heater_status_advanced, the prediction and the real system step run concurrently."""
+        predicted_temperatures = await self.predict_heater_effects_async()
+        self.decide_heater_status(predicted_temperatures)
+
+        # both requests only read the heater status decided above
+        predicted_temperatures, real_temperatures = await asyncio.gather(self.predict_heater_effects_async(),
+                                                                         self.real_system_async())
+        self.process_step(client, predicted_temperatures, real_temperatures)
+
+    async def run_async(self, client, steps):
+        """Runs the control loop on asyncio."""
+        for i in range(steps):
+            if self.adjustment_mode == 'advanced':
+                await self.adjust_heater_status_advanced_async(client)
+            else:
+                # a single request per step, nothing to overlap
+                getattr(self, f'adjust_heater_status_{self.adjustment_mode}')(client)
+
+    def adjust_heater_status_mpc(self, client):
+        """Model predictive control: applies the heater status with the lowest predicted cost over the horizon."""
+        predicted_temperatures = self.optimize_heater_status()
+        real_temperatures = self.real_system(client)
+        self.process_step(client, predicted_temperatures, real_temperatures)
+
+    def optimize_heater_status(self):
+        """Sets the heater status that minimizes tracking plus energy cost, returns its predicted next temperatures.
+
+        Every on/off combination of the working heaters is held over config.Controller.MPC_HORIZON steps.
+        The model is linear, so one batched rollout (free response plus one response per heater) gives
+        the trajectory of any combination by superposition and its cost as a quadratic form in the
+        on/off vector. Up to MPC_MAX_EXHAUSTIVE_ZONES heaters all 2^Z combinations are evaluated at once,
+        above that a greedy search flips heaters from several starting points.
+        """
+        self.model.set_parameters(self.capacity_controller_simulation, self.heat_transfer_external_controller_simulation,
+                                  self.heat_transfer_zones_controller_simulation, DELTA_T)
+        state = self.model.to_vector(self.current_temperatures)
+        # broken heaters stay off from the time of fault
+        available = [zone for zone in self.zones
+                     if not (zone in self.broken_heaters and self.steps * DELTA_T >= self.broken_heaters[zone])]
+        columns = [self.model.zone_index[zone] for zone in available]
+        first_zones, first_readings, constant, linear, quadratic = self.schedule_cost_terms(state, columns)
+
+        if len(available) <= config.Controller.MPC_MAX_EXHAUSTIVE_ZONES:
+            candidates = (np.arange(2 ** len(available))[:, None] >> np.arange(len(available))) & 1
+            costs = constant + candidates @ linear + np.einsum('bi,ij,bj->b', candidates, quadratic, candidates)
+            best = candidates[np.argmin(costs)]
+        else:
+            # all off, all on, the threshold rule of the simple mode and the current status as starting points
+            starts = [np.zeros(len(columns)), np.ones(len(columns)), state[columns] < self.target_temperature,
+                      [self.heater_status[zone] > 0 for zone in available]]
+            best = self.greedy_heater_status(linear, quadratic, starts)
+
+        self.heater_status = {zone: 0 for zone in self.zones}
+        for zone, on in zip(available, best):
+            self.heater_status[zone] = config.Controller.HEATER_POWER * int(on)
+        predicted_temperatures = dict(zip(self.model.zones, (first_zones[0] + best @ first_zones[1:]).tolist()))
+        predicted_temperatures.update(zip(self.model.sensors, (first_readings[0] + best @ first_readings[1:]).tolist()))
+        return predicted_temperatures
+
+    def schedule_cost_terms(self, state, columns):
+        """Cost of a heater combination x over the horizon as constant + linear . x + x' quadratic x.
+
+        Row 0 of the batched rollout is the free response from state (no heating), row i the response to
+        heater i alone from zero (no environment). Also returns these rows for the first step, zones and sensors.
+        """
+        heating = np.zeros((len(columns) + 1, len(state)))
+        heating[np.arange(1, len(columns) + 1), columns] = config.Controller.HEATER_POWER
+        temperatures = np.zeros(heating.shape)
+        temperatures[0] = state
+        environment = np.zeros((len(heating), 1))
+        environment[0] = self.environment_temperature
+        readings = []
+        for k in range(config.Controller.MPC_HORIZON):
+            temperatures = self.model.step(temperatures, heating, environment)
+            readings.append(self.model.observe(temperatures))
+            if k == 0:
+                first_zones = temperatures
+        readings = np.array(readings)  # (horizon, 1 + heaters, sensors)
+        sensors = readings.shape[2]
+        error = (readings[:, 0, :] - self.target_temperature).ravel()
+        # one row per heater with its whole sensor trajectory, the products are then plain matrix products
+        responses = readings[:, 1:, :].transpose(1, 0, 2).reshape(len(columns), -1)
+        constant = error @ error / sensors
+        linear = 2 * responses @ error / sensors + config.Controller.MPC_ENERGY_WEIGHT * config.Controller.MPC_HORIZON
+        quadratic = responses @ responses.T / sensors
+        return first_zones, readings[0], constant, linear, quadratic
+
+    @staticmethod
+    def greedy_heater_status(linear, quadratic, starts):
+        """Local search from each start, flipping the heater that lowers the cost most until none does; returns the best."""
+        diagonal = np.diag(quadratic).copy()
+        best, best_cost = None, np.inf
+        for start in starts:
+            on = np.array(start, dtype=float)
+            coupling = quadratic @ on  # updated with every flip
+            for _ in range(2 * len(linear)):
+                # cost change of flipping each heater alone
+                direction = 1 - 2 * on
+                deltas = direction * (linear + 2 * coupling) + diagonal
+                i = np.argmin(deltas)
+                if deltas[i] >= 0:
+                    break
+                on[i] = 1 - on[i]
+                # quadratic is symmetric, its row is the contiguous column
+                coupling += direction[i] * quadratic[i]
+            cost = linear @ on + on @ coupling
+            if cost < best_cost:
+                best, best_cost = on, cost
+        return best.astype(np.int64)
+
+    def decide_heater_status(self, predicted_temperatures):
+        """Switches the heaters on where the predicted average of the zone's sensors is below the target."""
+        # Use the class attribute for sensor-zone mapping and predicted temperatures
+        for zone, sensors in self.zone_sensor_map.items():
+            if sensors and all(sensor in predicted_temperatures for sensor in sensors):
+                average_temp = sum(predicted_temperatures[sensor] for sensor in sensors) / len(sensors)
+                self.heater_status[zone] = config.Controller.HEATER_POWER if average_temp < self.target_temperature else 0
+
+    def process_step(self, client, predicted_temperatures, real_temperatures):
+        """Compares prediction and real system, recalibrates if necessary and records the step."""
+        self.step_history.append({
+            'temperatures': {zone: self.current_temperatures[zone] for zone in self.heater_status},
+            'heater_status': dict(self.heater_status),
+            'environment': real_temperatures['environment'],
+            'measured': {sensor: real_temperatures[sensor] for sensor in config.Model.SENSOR_ZONES if sensor in real_temperatures}
+        })
+        if self.estimator == 'rls':
+            # online update on every sample, the controller simulation always uses the latest estimate
+            self.rls.update(self.step_history[-1]['temperatures'], self.heater_status, real_temperatures['environment'],
+                            real_temperatures, DELTA_T)
+            (self.capacity_controller_simulation, self.heat_transfer_external_controller_simulation,
+             self.heat_transfer_zones_controller_simulation) = self.rls.parameters(
+                self.capacity_controller_simulation, self.heat_transfer_external_controller_simulation,
+                self.heat_transfer_zones_controller_simulation)
         for key, temp in real_temperatures.items():
             if key in self.comparison_temperatures:
                 self.comparison_temperatures[key] = temp
 
         # compare the predicted temperatures with the actual temperatures to adjust the constants if necessary; 
-        rmse = math.sqrt(sum((real_temperatures[sensor] - predicted_temperatures[sensor]) ** 2 for sensor in ['TA', 'TB', 'TC', 'TD']) / 4)
+        rmse = math.sqrt(sum((real_temperatures[sensor] - predicted_temperatures[sensor]) ** 2 for sensor in self.sensors) / len(self.sensors))
 
         if rmse < 10: # filter out unrealistic RMSE values
             self.RMSE = rmse
 
         print(f"RMSE: {rmse:.2f}")
-        if rmse > 0.45 and rmse < 10:
+        if rmse > 0.45 and rmse < 10 and self.estimator != 'rls':
             print("RMSE is too high, updating constants for the controller simulation")
             # print the latest predictions
-            for sensor in ['TA', 'TB', 'TC', 'TD']:
+            for sensor in self.sensors:
                 print(f"prediction for {sensor}: {predicted_temperatures[sensor]}, actual: {self.current_temperatures[sensor]}")
-            # use the gradient descent function to update the constants
-            new_constants = self.gradient_descent(client)
+            # fit the constants with the configured estimator
+            new_constants = self.recalibrate(client)
             self.capacity_controller_simulation = new_constants['capacity']
             self.heat_transfer_external_controller_simulation = new_constants['heat_transfer_external']
             self.heat_transfer_zones_controller_simulation = new_constants['heat_transfer_zones']
         
         
-        self.predicted_temperatures_history.append(predicted_temperatures)
-        for key, temp in real_temperatures.items():
-            if key in self.current_temperatures:
-                self.current_temperatures[key] = temp
-                self.temperature_history[key].append(temp)
+        self.predicted_temperatures_history.append([predicted_temperatures.get(sensor, np.nan) for sensor in self.sensors])
         self.environment_temperature = real_temperatures['environment']
-        self.time_history.append(len(self.time_history) * DELTA_T)
+        self.record_temperatures(real_temperatures)
        
         if True:
             # add parameter drift to real system (simulation) with a random factor betwenen 1 and 1.1
@@ -151,7 +363,7 @@ class TemperatureController:
         # get a new prediction
         predicted_temperatures = self.predict_heater_effects(client, timestep = -2)
         # calculate the RMSE
-        rmse = math.sqrt(sum((self.current_temperatures[sensor] - predicted_temperatures[sensor]) ** 2 for sensor in ['TA', 'TB', 'TC', 'TD']) / 4)
+        rmse = math.sqrt(sum((self.current_temperatures[sensor] - predicted_temperatures[sensor]) ** 2 for sensor in self.sensors) / len(self.sensors))
         # print the RMSE rounded to 2 decimal places 
         print(f"RMSE: {rmse:.2f}")
     
@@ -159,10 +371,10 @@ class TemperatureController:
         if rmse > 0.45 and rmse < 10:
             print("RMSE is too high, updating constants for the controller simulation")
             # print the latest predictions
-            for sensor in ['TA', 'TB', 'TC', 'TD']:
+            for sensor in self.sensors:
                 print(f"prediction for {sensor}: {predicted_temperatures[sensor]}, actual: {self.current_temperatures[sensor]}")
-            # use the gradient descent function to update the constants
-            new_constants = self.gradient_descent(client)
+            # fit the constants with the configured estimator
+            new_constants = self.recalibrate(client)
             self.capacity_controller_simulation = new_constants['capacity']
             self.heat_transfer_external_controller_simulation = new_constants['heat_transfer_external']
             self.heat_transfer_zones_controller_simulation = new_constants['heat_transfer_zones']
@@ -170,46 +382,60 @@ class TemperatureController:
             self.RMSE = rmse
 
     def predict_heater_effects(self, client):
-        # Initialize the event
-        self.prediction_event = threading.Event()
-
+        message = self.prediction_message()
+        key = self.prediction_cache.key("controller/heater_simulation", message)
+        reply = self.prediction_cache.get(key)
+        if reply is None:
+            reply = self.request("controller/heater_simulation", 'controller_simulation/temperatures', message)
+            self.prediction_cache.put(key, reply)
+        return reply
+
+    async def predict_heater_effects_async(self):
+        message = self.prediction_message()
+        key = self.prediction_cache.key("controller/heater_simulation", message)
+        reply = self.prediction_cache.get(key)
+        if reply is None:
+            reply = await self.request_async("controller/heater_simulation", 'controller_simulation/temperatures', message)
+            self.prediction_cache.put(key, reply)
+        return reply
+
+    def prediction_message(self):
         # Message to be sent; the constants are flexible, and can diverge from reality, so they need to be resynced sometimes
-        message = {
+        return {
             'heater_status': self.heater_status,
             'current_temperatures': self.current_temperatures,
             'delta_t': DELTA_T,
             'capacity': self.capacity_controller_simulation,
             'heat_transfer_external': self.heat_transfer_external_controller_simulation,
             'heat_transfer_zones': self.heat_transfer_zones_controller_simulation
-        }        
-        
-        response_data = {}
-        def on_message(client, userdata, msg):
-            nonlocal response_data
-            try:
-                response_data = json.loads(msg.payload.decode())
-                self.prediction_event.set()
-            except Exception as e:
-                print(f"Error processing reply: {e}")
-
-        client = mqtt.Client()
-        client.on_message = on_message
-        client.connect(config.Mqtt.MQTT_SERVER_URL, config.Mqtt.MQTT_SERVER_PORT, 60)
-        client.subscribe('controller_simulation/temperatures')
-        client.loop_start()
-        client.publish("controller/heater_simulation", json.dumps(message))
-
-        self.prediction_event.wait(timeout=10)
-        client.loop_stop()
-        client.disconnect()
-        return response_data
+        }
 
     def real_system(self, client):
-        # Initialize the event
-        self.prediction_event = threading.Event()
-
+        message = self.real_system_message()
+        reply = self.request("controller/heater_status", 'simulation/temperatures', message)
+        self.record_frame(message)
+        return reply
+
+    async def real_system_async(self):
+        message = self.real_system_message()
+        reply = await self.request_async("controller/heater_status", 'simulation/temperatures', message)
+        self.record_frame(message)
+        return reply
+
+    def record_frame(self, message):
+        """Adds the step to the frames of the monitor and the plots, if they are batched (config.Batching)."""
+        if config.Batching.BATCH_SIZE <= 1 or self.rpc is None:
+            return
+        if self.frames is None:
+            self.frames = BatchPublisher(self.rpc.client, "controller/heater_status_frames")
+        # the constants are not samples; copies, the dicts change before the frame is published
+        sample = {key: dict(value) if isinstance(value, dict) else value for key, value in message.items()
+                  if key not in ('capacity', 'heat_transfer_external', 'heat_transfer_zones')}
+        self.frames.append(self.steps * DELTA_T, sample)
+
+    def real_system_message(self):
         # Message to be sent; the constants are flexible, and can diverge from reality, so they need to be resynced sometimes
-        message = {
+        return {
             'heater_status': self.heater_status,
             'current_temperatures': self.current_temperatures,
             'delta_t': DELTA_T,
@@ -217,135 +443,186 @@ class TemperatureController:
             'heat_transfer_external': self.heat_transfer_external,
             'heat_transfer_zones': self.heat_transfer_zones,
             'RMSE': self.RMSE,
-            'Simulated Temperature Sensor A': self.predicted_temperatures_history[-1]['TA'],
-            'Simulated Temperature Sensor B': self.predicted_temperatures_history[-1]['TB'],
-            'Simulated Temperature Sensor C': self.predicted_temperatures_history[-1]['TC'],
-            'Simulated Temperature Sensor D': self.predicted_temperatures_history[-1]['TD'],
+            # latest predictions for the plots, 'Simulated Temperature Sensor A' for TA
+            **{f'Simulated Temperature Sensor {sensor[1:]}': prediction
+               for sensor, prediction in zip(self.sensors, np.nan_to_num(self.predicted_temperatures_history.latest()).tolist())},
             'environment': self.environment_temperature
-        }       
-        
-        response_data = {}
-        def on_message(client, userdata, msg):
-            nonlocal response_data
-            try:
-                response_data = json.loads(msg.payload.decode())
-                self.prediction_event.set()
-            except Exception as e:
-                print(f"Error processing reply: {e}")
-
-        client = mqtt.Client()
-        client.on_message = on_message
-        client.connect(config.Mqtt.MQTT_SERVER_URL, config.Mqtt.MQTT_SERVER_PORT, 60)
-        client.subscribe('simulation/temperatures')
-        client.loop_start()
-        client.publish("controller/heater_status", json.dumps(message))
-
-        self.prediction_event.wait(timeout=10)
-        client.loop_stop()
-        client.disconnect()
-        return response_data
+        }
 
     def on_disconnect(self, client, userdata, rc):
         """Handles MQTT disconnection."""
         print(f"Disconnected with result code {rc}")
 
-    def gradient_descent(self, client):
-        params = {
+    def request(self, topic, reply_topic, message):
+        """Sends a request over the controller's persistent MQTT session and waits for the matching reply."""
+        if self.rpc is None:
+            self.rpc = RpcClient(config.Controller.REQUEST_TIMEOUT)
+        try:
+            return self.rpc.request(topic, reply_topic, message)
+        except TimeoutError:
+            print(f"No reply on {reply_topic} within {self.rpc.timeout} s")
+            return {}
+
+    async def request_async(self, topic, reply_topic, message):
+        """Awaitable version of request, several requests can be in flight on the same session."""
+        if self.rpc is None:
+            self.rpc = RpcClient(config.Controller.REQUEST_TIMEOUT)
+        future = self.rpc.submit(topic, reply_topic, message)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.rpc.timeout)
+        except asyncio.TimeoutError:
+            self.rpc.cancel(future)
+            print(f"No reply on {reply_topic} within {self.rpc.timeout} s")
+            return {}
+
+    def close(self):
+        """Publishes the last frame and closes the MQTT session."""
+        if self.frames is not None:
+            self.frames.close()
+            self.frames = None
+        if self.rpc is not None:
+            self.rpc.close()
+            self.rpc = None
+
+    def recalibrate(self, client):
+        """Fits the constants of the controller simulation with the configured estimator."""
+        if self.estimator == 'least_squares':
+            capacity, heat_transfer_external, heat_transfer_zones, rmse = self.least_squares.fit(
+                self.capacity_controller_simulation, self.heat_transfer_external_controller_simulation,
+                self.heat_transfer_zones_controller_simulation, list(self.step_history), DELTA_T)
+            print(f"Least squares fit over {len(self.step_history)} steps: RMSE = {rmse:.2f}")
+            return {'capacity': capacity, 'heat_transfer_external': heat_transfer_external, 'heat_transfer_zones': heat_transfer_zones}
+        return self.gradient_descent(client)
+
+    def predict_heater_effects_batch(self, client, parameter_sets):
+        """Predicts the next step for many parameter sets with a single request to the controller simulation.
+
+        Candidates already in the prediction cache (under the key of the equivalent single prediction)
+        are not sent again.
+        """
+        candidates = [{'capacity': params['capacity'],
+                       'heat_transfer_external': params['heat_transfer_external'],
+                       'heat_transfer_zones': params['heat_transfer_zones']} for params in parameter_sets]
+        keys = [self.prediction_cache.key("controller/heater_simulation", dict(candidate, heater_status=self.heater_status,
+                                          current_temperatures=self.current_temperatures, delta_t=DELTA_T))
+                for candidate in candidates]
+        predictions = [self.prediction_cache.get(key) for key in keys]
+        missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if missing:
+            message = {
+                'heater_status': self.heater_status,
+                'current_temperatures': self.current_temperatures,
+                'delta_t': DELTA_T,
+                'candidates': [candidates[i] for i in missing]
+            }
+            replies = self.request("controller/heater_simulation_batch", 'controller_simulation/batch_temperatures', message).get('predictions', [])
+            if len(replies) != len(missing):
+                return []
+            for i, reply in zip(missing, replies):
+                predictions[i] = reply
+                self.prediction_cache.put(keys[i], reply)
+        return predictions
+
+    def predict_horizon(self, client, heater_schedule, environment_profile=None):
+        """Predicts the temperatures for a schedule of heater states with one request, returns one dict per step."""
+        message = {
+            'heater_schedule': heater_schedule,
+            'current_temperatures': self.current_temperatures,
+            'delta_t': DELTA_T,
             'capacity': self.capacity_controller_simulation,
             'heat_transfer_external': self.heat_transfer_external_controller_simulation,
             'heat_transfer_zones': self.heat_transfer_zones_controller_simulation
         }
+        if environment_profile is not None:
+            message['environment'] = list(environment_profile)
+        return self.request("controller/heater_horizon", 'controller_simulation/horizon_temperatures', message).get('trajectory', [])
+
+    @staticmethod
+    def parameter_paths(params):
+        """Lists every tunable parameter as (param_type, zone) or (param_type, zone, sub_zone)."""
+        paths = []
+        for param_type, values in params.items():
+            for zone, value in values.items():
+                if isinstance(value, dict):
+                    paths.extend((param_type, zone, sub_zone) for sub_zone in value)
+                else:
+                    paths.append((param_type, zone))
+        return paths
+
+    @staticmethod
+    def _get_parameter(params, path):
+        value = params
+        for key in path:
+            value = value[key]
+        return value
+
+    @staticmethod
+    def _set_parameter(params, path, value):
+        container = params
+        for key in path[:-1]:
+            container = container[key]
+        container[path[-1]] = value
+
+    def gradient_descent(self, client):
+        # work on copies, the controller simulation keeps its constants until the caller applies the result
+        params = copy.deepcopy({
+            'capacity': self.capacity_controller_simulation,
+            'heat_transfer_external': self.heat_transfer_external_controller_simulation,
+            'heat_transfer_zones': self.heat_transfer_zones_controller_simulation
+        })
         learning_rate = 200
-        predicted_temperatures = self.predicted_temperatures_history[-1]
+        paths = self.parameter_paths(params)
+        best_params, best_rmse = params, math.inf
+
+        def prediction_rmse(predicted_temperatures):
+            # only use temperature sensors
+            return math.sqrt(sum((self.comparison_temperatures[sensor] - predicted_temperatures[sensor]) ** 2 for sensor in self.sensors) / len(self.sensors))
 
         for iteration in range(5):
-            # new simulation
-            predicted_temperatures = self.predict_heater_effects(client)
-            # self.predicted_temperatures_history.append(predicted_temperatures)
+            # the current parameters and one probe up and one down for every parameter, simulated in one batch
+            candidates = [params]
+            for path in paths:
+                for change in [-1, 1]:
+                    probe = copy.deepcopy(params)
+                    # check if the value is still positive
+                    self._set_parameter(probe, path, max(0, self._get_parameter(params, path) + learning_rate * change))
+                    candidates.append(probe)
+            try:
+                predictions = self.predict_heater_effects_batch(client, candidates)
+            except RemoteError as e:
+                print(f"The controller simulation rejected the batch ({e}), keeping the best constants found so far")
+                break
+            if len(predictions) != len(candidates):
+                print("No reply from the controller simulation, keeping the best constants found so far")
+                break
+            errors = [prediction_rmse(prediction) for prediction in predictions]
+            rmse = errors[0]
 
-            # Calculate the RMSE and print it rounded to 2 decimal places
-            rmse = math.sqrt(sum((self.comparison_temperatures[sensor] - predicted_temperatures[sensor]) ** 2 for sensor in ['TA', 'TB', 'TC', 'TD']) / 4)
-            
             print(f"Iteration {iteration}: RMSE = {rmse:.2f}")
 
+            for candidate, error in zip(candidates, errors):
+                if error < best_rmse:
+                    best_params, best_rmse = candidate, error
+
             # Check if the target temperature is close enough
             if abs(rmse) < 0.4:
                 print(f"Target temperature reached within tolerance.")
                 break
 
-           # for each parameter find out, if the error shrinks if increased or decreased or left unchanged
-            for param_type in params:
-                for zone in params[param_type]:
-                    original_value = params[param_type][zone]
-                    
-                    if isinstance(original_value, dict):
-                        # If the value is a dictionary (like for heat_transfer_zones), handle each sub_zone individually
-                        for sub_zone in original_value:
-                            original_sub_value = original_value[sub_zone]
-                            best_sub_value = original_sub_value
-                            best_rmse = rmse
-
-                            for change in [-1, 0, 1]:
-                                # Adjust sub_zone value
-                                params[param_type][zone][sub_zone] = original_sub_value + learning_rate * change
-                                if params[param_type][zone][sub_zone] < 0:
-                                    params[param_type][zone][sub_zone] = 0
-                                params['heat_transfer_zones'][zone][sub_zone] = params[param_type][zone][sub_zone]
-
-                                # Predict temperatures and calculate the RMSE
-                                predicted_temperature = self.predict_heater_effects(client)
-                                # only use temperature sensors
-                                new_rmse = math.sqrt(sum((self.comparison_temperatures[sensor] - predicted_temperatures[sensor]) ** 2 for sensor in ['TA', 'TB', 'TC', 'TD']) / 4)
-
-                                if new_rmse < best_rmse:
-                                    best_sub_value = params[param_type][zone][sub_zone]
-                                    best_rmse = new_rmse
-                                else:
-                                    # Revert to the original sub_zone value
-                                    params[param_type][zone][sub_zone] = original_sub_value
-
-                            # Update the best sub_zone value in the controller simulation
-                            params['heat_transfer_zones'][zone][sub_zone] = best_sub_value
-
-                    else:
-                        # For non-dict values (like capacity and heat_transfer_external), handle as usual
-                        best_value = original_value
-                        best_rmse = rmse
-
-                        for change in [-1, 0, 1]:
-                            params[param_type][zone] = original_value + learning_rate * change
-                            # check if the value is still positive
-                            if params[param_type][zone] < 0:
-                                params[param_type][zone] = 0
-
-                            if param_type == 'capacity':
-                                params['capacity'][zone] = params[param_type][zone]
-                            elif param_type == 'heat_transfer_external':
-                                params['heat_transfer_external'][zone] = params[param_type][zone]
-
-                            # Predict temperatures and calculate the RMSE
-                            predicted_temperatures = self.predict_heater_effects(client)
-                            # only use temperature sensors
-                            new_rmse = math.sqrt(sum((self.comparison_temperatures[sensor] - predicted_temperatures[sensor]) ** 2 for sensor in ['TA', 'TB', 'TC', 'TD']) / 4)
-
-                            if new_rmse < best_rmse:
-                                best_value = params[param_type][zone]
-                                best_rmse = new_rmse
-                            else:
-                                # Revert to the original value
-                                params[param_type][zone] = original_value
-
-                        # Update the best value in the controller simulation
-                        if param_type == 'capacity':
-                            params['capacity'][zone] = best_value
-                        elif param_type == 'heat_transfer_external':
-                            params['heat_transfer_external'][zone] = best_value
-            
-                        # adaptive learning rate
-            
+            # for each parameter take the probe with the smaller error, or leave it unchanged if neither helps
+            update = copy.deepcopy(params)
+            for p, path in enumerate(paths):
+                down, up = errors[1 + 2 * p], errors[2 + 2 * p]
+                if min(down, up) < rmse:
+                    best_probe = candidates[1 + 2 * p] if down <= up else candidates[2 + 2 * p]
+                    self._set_parameter(update, path, self._get_parameter(best_probe, path))
+            params = update
+
+            # adaptive learning rate
             learning_rate = learning_rate * 0.75
 
-        return params
+        # the combined update of the last iteration is not simulated, return the best evaluated constants
+        return best_params
 
     def deep_copy_params(self, params):
         return {key: {k: v for k, v in value.items()} for key, value in params.items()}
@@ -356,16 +633,23 @@ class TemperatureController:
 #STOP_TIME = 5000
 DELTA_T = config.Controller.SIM_DELTA_T
 
-client = mqtt.Client()
-client.username_pw_set(config.Mqtt.MQTT_SERVER_USER, config.Mqtt.MQTT_SERVER_PASS)
-controller = TemperatureController(config.Controller.TARGET_TEMP, config.Controller.BROKEN_HEATER_TIMES, config.Controller.SIM_STOP_TIME)
-controller.set_adjustment_mode(config.Controller.ADJUSTMENT_MODE) # simple or advanced
+def main():
+    """Runs the controller for config.Controller.SIM_STOP_TIME, returns it for inspection."""
+    client = transport.create_client()
+    controller = TemperatureController(config.Controller.TARGET_TEMP, config.Controller.BROKEN_HEATER_TIMES, config.Controller.SIM_STOP_TIME)
+    controller.set_adjustment_mode(config.Controller.ADJUSTMENT_MODE) # simple, advanced or mpc
+    controller.set_estimator(config.Controller.ESTIMATOR)
 
-for i in range(config.Controller.SIM_STOP_TIME // DELTA_T):
-    # if the controller mode is advanced, the advanced adjustment function needs to be called
-    if controller.adjustment_mode == 'advanced':
-        controller.adjust_heater_status_advanced(client)
+    if config.Controller.EXECUTION == 'asyncio':
+        asyncio.run(controller.run_async(client, config.Controller.SIM_STOP_TIME // DELTA_T))
     else:
-        controller.adjust_heater_status_simple(client)
-print('end')
-client.disconnect()
+        for i in range(config.Controller.SIM_STOP_TIME // DELTA_T):
+            # the adjustment function of the controller mode (simple, advanced or mpc)
+            getattr(controller, f'adjust_heater_status_{controller.adjustment_mode}')(client)
+    print('end')
+    controller.close()
+    client.disconnect()
+    return controller
+
+if __name__ == "__main__":
+    main()
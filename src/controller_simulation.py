@@ -1,7 +1,9 @@
-import paho.mqtt.client as mqtt
 import json
 import numpy as np
 import config
+import transport
+import wire
+from thermal_model import ThermalModel
 
 
 class HeatingSimulation:
@@ -10,15 +12,17 @@ class HeatingSimulation:
         self.capacity = {}
         self.heat_transfer_external = {}
         self.heat_transfer_zones = {}
-        self.zones_neighbors = {}
+        self.model = ThermalModel(config.Model.SENSOR_ZONES, config.Model.BACKEND, config.Model.DISCRETIZATION)
+        self.encoder = wire.Encoder()
+        self.decoder = wire.Decoder()
         self.current_time = 0
         initial_temperature = self.generate_environment_temperature(self.current_time)
-        self.temperatures = {'Z1': initial_temperature, 'Z2': initial_temperature, 'Z3': initial_temperature}
+        self.temperatures = {zone: initial_temperature for zone in config.Model.HEAT_CAPACITY}
 
-    def simulate_step(self, heater_status, current_temps, delta_t):
+    def simulate_step(self, heater_status, current_temps, delta_t, correlation_id=None):
         new_temps = self.calculate_new_temps(current_temps, heater_status, self.current_time, delta_t)
         self.temperatures.update(new_temps)
-        self.publish_temperatures()
+        self.publish_temperatures(correlation_id)
         self.current_time += 1
     
     def generate_environment_temperature(self, current_time):
@@ -28,60 +32,134 @@ class HeatingSimulation:
         return base_temp
 
     def calculate_new_temps(self, current_temps, heater_status, current_time, delta_t):
-        new_temps = {}
         env_temp = self.generate_environment_temperature(current_time)
-        for zone in self.capacity.keys():  # Sicherstellen, dass nur die Zonen verwendet werden, die in der Nachricht enthalten sind
-            if zone in current_temps:  # Überprüfen, ob die Zone existiert
-                heat_loss = current_temps[zone] * (
-                    self.heat_transfer_external[zone] + 
-                    sum(self.heat_transfer_zones[zone].get(nbr, 0) for nbr in self.zones_neighbors[zone])
-                )
-                heat_gain = (
-                    self.heat_transfer_external[zone] * env_temp +
-                    sum(self.heat_transfer_zones[zone].get(nbr, 0) * current_temps.get(nbr, 0) for nbr in self.zones_neighbors[zone])
-                )
-                new_temps[zone] = current_temps[zone] + (delta_t / self.capacity[zone]) * (heater_status[zone] + heat_gain - heat_loss)
-        return new_temps
+        # the matrices are only rebuilt if the parameters or delta_t changed
+        self.model.set_parameters(self.capacity, self.heat_transfer_external, self.heat_transfer_zones, delta_t)
+        # only the zones contained in the message are updated
+        return self.model.step_dict(current_temps, heater_status, env_temp)
 
     def update_heater_status(self, message):
-        status = json.loads(message.payload.decode())
+        status = self.decoder.loads(message.topic, message.payload)
         heater_status = status['heater_status']
         current_temps = status['current_temperatures']
         self.delta_t = status['delta_t']  # Make sure to assign delta_t
-        self.capacity = status['capacity']
-        self.heat_transfer_external = status['heat_transfer_external']
-        self.heat_transfer_zones = status['heat_transfer_zones']
-        self.zones_neighbors = {zone: list(self.heat_transfer_zones[zone].keys()) for zone in self.heat_transfer_zones}
-        self.simulate_step(heater_status, current_temps, self.delta_t)
+        # binary messages only carry the constants when they changed, see wire.py
+        self.capacity = status.get('capacity', self.capacity)
+        self.heat_transfer_external = status.get('heat_transfer_external', self.heat_transfer_external)
+        self.heat_transfer_zones = status.get('heat_transfer_zones', self.heat_transfer_zones)
+        self.simulate_step(heater_status, current_temps, self.delta_t, status.get('correlation_id'))
         print(status)
 
-    def publish_temperatures(self):
-        Z1 = self.temperatures['Z1']
-        Z2 = self.temperatures['Z2']
-        Z3 = self.temperatures['Z3']
+    def simulate_batch(self, message):
+        """Predicts one step for every candidate of a batch request and publishes all predictions in one reply.
+
+        The request holds 'delta_t', the shared 'current_temperatures' and 'heater_status', and a list of
+        'candidates', each with 'capacity', 'heat_transfer_external' and 'heat_transfer_zones' and optionally
+        its own 'current_temperatures' or 'heater_status'. The simulation state is not advanced.
+        """
+        request = json.loads(message.payload.decode())
+        try:
+            candidates = request['candidates']
+            parameter_sets = [(candidate['capacity'], candidate['heat_transfer_external'], candidate['heat_transfer_zones'])
+                              for candidate in candidates]
+            matrices = self.model.compile_batch(parameter_sets, request['delta_t'])
+
+            shared_temperatures = self.model.to_vector(request.get('current_temperatures', {}))
+            shared_heating = self.model.to_vector(request.get('heater_status', {}))
+            temperatures = np.array([self.model.to_vector(candidate['current_temperatures']) if 'current_temperatures' in candidate
+                                     else shared_temperatures for candidate in candidates])
+            heating = np.array([self.model.to_vector(candidate['heater_status']) if 'heater_status' in candidate
+                                else shared_heating for candidate in candidates])
+
+            environment = self.generate_environment_temperature(self.current_time)
+            new_temps = self.model.step_batch(matrices, temperatures, heating, environment)
+            readings = self.model.observe(new_temps)
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError) as e:
+            self.publish_error("controller_simulation/batch_temperatures", request, e)
+            return
+
+        predictions = []
+        for zone_values, sensor_values in zip(new_temps.tolist(), readings.tolist()):
+            prediction = dict(zip(self.model.zones, zone_values))
+            prediction.update(zip(self.model.sensors, sensor_values))
+            prediction['environment'] = environment
+            predictions.append(prediction)
+        reply = {'predictions': predictions}
+        if 'correlation_id' in request:
+            reply['correlation_id'] = request['correlation_id']
+        client.publish("controller_simulation/batch_temperatures", json.dumps(reply))
+
+    def simulate_horizon(self, message):
+        """Predicts a whole trajectory of K steps in-process and publishes it in one reply.
+
+        The request holds 'current_temperatures', 'delta_t', the model constants and a 'heater_schedule' with
+        one heater status per step. The optional 'environment' profile defaults to the environment model from
+        the current simulation time on. The simulation state is not advanced.
+        """
+        request = json.loads(message.payload.decode())
+        try:
+            schedule = request['heater_schedule']
+            environment = request.get('environment')
+            if environment is None:
+                environment = [self.generate_environment_temperature(self.current_time + k) for k in range(len(schedule))]
+            if len(environment) != len(schedule):
+                raise ValueError("The environment profile needs one temperature per step of the heater schedule.")
+
+            self.model.set_parameters(request['capacity'], request['heat_transfer_external'],
+                                      request['heat_transfer_zones'], request['delta_t'])
+            heating = np.array([self.model.to_vector(status) for status in schedule]).reshape(len(schedule), len(self.model.zones))
+            trajectory = self.model.rollout(self.model.to_vector(request['current_temperatures']), heating, environment)
+            readings = self.model.observe(trajectory)
+        except (KeyError, ValueError) as e:
+            self.publish_error("controller_simulation/horizon_temperatures", request, e)
+            return
+
+        steps = []
+        for zone_values, sensor_values, environment_temperature in zip(trajectory.tolist(), readings.tolist(), environment):
+            step = dict(zip(self.model.zones, zone_values))
+            step.update(zip(self.model.sensors, sensor_values))
+            step['environment'] = environment_temperature
+            steps.append(step)
+        reply = {'trajectory': steps}
+        if 'correlation_id' in request:
+            reply['correlation_id'] = request['correlation_id']
+        client.publish("controller_simulation/horizon_temperatures", json.dumps(reply))
+
+    def publish_error(self, topic, request, error):
+        """Replies to a request that cannot be handled, the requester gets the error instead of waiting for the timeout."""
+        print(f"Invalid request: {error!r}")
+        reply = {'error': f"{type(error).__name__}: {error}"}
+        if 'correlation_id' in request:
+            reply['correlation_id'] = request['correlation_id']
+        client.publish(topic, json.dumps(reply))
+
+    def publish_temperatures(self, correlation_id=None):
+        # zone temperatures and the sensor readings through the observation matrix (config.Model.SENSOR_ZONES)
+        temp_data = dict(self.temperatures)
+        temp_data.update(self.model.observe_dict(self.temperatures))
+        #temp_data['TB'] = 42 # Faulty component
+        temp_data['environment'] = self.generate_environment_temperature(self.current_time)
         
-        temp_data = {
-            'Z1': Z1,
-            'Z2': Z2,
-            'Z3': Z3,
-            'TA': Z1,
-            'TB': (Z1 + Z2) / 2,
-            #'TB': 42, # Faulty component
-            'TC': (Z2 + Z3) / 2,
-            'TD': Z3,
-            'environment': self.generate_environment_temperature(self.current_time)
-        }
-        
-        client.publish("controller_simulation/temperatures", json.dumps(temp_data))
+        if correlation_id is not None:
+            # lets the requester match the reply
+            temp_data['correlation_id'] = correlation_id
+        client.publish("controller_simulation/temperatures", self.encoder.dumps("controller_simulation/temperatures", temp_data))
 
 # MQTT Callbacks
 
 def on_connect(client, userdata, flags, rc):
     print("Connected with result code " + str(rc))
     client.subscribe("controller/heater_simulation")
+    client.subscribe("controller/heater_simulation_batch")
+    client.subscribe("controller/heater_horizon")
 
 def on_message(client, userdata, msg):
-    simulation.update_heater_status(msg)
+    if msg.topic == "controller/heater_simulation_batch":
+        simulation.simulate_batch(msg)
+    elif msg.topic == "controller/heater_horizon":
+        simulation.simulate_horizon(msg)
+    else:
+        simulation.update_heater_status(msg)
 
 def on_disconnect(client, userdata, rc):
     print("Disconnected with result code " + str(rc))
@@ -90,22 +168,25 @@ def on_disconnect(client, userdata, rc):
 SIMULATION_DURATION = 7200  # Use this for calculating environment temperature fluctuation
 
 
-# MQTT Client setup
-client = mqtt.Client()
-client.on_connect = on_connect
-client.on_message = on_message
-client.on_disconnect = on_disconnect
-client.username_pw_set(config.Mqtt.MQTT_SERVER_USER, config.Mqtt.MQTT_SERVER_PASS)
-
-
-# Start simulation
-simulation = HeatingSimulation()
-client.connect(config.Mqtt.MQTT_SERVER_URL, config.Mqtt.MQTT_SERVER_PORT, 60)
-client.loop_start()
-
-try:
-    while True:
-        pass  # Keep the script running to listen for messages
-except KeyboardInterrupt:
-    client.loop_stop()
-    client.disconnect()
+client = None
+simulation = None
+
+def start():
+    """Creates the simulation and connects its client, the caller runs the network loop."""
+    global client, simulation
+    simulation = HeatingSimulation()
+    client = transport.create_client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_disconnect = on_disconnect
+    return transport.connect(client)
+
+def main():
+    start()
+    try:
+        client.loop_forever()  # Keep the script running to listen for messages
+    except KeyboardInterrupt:
+        client.disconnect()
+
+if __name__ == "__main__":
+    main()
@@ -1,109 +1,414 @@
+import hashlib
 import json
-import paho.mqtt.client as mqtt
+import io
+import os
+import re
 import config
+import transport
 
-def extract_mqtt_connections(contents):
-    publisher_map = {}
-    subscriber_map = {}
-
-    def find_publishers(data):
-        def traverse_objects(item, current_name=None):
-            if isinstance(item, dict):
-                # Update current name if this item is an InstanceComponent
-                if item.get('@type') == 'InstanceComponent':
-                    current_name = item.get('name', current_name)
-
-                # Check for multiple realizations and store topics for each MQTTPublisher
-                realizations = item.get('realization', [])
-                if not isinstance(realizations, list):
-                    realizations = [realizations]
-
-                for realization in realizations:
-                    if realization.get('@type') == 'TelemetryRealizationMQTTPublisher':
-                        topic = realization.get('topic')
-                        if current_name:
-                            if current_name not in publisher_map:
-                                publisher_map[current_name] = set()
-                            publisher_map[current_name].add(topic)
-
-                # Recursively search within this dictionary
-                for value in item.values():
-                    traverse_objects(value, current_name)
-
-            elif isinstance(item, list):
-                for element in item:
-                    traverse_objects(element, current_name)
-
-        # Start traversal from the root
-        traverse_objects(data)
-        return publisher_map
-
-    def find_subscribers(data):
-        def traverse_objects(item, current_name=None):
-            if isinstance(item, dict):
-                # Update current name if this item is an InstanceComponent
-                if item.get('@type') == 'InstanceComponent':
-                    current_name = item.get('name', current_name)
-
-                # Check for multiple realizations and store topics for each MQTTSubscriber
-                realizations = item.get('realization', [])
-                if not isinstance(realizations, list):
-                    realizations = [realizations]
-
-                for realization in realizations:
-                    if realization.get('@type') == 'TelemetryRealizationMQTTSubscriber':
-                        topic = realization.get('topic')
-                        if current_name:
-                            if current_name not in subscriber_map:
-                                subscriber_map[current_name] = set()
-                            subscriber_map[current_name].add(topic)
-
-                # Recursively search within this dictionary
-                for value in item.values():
-                    traverse_objects(value, current_name)
-
-            elif isinstance(item, list):
-                for element in item:
-                    traverse_objects(element, current_name)
-
-        # Start traversal from the root
-        traverse_objects(data)
-        return subscriber_map
-
-    def match_publishers_and_subscribers():
+# bump whenever the serialized artifacts or the extraction semantics change, older cache files are then ignored
+# 2: wildcard subscriptions, edges deduplicated in publisher order (topic trie)
+CACHE_FORMAT_VERSION = 2
+
+# in-memory caches: path -> (mtime_ns, size, digest) and (digest, artifact name) -> artifact
+_file_digests = {}
+_artifacts = {}
+
+class TopicIndex:
+    """Trie over the '/' separated levels of the published topics.
+
+    Resolves exact and wildcard ('+', '#') subscriptions by walking only the matching branches.
+    """
+
+    class Node:
+        __slots__ = ('children', 'publishers')
+
+        def __init__(self):
+            self.children = {}
+            self.publishers = {}  # used as an ordered set
+
+    def __init__(self):
+        self.root = TopicIndex.Node()
+        self.order = {}  # publisher -> first appearance, keeps the edge order deterministic
+        self._matches = {}
+
+    def add_publisher(self, publisher, topic):
+        self.order.setdefault(publisher, len(self.order))
+        node = self.root
+        for level in topic.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = TopicIndex.Node()
+            node = child
+        node.publishers[publisher] = None
+        self._matches.clear()
+
+    def match(self, topic_filter):
+        """Returns the publishers of every topic matching topic_filter."""
+        if topic_filter in self._matches:
+            return self._matches[topic_filter]
+        levels = topic_filter.split('/')
+        publishers = {}
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth == len(levels):
+                publishers.update(node.publishers)
+                continue
+            level = levels[depth]
+            if level == '#':
+                # multi-level wildcard, matches the parent level and everything below it
+                subtree = [node]
+                while subtree:
+                    current = subtree.pop()
+                    publishers.update(current.publishers)
+                    subtree.extend(child for name, child in current.children.items()
+                                   if not (current is self.root and name.startswith('$')))
+            elif level == '+':
+                # wildcards do not match topics starting with '$' on the first level
+                stack.extend((child, depth + 1) for name, child in node.children.items()
+                             if not (node is self.root and name.startswith('$')))
+            elif level in node.children:
+                stack.append((node.children[level], depth + 1))
+        self._matches[topic_filter] = publishers
+        return publishers
+
+    def connect(self, subscriptions):
+        """Maps each subscriber to the deduplicated list of publishers it receives from."""
         connections = {}
-        for subscriber, topics in subscriber_map.items():
-            for topic in topics:
-                for publisher, publisher_topics in publisher_map.items():
-                    if topic in publisher_topics:
-                        if subscriber not in connections:
-                            connections[subscriber] = []
-                        connections[subscriber].append(publisher)
-        return connections
-
-    # Execute the find operations
-    publisher_map = find_publishers(contents)
-    subscriber_map = find_subscribers(contents)
-    
+        for subscriber, topic_filter in subscriptions:
+            publishers = self.match(topic_filter)
+            if publishers:
+                connections.setdefault(subscriber, {}).update(publishers)
+        return {subscriber: sorted(publishers, key=self.order.__getitem__)
+                for subscriber, publishers in connections.items()}
+
+def topic_matches(topic_filter, topic):
+    """Whether topic_filter matches topic, by the rules of TopicIndex; used by the in-process broker."""
+    index = TopicIndex()
+    index.add_publisher(topic, topic)
+    return bool(index.match(topic_filter))
+
+PUBLISHER = 'TelemetryRealizationMQTTPublisher'
+SUBSCRIBER = 'TelemetryRealizationMQTTSubscriber'
+
+def iter_mqtt_endpoints(data):
+    """Yields (component, realization type, topic) for every MQTT realization in a parsed DTDL tree.
+
+    Iterative depth-first walk, a realization belongs to the innermost enclosing InstanceComponent.
+    """
+    stack = [(data, None)]
+    while stack:
+        item, current_name = stack.pop()
+        if isinstance(item, dict):
+            # Update current name if this item is an InstanceComponent
+            if item.get('@type') == 'InstanceComponent':
+                current_name = item.get('name', current_name)
+
+            # Check for multiple realizations
+            realizations = item.get('realization', [])
+            if not isinstance(realizations, list):
+                realizations = [realizations]
+
+            for realization in realizations:
+                if isinstance(realization, dict) and realization.get('@type') in (PUBLISHER, SUBSCRIBER):
+                    topic = realization.get('topic')
+                    if current_name and topic is not None:
+                        yield current_name, realization['@type'], topic
+
+            stack.extend((value, current_name) for value in reversed(list(item.values())))
+
+        elif isinstance(item, list):
+            stack.extend((element, current_name) for element in reversed(item))
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?')
+_NUMBER_CHARS = re.compile(r'[-+0-9.eE]*')
+_LITERALS = (('true', True), ('false', False), ('null', None))
+
+def iter_json_events(file, chunk_size=65536):
+    """Reads a JSON document incrementally and yields (event, value) pairs.
+
+    The events are 'start_map', 'end_map', 'start_array', 'end_array', 'key' and 'value'. Only the
+    current chunk is held in memory, never the decoded document.
+    """
+    buffer = ''
+    pos = 0
+    eof = False
+    containers = []  # True for objects, False for arrays
+    expect_key = False
+
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        need_more = pos == len(buffer)
+        if not need_more:
+            char = buffer[pos]
+            if char == '{':
+                containers.append(True)
+                expect_key = True
+                pos += 1
+                yield 'start_map', None
+            elif char == '}':
+                containers.pop()
+                expect_key = False
+                pos += 1
+                yield 'end_map', None
+            elif char == '[':
+                containers.append(False)
+                pos += 1
+                yield 'start_array', None
+            elif char == ']':
+                containers.pop()
+                pos += 1
+                yield 'end_array', None
+            elif char == ',':
+                expect_key = bool(containers) and containers[-1]
+                pos += 1
+            elif char == ':':
+                expect_key = False
+                pos += 1
+            elif char == '"':
+                try:
+                    value, pos = json.decoder.scanstring(buffer, pos + 1)
+                except json.JSONDecodeError:
+                    # the string continues in the next chunk
+                    if eof:
+                        raise
+                    need_more = True
+                else:
+                    if expect_key:
+                        expect_key = False
+                        yield 'key', value
+                    else:
+                        yield 'value', value
+            else:
+                match = _NUMBER.match(buffer, pos)
+                # a number is only complete once the characters following it are in the buffer
+                number_end = _NUMBER_CHARS.match(buffer, pos).end()
+                if match and (number_end < len(buffer) or eof):
+                    pos = match.end()
+                    if match.group(1) or match.group(2):
+                        yield 'value', float(match.group())
+                    else:
+                        yield 'value', int(match.group())
+                elif match or len(buffer) - pos < 5 and not eof:
+                    need_more = True
+                else:
+                    for literal, value in _LITERALS:
+                        if buffer.startswith(literal, pos):
+                            pos += len(literal)
+                            yield 'value', value
+                            break
+                    else:
+                        raise ValueError(f"Unexpected character {char!r} in JSON stream")
+        if need_more:
+            if eof:
+                if containers:
+                    raise ValueError("Unexpected end of JSON stream")
+                return
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+class _StreamFrame:
+    """An open JSON container while streaming, maps remember the fields needed to place realizations."""
+    __slots__ = ('is_map', 'parent', 'owner', 'key', 'type', 'name', 'topic', 'pending')
+
+    def __init__(self, is_map, parent, owner):
+        self.is_map = is_map
+        self.parent = parent  # innermost enclosing map
+        self.owner = owner  # the map holding the 'realization' key, if this container is (part of) its value
+        self.key = None
+        self.type = None
+        self.name = None
+        self.topic = None
+        self.pending = []  # realizations waiting for the '@type'/'name' of this map
+
+def iter_mqtt_endpoints_stream(file, chunk_size=65536):
+    """Single streaming pass over a DTDL document, yields (component, realization type, topic).
+
+    Same records as iter_mqtt_endpoints, but read incrementally from a file handle. A record is emitted
+    as soon as its InstanceComponent is known, usually right after the realization has been read.
+    """
+    frames = []
+    emitted = []
+
+    def deliver(frame, record):
+        # walk outwards to the innermost InstanceComponent, wait where the '@type' is still unknown
+        while frame is not None:
+            if frame.type is None or frame.type == 'InstanceComponent' and frame.name is None:
+                frame.pending.append(record)
+                return
+            if frame.type == 'InstanceComponent':
+                if frame.name:
+                    emitted.append((frame.name,) + record)
+                return
+            frame = frame.parent
+
+    def release(frame, parent):
+        pending, frame.pending = frame.pending, []
+        for record in pending:
+            deliver(parent, record)
+
+    for event, value in iter_json_events(file, chunk_size):
+        container = frames[-1] if frames else None
+        if event == 'key':
+            container.key = value
+        elif event == 'value':
+            if container is not None and container.is_map:
+                if container.key == '@type':
+                    container.type = value
+                    if value != 'InstanceComponent' or container.name is not None:
+                        release(container, container.parent if value != 'InstanceComponent' else container)
+                elif container.key == 'name':
+                    container.name = value
+                    if container.type == 'InstanceComponent':
+                        release(container, container)
+                elif container.key == 'topic':
+                    container.topic = value
+        elif event in ('start_map', 'start_array'):
+            if container is None:
+                parent = owner = None
+            elif container.is_map:
+                parent = container
+                owner = container if container.key == 'realization' else None
+            else:
+                parent = container.parent
+                owner = container.owner if event == 'start_map' else None
+            frames.append(_StreamFrame(event == 'start_map', parent, owner))
+        else:
+            frame = frames.pop()
+            if frame.is_map:
+                if frame.owner is not None and frame.type in (PUBLISHER, SUBSCRIBER) and frame.topic is not None:
+                    deliver(frame.owner, (frame.type, frame.topic))
+                # still unresolved: not a named InstanceComponent, hand over to the enclosing map
+                if frame.pending:
+                    release(frame, frame.parent)
+        if emitted:
+            yield from emitted
+            emitted.clear()
+
+def connections_from_endpoints(endpoints):
+    """Builds the connections (subscriber -> publishers) from (component, realization type, topic) records."""
+    index = TopicIndex()
+    subscriptions = []
+    for component, realization_type, topic in endpoints:
+        if realization_type == PUBLISHER:
+            index.add_publisher(component, topic)
+        else:
+            subscriptions.append((component, topic))
+
     # Match publishers and subscribers based on topics and return the connections
-    return match_publishers_and_subscribers()
+    return index.connect(subscriptions)
+
+def extract_mqtt_connections(contents):
+    return connections_from_endpoints(iter_mqtt_endpoints(contents))
+
+def extract_mqtt_connections_from_stream(file):
+    """Like extract_mqtt_connections, for a whole DTDL document read incrementally from a file handle."""
+    return connections_from_endpoints(iter_mqtt_endpoints_stream(file))
+
+def file_digest(dtdl_file_path):
+    """Returns the content hash of a DTDL file, re-reading it only if its mtime or size changed."""
+    stat = os.stat(dtdl_file_path)
+    known = _file_digests.get(dtdl_file_path)
+    if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+        return known[2]
+    with open(dtdl_file_path, 'rb') as file:
+        digest = hashlib.sha256(file.read()).hexdigest()
+    _file_digests[dtdl_file_path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+def cache_directory(cache_dir=None):
+    """The disk cache (config.Dtdl2Graph.CACHE_DIR); a relative path is taken from the source directory, not the working directory."""
+    cache_dir = cache_dir or config.Dtdl2Graph.CACHE_DIR
+    return os.path.join(os.path.dirname(os.path.abspath(config.__file__)), cache_dir)
+
+def cached_artifact(digest, name, build, cache_dir=None):
+    """Returns the artifact `name` compiled from the DTDL content `digest`.
+
+    Looks in memory first, then in the JSON files of the disk cache, and calls build() only on a miss.
+    """
+    key = (digest, name)
+    if key in _artifacts:
+        return _artifacts[key]
+    cache_dir = cache_directory(cache_dir)
+    cache_file = os.path.join(cache_dir, f"{digest}.{name}.v{CACHE_FORMAT_VERSION}.json")
+    try:
+        with open(cache_file, 'r') as file:
+            artifact = json.load(file)
+    except (OSError, ValueError):
+        artifact = build()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file + '.tmp', 'w') as file:
+                json.dump(artifact, file)
+            os.replace(cache_file + '.tmp', cache_file)
+        except OSError as e:
+            print(f"Could not write graph cache {cache_file}: {e}")
+    _artifacts[key] = artifact
+    return artifact
+
+def load_graph(dtdl_file_path):
+    """Compiles the publisher/subscriber graph of a DTDL file in-process, cached by content hash.
+
+    Returns (digest, connections).
+    """
+    digest = file_digest(dtdl_file_path)
+
+    def build():
+        with open(dtdl_file_path, 'r', encoding='utf-8') as file:
+            # large twins are streamed instead of being decoded in full
+            if os.path.getsize(dtdl_file_path) >= config.Dtdl2Graph.STREAMING_MIN_BYTES:
+                return extract_mqtt_connections_from_stream(file)
+            return extract_mqtt_connections(json.load(file)['contents'])
+
+    return digest, cached_artifact(digest, 'graph', build)
+
+def load_publishers(dtdl_file_path, topic_filter):
+    """Components publishing on a topic that matches topic_filter (e.g. 'sensor/+'), in document order.
+
+    Cached by content hash like load_graph.
+    """
+    digest = file_digest(dtdl_file_path)
+
+    def build():
+        index = TopicIndex()
+        with open(dtdl_file_path, 'r', encoding='utf-8') as file:
+            if os.path.getsize(dtdl_file_path) >= config.Dtdl2Graph.STREAMING_MIN_BYTES:
+                endpoints = iter_mqtt_endpoints_stream(file)
+            else:
+                endpoints = iter_mqtt_endpoints(json.load(file)['contents'])
+            for component, realization_type, topic in endpoints:
+                if realization_type == PUBLISHER:
+                    index.add_publisher(component, topic)
+        return sorted(index.match(topic_filter), key=index.order.__getitem__)
+
+    # the filter may contain '/', '+' and '#', which do not belong in a file name
+    name = 'publishers-' + hashlib.sha1(topic_filter.encode()).hexdigest()[:12]
+    return cached_artifact(digest, name, build)
 
 def on_message(client, userdata, msg):
     try:
-        data = json.loads(msg.payload.decode())
-        connections = extract_mqtt_connections(data['contents'])
+        connections = extract_mqtt_connections_from_stream(io.TextIOWrapper(io.BytesIO(msg.payload), encoding='utf-8'))
         response = json.dumps(connections)
         client.publish("dtdl2graph/reply", response)
     except Exception as e:
         print(f"Error processing message: {e}")
 
-def main():
-    client = mqtt.Client()
+def on_connect(client, userdata, flags, rc):
+    client.subscribe("dtdl2graph/request")
+
+def start():
+    """Creates and connects the client of the graph service, the caller runs its network loop."""
+    client = transport.create_client()
+    client.on_connect = on_connect
     client.on_message = on_message
-    client.username_pw_set(config.Mqtt.MQTT_SERVER_USER, config.Mqtt.MQTT_SERVER_PASS)
+    return transport.connect(client)
 
-    client.connect(config.Mqtt.MQTT_SERVER_URL, config.Mqtt.MQTT_SERVER_PORT, 60)
-    client.subscribe("dtdl2graph/request")
+def main():
+    client = start()
 
     client.loop_forever()
 
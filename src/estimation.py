@@ -0,0 +1,193 @@
+import numpy as np
+
+from thermal_model import ThermalModel
+
+# lower bound for the constants, the fit works on their logarithms
+MIN_PARAMETER = 1e-6
+
+
+class LeastSquaresEstimator:
+    """Levenberg-Marquardt fit of the thermal model constants to a window of recorded steps.
+
+    Every step of the history is a one-step prediction from the recorded zone temperatures, the
+    heating powers and the environment temperature; the residuals are the differences between the
+    predicted and the measured sensor readings. The parameters are fitted in log space, which keeps
+    them positive and puts capacities (~1e6) and transfer coefficients (~1e3) on the same scale.
+
+    The Jacobian comes from the explicit heat balance of doc/Heating_simulation.md,
+        T_i' = T_i + dt / C_i (u_i + He_i (env - T_i) + sum_j Hij (T_j - T_i)),
+    so the sensitivities are closed form:
+        dT_i'/dlog C_i = -(T_i' - T_i),  dT_i'/dlog He_i = dt He_i / C_i (env - T_i),
+        dT_i'/dlog Hij = dt Hij / C_i (T_j - T_i).
+    The residuals use the model's own discretization; with 'exact' the Jacobian is the first-order
+    approximation, the step acceptance still uses the true cost.
+
+    Constants the window does not excite (e.g. the zone couplings while all zones have the same
+    temperature) are held near their previous values by a weak prior on the log parameters.
+    """
+
+    def __init__(self, sensor_zones, discretization='euler', max_iterations=20, damping=1e-3, tolerance=1e-9,
+                 prior_weight=1e-2):
+        self.model = ThermalModel(sensor_zones, 'dense', discretization)
+        self.prior_weight = prior_weight
+        self.max_iterations = max_iterations
+        self.damping = damping
+        self.tolerance = tolerance
+
+    def fit(self, capacity, heat_transfer_external, heat_transfer_zones, history, delta_t):
+        """Fits the constants to the history, starting from the given ones.
+
+        history is a list of steps {'temperatures': zone temperatures before the step, 'heater_status',
+        'environment', 'measured': sensor readings after the step}. Returns the fitted
+        (capacity, heat_transfer_external, heat_transfer_zones) dicts and the RMSE of the fit.
+        """
+        zones = list(capacity)
+        pairs = [(zone, neighbour) for zone, neighbours in heat_transfer_zones.items() for neighbour in neighbours]
+        theta = np.array([capacity[zone] for zone in zones] + [heat_transfer_external[zone] for zone in zones]
+                         + [heat_transfer_zones[zone][neighbour] for zone, neighbour in pairs], dtype=float)
+        if not history:
+            return capacity, heat_transfer_external, heat_transfer_zones, float('nan')
+        # log space needs positive values, zeros are moved to a negligible value
+        theta = np.maximum(theta, MIN_PARAMETER)
+
+        self.model.set_parameters(capacity, heat_transfer_external, heat_transfer_zones, delta_t)
+        index = self.model.zone_index
+        sensors = [sensor for sensor in self.model.sensors if all(sensor in step['measured'] for step in history)]
+        X = np.array([self.model.to_vector(step['temperatures']) for step in history])
+        U = np.array([self.model.to_vector(step['heater_status']) for step in history])
+        env = np.array([step['environment'] for step in history], dtype=float)
+        Y = np.array([[step['measured'][sensor] for sensor in sensors] for step in history])
+        H = np.asarray(self.model.H.toarray() if hasattr(self.model.H, 'toarray') else self.model.H)
+        H = H[[self.model.sensors.index(sensor) for sensor in sensors]]
+
+        # the zone every parameter belongs to; neighbours outside the zones only add to the loss
+        owner = np.array([index[zone] for zone in zones] * 2 + [index[zone] for zone, _ in pairs])
+        neighbour = np.array([index.get(other, -1) for _, other in pairs], dtype=np.int64)
+        n, m = len(zones), len(pairs)
+
+        def unpack(theta):
+            return (dict(zip(zones, theta[:n].tolist())), dict(zip(zones, theta[n:2 * n].tolist())),
+                    _nested(pairs, theta[2 * n:].tolist(), heat_transfer_zones))
+
+        prior = np.log(theta)
+        prior_weight = np.sqrt(self.prior_weight)
+
+        def residuals(log_theta):
+            self.model.set_parameters(*unpack(np.exp(log_theta)), delta_t)
+            return np.concatenate([(self.model.step(X, U, env[:, None]) @ H.T - Y).ravel(),
+                                   prior_weight * (log_theta - prior)])
+
+        def jacobian(theta):
+            c, h_ext, h = theta[:n], theta[n:2 * n], theta[2 * n:]
+            gain = delta_t / c
+            # explicit step, rows are the time steps
+            flux = U + h_ext * (env[:, None] - X)
+            # the model takes neighbours outside the zones at 0 degrees
+            exchange = np.where(neighbour >= 0, X[:, np.maximum(neighbour, 0)], 0.0) - X[:, owner[2 * n:]]
+            np.add.at(flux.T, owner[2 * n:], (h * exchange).T)
+            derivatives = np.empty((len(X), 2 * n + m))
+            derivatives[:, :n] = -gain * flux
+            derivatives[:, n:2 * n] = gain * h_ext * (env[:, None] - X)
+            derivatives[:, 2 * n:] = gain[owner[2 * n:]] * h * exchange
+            # sensors see the parameters through the zone they belong to
+            return np.vstack([(derivatives[:, None, :] * H[:, owner][None, :, :]).reshape(-1, len(theta)),
+                              prior_weight * np.eye(len(theta))])
+
+        log_theta = prior.copy()
+        r = residuals(log_theta)
+        cost = r @ r
+        damping = self.damping
+        for iteration in range(self.max_iterations):
+            J = jacobian(np.exp(log_theta))
+            JtJ = J.T @ J
+            gradient = J.T @ r
+            scale = np.diag(JtJ) + 1e-12 * max(np.max(np.diag(JtJ)), 1e-300)
+            while True:
+                step = np.linalg.solve(JtJ + damping * np.diag(scale), -gradient)
+                candidate = log_theta + step
+                r_candidate = residuals(candidate)
+                cost_candidate = r_candidate @ r_candidate
+                if cost_candidate < cost:
+                    break
+                damping *= 4
+                if damping > 1e12:
+                    break
+            if not cost_candidate < cost:
+                break
+            improvement = cost - cost_candidate
+            log_theta, r, cost = candidate, r_candidate, cost_candidate
+            damping = max(damping / 4, 1e-12)
+            if improvement <= self.tolerance * max(cost, 1e-300):
+                break
+
+        capacity, heat_transfer_external, heat_transfer_zones = unpack(np.exp(log_theta))
+        # RMSE of the sensor residuals only
+        fit_residuals = r[:Y.size]
+        return capacity, heat_transfer_external, heat_transfer_zones, float(np.sqrt(fit_residuals @ fit_residuals / max(Y.size, 1)))
+
+
+def _nested(pairs, values, template):
+    """Rebuilds the {zone: {neighbour: value}} dict, zones without neighbours are kept."""
+    nested = {zone: {} for zone in template}
+    for (zone, neighbour), value in zip(pairs, values):
+        nested[zone][neighbour] = value
+    return nested
+
+
+class RecursiveEstimator:
+    """Recursive least squares with a random-walk drift model (a Kalman filter on the constants), one per zone.
+
+    The explicit heat balance is linear in theta_i = (1/C_i, He_i/C_i, Hij/C_i ...):
+        T_i' - T_i = dt (u_i, env - T_i, T_j - T_i ...) . theta_i
+    so every sample updates each zone's estimate and covariance in O(p^2), p = 2 + neighbours.
+    Before each update the covariance grows by the expected drift, (drift * theta)^2 per parameter,
+    so the estimates follow drifting constants without the wind-up of a global forgetting factor
+    while the heating does not excite the system. noise is the standard deviation of a measured
+    temperature change.
+    """
+
+    def __init__(self, capacity, heat_transfer_external, heat_transfer_zones, drift=0.05, noise=0.01,
+                 relative_uncertainty=1.0):
+        self.drift = drift
+        self.noise = noise
+        self.neighbours = {zone: list(heat_transfer_zones.get(zone, {})) for zone in capacity}
+        self.theta = {}
+        self.P = {}
+        for zone in capacity:
+            theta = np.array([1.0 / capacity[zone], heat_transfer_external[zone] / capacity[zone]]
+                             + [heat_transfer_zones[zone][neighbour] / capacity[zone] for neighbour in self.neighbours[zone]])
+            self.theta[zone] = theta
+            # the uncertainties scale with the parameters, which differ by orders of magnitude
+            self.P[zone] = np.diag((relative_uncertainty * self._scale(theta, capacity[zone])) ** 2)
+
+    @staticmethod
+    def _scale(theta, capacity):
+        return np.maximum(np.abs(theta), MIN_PARAMETER / capacity)
+
+    def update(self, temperatures, heater_status, environment, new_temperatures, delta_t):
+        """Updates every zone with one step: zone temperatures before and after, heating and environment."""
+        for zone, theta in self.theta.items():
+            if zone not in temperatures or zone not in new_temperatures:
+                continue
+            t = temperatures[zone]
+            # the model takes neighbours outside the zones at 0 degrees
+            phi = delta_t * np.array([heater_status.get(zone, 0.0), environment - t]
+                                     + [temperatures.get(neighbour, 0.0) - t for neighbour in self.neighbours[zone]])
+            P = self.P[zone] + np.diag((self.drift * self._scale(theta, 1.0 / max(theta[0], 1e-300))) ** 2)
+            Pphi = P @ phi
+            gain = Pphi / (self.noise ** 2 + phi @ Pphi)
+            theta += gain * (new_temperatures[zone] - t - phi @ theta)
+            self.P[zone] = P - np.outer(gain, Pphi)
+
+    def parameters(self, capacity, heat_transfer_external, heat_transfer_zones):
+        """The estimated constants; zones whose estimate is not physical (1/C <= 0) keep the given values."""
+        capacity, heat_transfer_external = dict(capacity), dict(heat_transfer_external)
+        heat_transfer_zones = {zone: dict(neighbours) for zone, neighbours in heat_transfer_zones.items()}
+        for zone, theta in self.theta.items():
+            if theta[0] <= 0:
+                continue
+            capacity[zone] = 1.0 / theta[0]
+            heat_transfer_external[zone] = max(theta[1] / theta[0], MIN_PARAMETER)
+            for neighbour, value in zip(self.neighbours[zone], theta[2:]):
+                heat_transfer_zones[zone][neighbour] = max(value / theta[0], MIN_PARAMETER)
+        return capacity, heat_transfer_external, heat_transfer_zones
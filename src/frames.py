@@ -0,0 +1,82 @@
+import json
+import threading
+import numpy as np
+import config
+
+
+def to_frame(times, samples):
+    """Columnar frame of the samples of many time steps.
+
+    Scalars become lists and dicts of scalars dicts of lists, one entry per time step; a value missing
+    in a sample is None. The keys of the first sample give the columns.
+    """
+    frame = {'time': list(times)}
+    for key, value in samples[0].items():
+        if isinstance(value, dict):
+            names = dict.fromkeys(name for sample in samples for name in sample.get(key, {}))
+            frame[key] = {name: [sample.get(key, {}).get(name) for sample in samples] for name in names}
+        else:
+            frame[key] = [sample.get(key) for sample in samples]
+    return frame
+
+
+def column(frame, key, name=None):
+    """One column of a frame as a float array, NaN for missing values and for unknown columns."""
+    values = frame.get(key) if name is None else frame.get(key, {}).get(name)
+    if values is None:
+        return np.full(len(frame['time']), np.nan)
+    return np.array(values, dtype=float)
+
+
+def columns(frame, key, names):
+    """The columns of the names in one (time steps, names) array, e.g. all sensors of a frame."""
+    values = frame.get(key, {})
+    steps = len(frame['time'])
+    missing = [None] * steps
+    return np.array([values.get(name, missing) for name in names], dtype=float).reshape(len(names), steps).T
+
+
+class BatchPublisher:
+    """Collects the samples of consecutive time steps and publishes them as one frame.
+
+    A frame is published once batch_size samples are collected, or flush_interval seconds after the
+    first sample of a partly filled frame, so the added latency is bounded. Call close() to publish the rest.
+    """
+    def __init__(self, client, topic, batch_size=None, flush_interval=None):
+        self.client = client
+        self.topic = topic
+        self.batch_size = config.Batching.BATCH_SIZE if batch_size is None else batch_size
+        self.flush_interval = config.Batching.FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.times = []
+        self.samples = []
+        self.lock = threading.Lock()
+        # held from taking the samples to their publish, so a timer and a full frame cannot overtake each other
+        self.publish_lock = threading.Lock()
+        self.timer = None
+
+    def append(self, timestamp, sample):
+        with self.lock:
+            self.times.append(timestamp)
+            self.samples.append(sample)
+            if len(self.samples) < self.batch_size:
+                if self.timer is None and self.flush_interval is not None:
+                    self.timer = threading.Timer(self.flush_interval, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """Publishes the collected samples, if there are any."""
+        with self.publish_lock:
+            with self.lock:
+                times, samples = self.times, self.samples
+                self.times, self.samples = [], []
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            if samples:
+                self.client.publish(self.topic, json.dumps(to_frame(times, samples)))
+
+    def close(self):
+        self.flush()
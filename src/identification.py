@@ -1,17 +1,25 @@
 from pysat.solvers import Solver
+from pysat.examples.rc2 import RC2
+from pysat.formula import WCNF
+from collections import OrderedDict
 from itertools import combinations
-import paho.mqtt.client as mqtt
 import json
+import math
 import threading
+import time
 import config
+import dtdl2graph
+import transport
 
 DEBUG = False
 PRINT_ALL_CLAUSES = False
-MONITORED_DEVICES = {'TA+1', 'TB+1', 'TC+1', 'TD+1'}
+DIAGNOSIS_MODES = ['minimal', 'top_k']
 FAILING_MONITORS = {'TA', 'TC'} 
 
 # Initialisierung des Caches
 diagnosis_cache = {}
+# persistent Diagnoser (solver session) per system graph, least recently used first (config.Diagnosis.SESSION_CACHE_SIZE)
+diagnoser_sessions = OrderedDict()
 
 def get_graph(dtdl_file_path):
     with open(dtdl_file_path, 'r') as file:
@@ -28,10 +36,9 @@ def get_graph(dtdl_file_path):
         except Exception as e:
             print(f"Error processing reply: {e}")
 
-    client = mqtt.Client()
+    client = transport.create_client()
     client.on_message = on_message
-    client.username_pw_set(config.Mqtt.MQTT_SERVER_USER, config.Mqtt.MQTT_SERVER_PASS)
-    client.connect(config.Mqtt.MQTT_SERVER_URL, config.Mqtt.MQTT_SERVER_PORT, 60)
+    transport.connect(client)
     client.subscribe("dtdl2graph/reply")
     client.loop_start()
     client.publish("dtdl2graph/request", dtdl_data)
@@ -52,6 +59,13 @@ def get_name(var, var_map):
             return name
     return None
 
+def fault_weight(priors, name, default_prior):
+    """Soft clause weight of -AB(name): 1 without priors, otherwise the negative log-odds of the fault probability."""
+    if not priors:
+        return 1
+    probability = min(max(priors.get(name, default_prior), 1e-9), 0.5 - 1e-9)  # keep the weight positive
+    return -math.log(probability / (1 - probability))
+
 class Component:
     def __init__(self, name):
         self.name = name
@@ -87,23 +101,118 @@ class Monitor:
         return result == expected
 
 class Diagnoser:
-    def __init__(self, components):
+    STRATEGIES = ['brute_force', 'hs_tree']
+
+    def __init__(self, components, strategy='hs_tree', var_map=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Invalid strategy. Available strategies are: {self.STRATEGIES}")
         self.components = components
-        self.var_map = {}
+        self.strategy = strategy
+        # a precompiled system description brings its own variable numbering
+        self.var_map = dict(var_map) if var_map else {}
         self.system_description = []
         self.observations = []
+        # persistent solver session, the clauses are loaded once and every candidate is a solve(assumptions=...)
+        self._solver = None
+        self._observation_epoch = 0
+        self._observation_selector = get_var(f'observations({self._observation_epoch})', self.var_map)
 
     def add_system_description(self, description):
         for clause in description:
             translated_clause = [get_var(lit, self.var_map) if isinstance(lit, str) else lit for lit in clause]
             self.system_description.append(translated_clause)
+            if self._solver is not None:
+                self._solver.add_clause(translated_clause)
 
     def add_observation(self, observation):
         for clause in observation:
             translated_clause = [get_var(lit, self.var_map) if isinstance(lit, str) else lit for lit in clause]
             self.observations.append(translated_clause)
+            if self._solver is not None:
+                self._solver.add_clause(translated_clause + [-self._observation_selector])
+
+    def clear_observations(self):
+        """Retracts all observations without reloading the system description into the solver.
+
+        Every retraction leaves a dead selector and its clauses in the solver; after
+        config.Diagnosis.SOLVER_REBUILD_AFTER of them the solver is dropped and reloaded on next use.
+        """
+        if self._solver is None:
+            # no solver holds the observations, the selector can be used again
+            pass
+        elif self._observation_epoch + 1 >= config.Diagnosis.SOLVER_REBUILD_AFTER:
+            # the fresh solver knows none of the old selectors, their numbering starts over
+            self.close()
+            self._observation_epoch = 0
+        else:
+            # the old selector is switched off for good, its clauses are satisfied from now on
+            self._solver.add_clause([-self._observation_selector])
+            self._observation_epoch += 1
+        self._observation_selector = get_var(f'observations({self._observation_epoch})', self.var_map)
+        self.observations = []
+
+    def set_observation(self, observation):
+        """Replaces the current observations, only the new clauses are added to the solver."""
+        self.clear_observations()
+        self.add_observation(observation)
+
+    def close(self):
+        if self._solver is not None:
+            self._solver.delete()
+            self._solver = None
+
+    def _session(self):
+        """Returns the persistent solver, loading the clauses on first use."""
+        if self._solver is None:
+            self._solver = Solver(bootstrap_with=self.system_description)
+            # observations are guarded by a selector literal so they can be retracted later on
+            for clause in self.observations:
+                self._solver.add_clause(clause + [-self._observation_selector])
+        return self._solver
 
     def diagnose(self):
+        if self.strategy == 'hs_tree':
+            return self._diagnose_hs_tree()
+        return self._diagnose_brute_force()
+
+    def diagnose_top_k(self, k=None, priors=None, time_budget=None, default_prior=0.01):
+        """Enumerates the most plausible diagnoses in order of cost with RC2 MaxSAT.
+
+        Every component contributes a soft clause -AB(component). Without priors all weights are 1,
+        so the diagnoses are ranked by cardinality. With priors (component name -> fault probability)
+        the weight is the negative log-odds of the fault (default_prior for components without one),
+        so the cost of a diagnosis is its negative log-likelihood up to a constant. Stops after k diagnoses or when time_budget (seconds) is used up.
+        Returns a list of (diagnosis, cost) tuples.
+        """
+        start = time.monotonic()
+        weights = {f'AB({comp.name})': fault_weight(priors, comp.name, default_prior) for comp in self.components}
+
+        wcnf = WCNF()
+        for clause in self.system_description + self.observations:
+            wcnf.append(clause)
+        for name, weight in weights.items():
+            wcnf.append([-get_var(name, self.var_map)], weight=weight)
+
+        ranked = []
+        rc2 = RC2(wcnf)
+        while k is None or len(ranked) < k:
+            if time_budget is not None and time.monotonic() - start > time_budget:
+                break
+            model = rc2.compute()
+            if model is None:
+                break
+            model = set(model)
+            diagnosis = {name for name in weights if get_var(name, self.var_map) in model}
+            ranked.append((diagnosis, sum(weights[name] for name in diagnosis)))
+            if not diagnosis:
+                # the observations are consistent, no other diagnosis is minimal
+                break
+            # block this diagnosis and all of its supersets
+            rc2.add_clause([-get_var(name, self.var_map) for name in diagnosis])
+        rc2.delete()
+        return ranked
+
+    def _diagnose_brute_force(self):
         diagnoses = []
         all_components = [f'AB({comp.name})' for comp in self.components]
 
@@ -118,21 +227,68 @@ class Diagnoser:
         minimal_diagnoses = self._get_minimal_diagnoses(diagnoses)
         return minimal_diagnoses
 
-    def _is_consistent(self, faulty_components):
-        solver = Solver()
-        for clause in self.system_description:
-            solver.add_clause(clause)
+    def _diagnose_hs_tree(self):
+        """Computes the minimal diagnoses with Reiter's HS-DAG over conflicts taken from UNSAT cores."""
+        solver = self._session()
+        # the assumption -AB(c) says "c is healthy"; a core over these literals is a conflict set
+        healthy = {-get_var(f'AB({comp.name})', self.var_map): f'AB({comp.name})' for comp in self.components}
 
-        for clause in self.observations:
-            solver.add_clause(clause)
+        conflicts = []
+        diagnoses = []
+        visited = set()
+        level = [frozenset()]
+        # breadth first, so every diagnosis found on a level is minimal w.r.t. the levels above
+        while level:
+            next_level = []
+            for path in level:
+                # closing rule: a superset of a known diagnosis can not be minimal
+                if any(diagnosis <= path for diagnosis in diagnoses):
+                    continue
+                # reuse rule: a known conflict which is not hit by the path is a valid label
+                conflict = next((c for c in conflicts if not c & path), None)
+                if conflict is None:
+                    conflict = self._find_conflict(solver, healthy, path)
+                    if conflict is None:
+                        diagnoses.append(path)
+                        continue
+                    conflicts.append(conflict)
+                for component in sorted(conflict):
+                    child = path | {component}
+                    if child not in visited:
+                        visited.add(child)
+                        next_level.append(child)
+            level = next_level
+
+        if DEBUG:
+            print(f"HS-DAG: {len(conflicts)} conflicts, {len(visited) + 1} nodes")
+        return [set(diagnosis) for diagnosis in diagnoses]
+
+    def _find_conflict(self, solver, healthy, path):
+        """Returns a minimal conflict set disjoint from path, or None if path is a diagnosis."""
+        selector = [self._observation_selector]
+        assumptions = [lit for lit, name in healthy.items() if name not in path]
+        if solver.solve(assumptions=selector + assumptions):
+            return None
+        core = [lit for lit in solver.get_core() if lit in healthy]
+        # shrink the core to a minimal conflict (deletion based), required for the pruning rules
+        i = 0
+        while i < len(core):
+            candidate = core[:i] + core[i + 1:]
+            if not solver.solve(assumptions=selector + candidate):
+                core = [lit for lit in solver.get_core() if lit in candidate]
+            else:
+                i += 1
+        return frozenset(healthy[lit] for lit in core)
 
+    def _is_consistent(self, faulty_components):
+        assumptions = [self._observation_selector]
         for comp in self.components:
             if f'AB({comp.name})' in faulty_components:
-                solver.add_clause([get_var(f'AB({comp.name})', self.var_map)])
+                assumptions.append(get_var(f'AB({comp.name})', self.var_map))
             else:
-                solver.add_clause([-get_var(f'AB({comp.name})', self.var_map)])
+                assumptions.append(-get_var(f'AB({comp.name})', self.var_map))
 
-        result = solver.solve()
+        result = self._session().solve(assumptions=assumptions)
         
         if DEBUG and PRINT_ALL_CLAUSES:
             if result:
@@ -140,7 +296,6 @@ class Diagnoser:
             else:
                 print(f"Combination {faulty_components} is not consistent.")
 
-        solver.delete()
         return result
 
     def _get_minimal_diagnoses(self, diagnoses):
@@ -173,71 +328,144 @@ class Diagnoser:
         for clause in self.observations:
             print([get_name(var, self.var_map) if var > 0 else f"-{get_name(-var, self.var_map)}" for var in clause])
 
-def indentificator(failing_monitors):
-    # Definition der Komponenten
-    components = [
-        TemperatureSensor('TA'), TemperatureSensor('TB'), TemperatureSensor('TC'), TemperatureSensor('TD'),
-        TemperatureSensor('TA+1'), TemperatureSensor('TB+1'), TemperatureSensor('TC+1'), TemperatureSensor('TD+1'), # temperature one minute later
-        Heater('H1'), Heater('H2'), Heater('H3'),
-        HeaterController('C1'), HeaterController('C2'), HeaterController('C3')
-    ]
-    
-    # Definition der Verbindungen
-    connections = {
-        'TA+1': ['H1'], # the temperature measure after some time is influenced by the existance of faults (too low temperatures and not rising) in Zone 1 now
-        'TB+1': ['H1', 'H2'],
-        'TC+1': ['H2', 'H3'],
-        'TD+1': ['H3'],
-        'C1': ['TA', 'TB'], 
-        'C2': ['TB', 'TC'],
-        'C3': ['TC', 'TD'],
-        'H1': ['C1'],
-        'H2': ['C2'],
-        'H3': ['C3']
-    }
-    dtdl_file_path = 'heating_twin.dtdl'
-    connections = get_graph(dtdl_file_path)
-    
-    # todo: sliding window for components; move to next layer (?) 
+def indentificator(failing_monitors, mode=None):
+    """Diagnoses the failing monitors.
+
+    mode 'minimal' returns all minimal diagnoses as lists of AB(...) names, mode 'top_k' returns
+    the config.Diagnosis.TOP_K most plausible ones as ranked {'diagnosis': [...], 'cost': ...} entries.
+    """
+    mode = mode or config.Diagnosis.MODE
+    if mode not in DIAGNOSIS_MODES:
+        raise ValueError(f"Invalid mode. Available modes are: {DIAGNOSIS_MODES}")
+    digest, system_model = compile_system_model(config.Model.DTDL_FILE)
+    connections = system_model['connections']
+
+    # append "+1" on every element in  failing_monitors to get the corresponding temperature sensor
+    failing_monitors = [f'{monitor}+1' for monitor in failing_monitors]
+    monitors = []
+    for device in monitored_devices(config.Model.DTDL_FILE):
+        monitors.append(Monitor(device, lambda: True))
+    failing = sorted(monitor.component for monitor in monitors if monitor.component in failing_monitors)
+
+    # only the fan-in cone of the failing monitors can explain them; independent parts are diagnosed separately
+    cone = cone_of_influence(connections, failing)
+    components_by_name = {comp.name: comp for comp in typed_components(config.Model.DTDL_FILE, sorted(cone))}
+    part_results = []
+    for part in split_independent(connections, cone):
+        part_components = [components_by_name[node] for node in sorted(part)]
+        part_failing = [monitor for monitor in failing if monitor in part]
+        part_results.append(diagnose_part(digest, system_model, part_components, part_failing, mode))
+
+    ranked = combine_part_diagnoses(part_results, config.Diagnosis.TOP_K if mode == 'top_k' else None)
+    if mode == 'top_k':
+        if DEBUG:
+            print(f"Ranked Diagnoses: {ranked}")
+        return [{'diagnosis': sorted(diag), 'cost': cost} for diag, cost in ranked]
+
+    diagnoses = [diag for diag, cost in ranked]
+    if DEBUG:
+        print(f"Minimal Diagnoses: {diagnoses}")
+    return [list(diag) for diag in diagnoses]
+
+# the kind of a device follows from the topics it publishes on
+COMPONENT_TYPES = {'sensor/+': TemperatureSensor, 'heater/#': Heater, 'controller/#': HeaterController}
+
+def typed_components(dtdl_file_path, nodes):
+    """Components for the nodes of the twin's graph, typed by the topics the devices publish on.
+
+    'TA+1' is the sensor TA one step later; devices on other topics become plain Components.
+    """
+    types = {}
+    for topic_filter, component_type in COMPONENT_TYPES.items():
+        for name in dtdl2graph.load_publishers(dtdl_file_path, topic_filter):
+            types.setdefault(name, component_type)
+    return [types.get(node[:-len('+1')] if node.endswith('+1') else node, Component)(node) for node in nodes]
+
+def monitored_devices(dtdl_file_path):
+    """The sensors of the twin one step later, e.g. 'TA+1' for the sensor TA."""
+    return [f'{sensor}+1' for sensor in dtdl2graph.load_publishers(dtdl_file_path, 'sensor/+')]
+
+def cone_of_influence(connections, roots):
+    """Walks the connection graph backwards from roots and returns every node in their fan-in cone."""
+    cone = set()
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        if node not in cone:
+            cone.add(node)
+            stack.extend(connections.get(node, []))
+    return cone
+
+def split_independent(connections, nodes):
+    """Splits nodes into the connected components of the (undirected) connection graph restricted to nodes."""
+    neighbours = {node: set() for node in nodes}
+    for parent in nodes:
+        for child in connections.get(parent, []):
+            if child in neighbours:
+                neighbours[parent].add(child)
+                neighbours[child].add(parent)
+    parts = []
+    unvisited = set(nodes)
+    while unvisited:
+        stack = [unvisited.pop()]
+        part = set(stack)
+        while stack:
+            for neighbour in neighbours[stack.pop()]:
+                if neighbour in unvisited:
+                    unvisited.remove(neighbour)
+                    part.add(neighbour)
+                    stack.append(neighbour)
+        parts.append(part)
+    return parts
+
+def compile_system_model(dtdl_file_path):
+    """Returns (digest, model) for a DTDL twin, model holds the connections, the var_map and one clause per parent.
+
+    The graph is compiled in-process and, like the encoded clauses, cached by the content hash of the file.
+    """
+    digest, connections = dtdl2graph.load_graph(dtdl_file_path)
+    return digest, dtdl2graph.cached_artifact(digest, 'system_model', lambda: encode_system_model(connections))
+
+def encode_system_model(connections):
+    # todo: sliding window for components; move to next layer (?)
     updated_connections = {}
     for key, value in connections.items():
         new_key = key + "+1" if key.startswith("T") else key
         updated_connections[new_key] = value
-
     connections = updated_connections
 
-
-    diagnoser = Diagnoser(components)
-    
     # Erzeugung der Systembeschreibung basierend auf dem Graphen
-    system_description = []
+    var_map = {}
+    clauses = {}
     for parent, children in connections.items():
-        clause = [get_var(f'output_ok({parent})', diagnoser.var_map), get_var(f'AB({parent})', diagnoser.var_map)]
+        clause = [get_var(f'output_ok({parent})', var_map), get_var(f'AB({parent})', var_map)]
         for child in children:
             if child in connections:
-                clause.append(-get_var(f'output_ok({child})', diagnoser.var_map))
+                clause.append(-get_var(f'output_ok({child})', var_map))
             else:
-                clause.append(get_var(f'AB({child})', diagnoser.var_map))
-        system_description.append(clause)
+                clause.append(get_var(f'AB({child})', var_map))
+        clauses[parent] = clause
+    return {'connections': connections, 'var_map': var_map, 'clauses': clauses}
+
+def diagnose_part(digest, system_model, components, failing_monitors, mode):
+    """Diagnoses one independent part of the graph, returns a list of (diagnosis, cost) tuples."""
+    # reuse the solver session of this part, only the observations change between alerts
+    session_key = (config.Diagnosis.STRATEGY, digest, tuple(comp.name for comp in components))
+    diagnoser = diagnoser_sessions.get(session_key)
+    if diagnoser is None:
+        diagnoser = Diagnoser(components, strategy=config.Diagnosis.STRATEGY, var_map=system_model['var_map'])
+        diagnoser.add_system_description(
+            [system_model['clauses'][comp.name] for comp in components if comp.name in system_model['clauses']])
+        diagnoser_sessions[session_key] = diagnoser
+        if len(diagnoser_sessions) > config.Diagnosis.SESSION_CACHE_SIZE:
+            diagnoser_sessions.popitem(last=False)[1].close()
+    else:
+        diagnoser_sessions.move_to_end(session_key)
 
-    diagnoser.add_system_description(system_description)
-    
     observations = []
-    # append "+1" on every element in  failing_monitors to get the corresponding temperature sensor 
-    failing_monitors = [f'{monitor}+1' for monitor in failing_monitors]
     for failing_monitor in failing_monitors:
         observations.append([-get_var(f'output_ok({failing_monitor})', diagnoser.var_map)])
-    
-    monitors = []
-    for device in MONITORED_DEVICES:
-        monitors.append(Monitor(device, lambda: True))
-    observations = []
-    for i, monitor in enumerate(monitors):
-        if monitor.component in failing_monitors:
-            observations.append([-get_var(f'output_ok({monitor.component})', diagnoser.var_map)])
-        else:
-            pass #observations.append([get_var(f'output_ok({monitor.component})', diagnoser.var_map)])
-    diagnoser.add_observation(observations)
+    diagnoser.set_observation(observations)
 
     # Debug-Informationen ausgeben
     if DEBUG:
@@ -245,15 +473,27 @@ def indentificator(failing_monitors):
         diagnoser.print_system_description()
         diagnoser.print_observations()
 
-    diagnoses = diagnoser.diagnose()
-    if DEBUG:
-        print(f"Minimal Diagnoses: {diagnoses}")
-    return [list(diag) for diag in diagnoses]
+    if mode == 'top_k':
+        return diagnoser.diagnose_top_k(config.Diagnosis.TOP_K, config.Diagnosis.FAULT_PRIORS,
+                                        config.Diagnosis.TIME_BUDGET, config.Diagnosis.DEFAULT_FAULT_PRIOR)
+    return [(diag, len(diag)) for diag in diagnoser.diagnose()]
+
+def combine_part_diagnoses(part_results, k=None):
+    """Combines the diagnoses of independent parts: every union of one diagnosis per part, ranked by total cost.
 
+    The parts share no components, so the unions of minimal diagnoses are exactly the minimal diagnoses of
+    the whole graph. With k, only the k cheapest combinations are kept after every part.
+    """
+    combined = [(set(), 0)]
+    for results in part_results:
+        combined = [(diag | part_diag, cost + part_cost) for diag, cost in combined for part_diag, part_cost in results]
+        combined.sort(key=lambda entry: entry[1])
+        if k is not None:
+            combined = combined[:k]
+    return combined
 
-# MQTT-Einstellungen
-MQTT_BROKER = "localhost"
-MQTT_PORT = 1883
+
+# MQTT-Einstellungen, der Broker kommt aus config.Mqtt
 TOPIC_INPUT = "monitor/alert"
 TOPIC_OUTPUT = "diagnosis/output"
 
@@ -270,20 +510,21 @@ def on_message(client, userdata, msg):
                 failing_monitors = data.get("problematic_sensors", [])
                 if failing_monitors:
                     # Sortiere die Liste für konsistente Hashwerte
-                    failing_monitors_sorted = tuple(sorted(failing_monitors))
+                    mode = config.Diagnosis.MODE
+                    failing_monitors_sorted = (mode,) + tuple(sorted(failing_monitors))
                     # Überprüfen, ob das Ergebnis bereits im Cache vorhanden ist
                     if failing_monitors_sorted in diagnosis_cache:
                         diagnosis_results = diagnosis_cache[failing_monitors_sorted]
                     else:
                         # Diagnose durchführen und Ergebnis im Cache speichern
-                        diagnosis_results = indentificator(failing_monitors)
+                        diagnosis_results = indentificator(failing_monitors, mode)
                         diagnosis_cache[failing_monitors_sorted] = diagnosis_results
                         # print problematic sensors and diagnosis results
                         print("")
                         print(f"Monitoring results: {failing_monitors}")
                         print(f"Diagnosis results: {diagnosis_results}")
 
-                    send_diagnosis_results(client, diagnosis_results)
+                    send_diagnosis_results(client, diagnosis_results, mode)
                 else:
                     # print("No problematic sensor streams reported.")
                     pass
@@ -296,25 +537,33 @@ def on_message(client, userdata, msg):
 diagnosis_cache = {}
 
 
-def send_diagnosis_results(client, diagnosis_results):
-    # Umwandeln der Set-Objekte (Diagnoseergebnisse) in Listen
-    diagnosis_results_list = [list(result) if isinstance(result, set) else result for result in diagnosis_results]
-    message = {
-        "diagnosis_results": diagnosis_results_list
-    }
+def send_diagnosis_results(client, diagnosis_results, mode='minimal'):
+    message = {"mode": mode}
+    if mode == 'top_k':
+        # ranked results, the costs are listed in the same order
+        message["diagnosis_results"] = [result['diagnosis'] for result in diagnosis_results]
+        message["costs"] = [result['cost'] for result in diagnosis_results]
+    else:
+        # Umwandeln der Set-Objekte (Diagnoseergebnisse) in Listen
+        message["diagnosis_results"] = [list(result) if isinstance(result, set) else result for result in diagnosis_results]
     client.publish(TOPIC_OUTPUT, json.dumps(message))
 
 
-# MQTT Client setup
-client = mqtt.Client()
-client.on_connect = on_connect
-client.on_message = on_message
+def start():
+    """Creates and connects the diagnosis client, the caller runs its network loop."""
+    client = transport.create_client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    # Verbindung zum MQTT Broker
+    return transport.connect(client)
 
 # for testing this script
 # diagnosis_results = indentificator(FAILING_MONITORS)
 
-# Verbindung zum MQTT Broker
-client.connect(MQTT_BROKER, MQTT_PORT, 60)
+def main():
+    client = start()
+    # Schleife starten
+    client.loop_forever()
 
-# Schleife starten
-client.loop_forever()
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,155 @@
-import paho.mqtt.client as mqtt
 import json
+import numpy as np
 import config
+import dtdl2graph
+import frames
+import transport
+import wire
+from ring_buffer import RingBuffer
 
 # MQTT settings
 TOPIC_HEATER_STATUS = "controller/heater_status"
-
-# Global variables to store the latest messages
-temperature_history = {
-    'TA': [],
-    'TB': [],
-    'TC': [],
-    'TD': []
-}
+# the same steps in frames of config.Batching.BATCH_SIZE, used instead if that is above 1
+TOPIC_HEATER_STATUS_FRAMES = "controller/heater_status_frames"
+# reads JSON and binary messages (config.Wire.FORMAT of the sender)
+decoder = wire.Decoder()
 
 alert_threshold = 42
+alert_temperature = 19.5
+
+# the monitored sensors are the components of the twin (config.Model.DTDL_FILE) publishing on these topics
+SENSOR_TOPIC_FILTER = "sensor/+"
+
+
+class SensorWindowDetector:
+    """Sliding-window fault detector for many sensors, updated incrementally with one vectorized pass per message.
+
+    The last `window` readings of all sensors are the rows of a 2-D ring buffer (one column per sensor)
+    and the number of readings below `threshold` in the window is kept as a running count: each
+    message adds the new readings and subtracts the row leaving the window. A sensor is reported once
+    all readings in the window are below the threshold and the temperature rose by less than a factor
+    growth**window over it. Sensors missing from a message get NaN, which never counts as below.
+    """
+
+    def __init__(self, sensors, window=alert_threshold, threshold=alert_temperature, growth=1.001):
+        self.sensors = list(sensors)
+        self.index = {sensor: i for i, sensor in enumerate(self.sensors)}
+        self.window = window
+        self.threshold = threshold
+        self.rise_limit = growth ** window
+        self.history = RingBuffer(window, width=len(self.sensors))
+        self.below_count = np.zeros(len(self.sensors), dtype=np.int64)
+
+    def readings(self, temperatures):
+        """The message as a vector in sensor order, NaN for sensors without a reading."""
+        return np.fromiter((temperatures.get(sensor, np.nan) for sensor in self.sensors),
+                           dtype=float, count=len(self.sensors))
+
+    def update(self, temperatures):
+        """Adds the readings of one message and returns the problematic sensors."""
+        values = self.readings(temperatures)
+        if len(self.history) == self.window:
+            # the oldest row is overwritten by the append
+            self.below_count -= self.history.oldest() < self.threshold
+        self.history.append(values)
+        self.below_count += values < self.threshold
+        if len(self.history) < self.window:
+            return []
+        rising_slowly = self.history.latest() < self.rise_limit * self.history.oldest()
+        problematic = np.flatnonzero((self.below_count == self.window) & rising_slowly)
+        return [self.sensors[i] for i in problematic]
+
+    def update_batch(self, values):
+        """Adds the readings of many time steps, a (steps, sensors) array in sensor order.
+
+        Returns the problematic sensors of every step, the same as update() step by step. The window
+        counts of all steps come from one cumulative sum over the batch and the rows before it.
+        """
+        values = np.asarray(values, dtype=float).reshape(-1, len(self.sensors))
+        steps = len(values)
+        if steps == 0:
+            return []
+        rows = np.concatenate([self.history.window(self.window - 1), values])
+        previous = len(rows) - steps
+        below = np.zeros((len(rows) + 1, len(self.sensors)), dtype=np.int64)
+        np.cumsum(rows < self.threshold, axis=0, out=below[1:])
+        end = np.arange(previous, len(rows))
+        start = end - self.window + 1
+        # windows reaching before the first reading are not complete
+        complete = start >= 0
+        start = np.maximum(start, 0)
+        counts = below[end + 1] - below[start]
+        rising_slowly = rows[end] < self.rise_limit * rows[start]
+        problematic = complete[:, None] & (counts == self.window) & rising_slowly
+
+        self.history.extend(values)
+        self.below_count = below[-1] - below[max(len(rows) - self.window, 0)]
+        return [[self.sensors[i] for i in np.flatnonzero(row)] for row in problematic]
+
+    def clear(self):
+        self.history.clear()
+        self.below_count[:] = 0
+
+
+detector = None
+
+
+def get_detector():
+    """The detector for the sensors of the twin, created on first use."""
+    global detector
+    if detector is None:
+        detector = SensorWindowDetector(dtdl2graph.load_publishers(config.Model.DTDL_FILE, SENSOR_TOPIC_FILTER))
+    return detector
 
 # MQTT Callbacks
 def on_connect(client, userdata, flags, rc):
     print("Connected with result code " + str(rc))
-    client.subscribe(TOPIC_HEATER_STATUS)
+    client.subscribe(TOPIC_HEATER_STATUS_FRAMES if config.Batching.BATCH_SIZE > 1 else TOPIC_HEATER_STATUS)
 
 def on_message(client, userdata, msg):
     if msg.topic == TOPIC_HEATER_STATUS:
-        message = json.loads(msg.payload.decode())
+        message = decoder.loads(msg.topic, msg.payload)
         temperatures = message.get('current_temperatures', {})
     
         # Process the alert condition
         if temperatures:
             process_alert(client, temperatures)
+    elif msg.topic == TOPIC_HEATER_STATUS_FRAMES:
+        process_alert_frame(client, json.loads(msg.payload.decode()))
 
 def process_alert(client, temperatures):
-    global temperature_history
-
-    problematic_sensors = []
-
-    # Update temperature history
-    for zone, temp in temperatures.items():
-        if zone in temperature_history:
-            temperature_history[zone].append(temp)
-        
-            # Maintain a fixed history length
-            if len(temperature_history[zone]) > alert_threshold:
-                temperature_history[zone].pop(0)
-
-            # Check if the last `alert_threshold` values all indicate a problem
-            if len(temperature_history[zone]) >= alert_threshold:
-                rising_slowly = temperature_history[zone][-1] < (1.001**alert_threshold)*temperature_history[zone][-alert_threshold]
-                if all(t < 19.5 for t in temperature_history[zone][-alert_threshold:]) and rising_slowly:
-                    problematic_sensors.append(zone)
+    problematic_sensors = get_detector().update(temperatures)
 
     print("problematic sensor values:", problematic_sensors)
     
     if problematic_sensors:
         publish_alert(client, problematic_sensors)
 
+def process_alert_frame(client, frame):
+    """Checks all steps of a frame in one call, one alert per step with problematic sensors as without frames."""
+    sensor_detector = get_detector()
+    problematic_steps = sensor_detector.update_batch(frames.columns(frame, 'current_temperatures', sensor_detector.sensors))
+
+    print("problematic sensor values:", problematic_steps[-1] if problematic_steps else [])
+
+    for problematic_sensors in problematic_steps:
+        if problematic_sensors:
+            publish_alert(client, problematic_sensors)
+
 def publish_alert(client, problematic_sensors):
     alert_message = {"alert": True, "problematic_sensors": problematic_sensors}
     client.publish("monitor/alert", json.dumps(alert_message))
 
-# Main function
-def main():
-    client = mqtt.Client()
+def start():
+    """Creates and connects the monitor's client, the caller runs its network loop."""
+    client = transport.create_client()
     client.on_connect = on_connect
     client.on_message = on_message
-    client.username_pw_set(config.Mqtt.MQTT_SERVER_USER, config.Mqtt.MQTT_SERVER_PASS)
+    return transport.connect(client)
 
-    client.connect(config.Mqtt.MQTT_SERVER_URL, config.Mqtt.MQTT_SERVER_PORT, 60)
+# Main function
+def main():
+    client = start()
     
     try:
         client.loop_forever()
@@ -0,0 +1,94 @@
+import json
+import threading
+import uuid
+from concurrent.futures import Future, TimeoutError
+import config
+import transport
+import wire
+
+
+class RemoteError(Exception):
+    """The responder could not handle the request, its reply carried an 'error' instead of a result."""
+
+
+class RpcClient:
+    """Request/reply over one long-lived MQTT connection, replies are matched by the 'correlation_id' they echo."""
+    def __init__(self, timeout=None, client=None):
+        """Connects once and keeps the network loop running until close()."""
+        self.timeout = config.Controller.REQUEST_TIMEOUT if timeout is None else timeout
+        self.pending = {}  # correlation id -> Future
+        self.reply_topics = set()
+        self.lock = threading.Lock()
+        self.encoder = wire.Encoder()
+        self.decoder = wire.Decoder()
+        self.client = client if client is not None else transport.create_client()
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        transport.connect(self.client)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        """Renews the reply subscriptions after a reconnect."""
+        with self.lock:
+            topics = list(self.reply_topics)
+        for topic in topics:
+            client.subscribe(topic)
+
+    def on_message(self, client, userdata, msg):
+        """Resolves the pending request the reply belongs to, replies without a known id are ignored."""
+        try:
+            reply = self.decoder.loads(msg.topic, msg.payload)
+        except Exception as e:
+            print(f"Error processing reply: {e}")
+            return
+        if not isinstance(reply, dict):
+            return
+        with self.lock:
+            future = self.pending.pop(reply.get('correlation_id'), None)
+        if future is not None and not future.done():
+            if 'error' in reply:
+                future.set_exception(RemoteError(reply['error']))
+            else:
+                future.set_result(reply)
+
+    def submit(self, topic, reply_topic, message):
+        """Publishes a request and returns a Future for its reply."""
+        correlation_id = uuid.uuid4().hex
+        future = Future()
+        with self.lock:
+            self.pending[correlation_id] = future
+            subscribe = reply_topic not in self.reply_topics
+            self.reply_topics.add(reply_topic)
+        if subscribe:
+            # subscribe and publish are sent in order on the same connection
+            self.client.subscribe(reply_topic)
+        self.client.publish(topic, self.encoder.dumps(topic, dict(message, correlation_id=correlation_id)))
+        future.correlation_id = correlation_id
+        return future
+
+    def cancel(self, future):
+        """Forgets a pending request, a late reply is then ignored."""
+        with self.lock:
+            self.pending.pop(getattr(future, 'correlation_id', None), None)
+        future.cancel()
+
+    def request(self, topic, reply_topic, message, timeout=None):
+        """Publishes a request and waits for its reply.
+
+        Raises TimeoutError if none arrives in time and RemoteError if the responder replied with an error.
+        """
+        future = self.submit(topic, reply_topic, message)
+        try:
+            return future.result(timeout=self.timeout if timeout is None else timeout)
+        except TimeoutError:
+            self.cancel(future)
+            raise
+
+    def close(self):
+        """Cancels the pending requests and disconnects."""
+        with self.lock:
+            pending, self.pending = list(self.pending.values()), {}
+        for future in pending:
+            future.cancel()
+        self.client.loop_stop()
+        self.client.disconnect()
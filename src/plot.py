@@ -1,45 +1,53 @@
-import paho.mqtt.client as mqtt
-import json
 import matplotlib.pyplot as plt
 import numpy as np
 import config
+import frames
+import transport
+import wire
+from ring_buffer import RingBuffer
 
 # MQTT settings
-BROKER = config.Mqtt.MQTT_SERVER_URL
-PORT = config.Mqtt.MQTT_SERVER_PORT
 TOPIC_TEMPERATURES = "controller/heater_status"
 TOPIC_ALERT = "monitor/alert"
 TOPIC_SIMULATION_ERROR = "controller/heater_status"
-
-# Data storage
-temperature_history = {
-    'Temperature Sensor A': [],
-    'Temperature Sensor B': [],
-    'Temperature Sensor C': [],
-    'Temperature Sensor D': [],
-    'Zone 1': [],
-    'Zone 2': [],
-    'Zone 3': [],
-    'RMSE': [],
-    'Simulated Temperature Sensor A': [],
-    'Simulated Temperature Sensor B': [],
-    'Simulated Temperature Sensor C': [],
-    'Simulated Temperature Sensor D': [],
-    'Environment': []
-}
-time_history = []
-alerts = []
+# the steps in frames, subscribed instead if config.Batching.BATCH_SIZE is above 1
+TOPIC_TEMPERATURE_FRAMES = "controller/heater_status_frames"
+# reads JSON and binary messages (config.Wire.FORMAT of the sender)
+decoder = wire.Decoder()
+
+# Data storage, the last config.History.LENGTH samples of every series
+temperature_history = {name: RingBuffer(config.History.LENGTH) for name in [
+    'Temperature Sensor A',
+    'Temperature Sensor B',
+    'Temperature Sensor C',
+    'Temperature Sensor D',
+    'Zone 1',
+    'Zone 2',
+    'Zone 3',
+    'RMSE',
+    'Simulated Temperature Sensor A',
+    'Simulated Temperature Sensor B',
+    'Simulated Temperature Sensor C',
+    'Simulated Temperature Sensor D',
+    'Environment'
+]}
+time_history = RingBuffer(config.History.LENGTH)
+steps = 0  # received time steps, time_history only keeps the recent ones
+alerts = RingBuffer(config.History.LENGTH, dtype=object)
 delta_t = 10
 
 # MQTT Callbacks
 def on_connect(client, userdata, flags, rc):
     print("Connected with result code " + str(rc))
-    client.subscribe([(TOPIC_TEMPERATURES, 0), (TOPIC_ALERT, 0), (TOPIC_SIMULATION_ERROR, 0)])
+    if config.Batching.BATCH_SIZE > 1:
+        client.subscribe([(TOPIC_TEMPERATURE_FRAMES, 0), (TOPIC_ALERT, 0)])
+    else:
+        client.subscribe([(TOPIC_TEMPERATURES, 0), (TOPIC_ALERT, 0), (TOPIC_SIMULATION_ERROR, 0)])
 def on_message(client, userdata, msg):
-    global temperature_history, environment_temperature, time_history, alerts
+    global temperature_history, environment_temperature, time_history, alerts, steps
 
     # Nachricht dekodieren
-    message = json.loads(msg.payload.decode())
+    message = decoder.loads(msg.topic, msg.payload)
     
     # Überprüfung des Nachrichtenthemas
     if msg.topic == TOPIC_TEMPERATURES:
@@ -60,7 +68,8 @@ def on_message(client, userdata, msg):
 
         # Zeitschrittgröße aktualisieren
         delta_t = message.get('delta_t')
-        time_history.append(len(time_history) * delta_t)
+        time_history.append(steps * delta_t)
+        steps += 1
 
         # RMSE-Wert drucken und speichern
         print(message.get('RMSE', np.nan))
@@ -72,11 +81,27 @@ def on_message(client, userdata, msg):
         temperature_history['Simulated Temperature Sensor C'].append(message.get('Simulated Temperature Sensor C', np.nan))
         temperature_history['Simulated Temperature Sensor D'].append(message.get('Simulated Temperature Sensor D', np.nan))
 
+    elif msg.topic == TOPIC_TEMPERATURE_FRAMES:
+        process_frame(message)
+
     elif msg.topic == TOPIC_ALERT:
-        alert_time = len(time_history) * DELTA_T
+        alert_time = steps * DELTA_T
         problematic_zones = message.get("problematic_sensors", [])
         alerts.append((alert_time, problematic_zones))
 
+def process_frame(frame):
+    """Appends all steps of a frame at once, the same series as the single messages."""
+    global steps
+    temperature_history['Environment'].extend(frames.column(frame, 'environment'))
+    for sensor in 'ABCD':
+        temperature_history[f'Temperature Sensor {sensor}'].extend(frames.column(frame, 'current_temperatures', f'T{sensor}'))
+        temperature_history[f'Simulated Temperature Sensor {sensor}'].extend(frames.column(frame, f'Simulated Temperature Sensor {sensor}'))
+    for zone in '123':
+        temperature_history[f'Zone {zone}'].extend(frames.column(frame, 'current_temperatures', f'Z{zone}'))
+    temperature_history['RMSE'].extend(frames.column(frame, 'RMSE'))
+    time_history.extend(frames.column(frame, 'time'))
+    steps += len(frame['time'])
+
 def plot_data():
     global temperature_history, time_history, alerts
 
@@ -138,12 +163,10 @@ def main():
     global DELTA_T
     DELTA_T = 10  # Set delta_t to match your simulation
 
-    client = mqtt.Client()
+    client = transport.create_client()
     client.on_connect = on_connect
     client.on_message = on_message
-    client.username_pw_set(config.Mqtt.MQTT_SERVER_USER, config.Mqtt.MQTT_SERVER_PASS)
-
-    client.connect(BROKER, PORT, 60)
+    transport.connect(client)
 
     try:
         client.loop_start()
@@ -1,31 +1,39 @@
-import paho.mqtt.client as mqtt
-import json
 import matplotlib.pyplot as plt
 import numpy as np
 import config
+import frames
+import transport
+import wire
+from ring_buffer import RingBuffer
 
 # MQTT settings
 TOPIC_HEATING = "controller/heater_status"
 TOPIC_ALERT = "monitor/alert"
+# the steps in frames, subscribed instead if config.Batching.BATCH_SIZE is above 1
+TOPIC_HEATING_FRAMES = "controller/heater_status_frames"
+# reads JSON and binary messages (config.Wire.FORMAT of the sender)
+decoder = wire.Decoder()
 
 # Data storage: Ändern Sie die Schlüssel entsprechend den tatsächlichen Bezeichnern aus der MQTT-Nachricht
 heating_status = {
-    'Z1': [],
-    'Z2': [],
-    'Z3': []
+    'Z1': RingBuffer(config.History.LENGTH),
+    'Z2': RingBuffer(config.History.LENGTH),
+    'Z3': RingBuffer(config.History.LENGTH)
 }
-alerts = {sensor: [] for sensor in ['TA', 'TB', 'TC', 'TD']}
-time_history = []
+# (alert time, count) rows per sensor
+alerts = {sensor: RingBuffer(config.History.LENGTH, width=2) for sensor in ['TA', 'TB', 'TC', 'TD']}
+time_history = RingBuffer(config.History.LENGTH)
+steps = 0  # received time steps, time_history only keeps the recent ones
 
 # MQTT Callbacks
 def on_connect(client, userdata, flags, rc):
     print("Connected with result code " + str(rc))
-    client.subscribe([(TOPIC_HEATING, 0), (TOPIC_ALERT, 0)])
+    client.subscribe([(TOPIC_HEATING_FRAMES if config.Batching.BATCH_SIZE > 1 else TOPIC_HEATING, 0), (TOPIC_ALERT, 0)])
 
 def on_message(client, userdata, msg):
-    global heating_status, alerts, time_history
+    global heating_status, alerts, time_history, steps
 
-    message = json.loads(msg.payload.decode())
+    message = decoder.loads(msg.topic, msg.payload)
     if msg.topic == TOPIC_HEATING:
         heater_status = message.get('heater_status', {})
         for zone in ['Z1', 'Z2', 'Z3']:
@@ -33,19 +41,28 @@ def on_message(client, userdata, msg):
                 heating_status[zone].append(heater_status[zone])
             else:
                 print(f"Warnung: Kein Heizungsstatus für {zone} verfügbar.")
+    elif msg.topic == TOPIC_HEATING_FRAMES:
+        # all steps of the frame at once
+        for zone in ['Z1', 'Z2', 'Z3']:
+            heating_status[zone].extend(frames.column(message, 'heater_status', zone))
+        frame_steps = len(message['time'])
+        time_history.extend((steps + np.arange(frame_steps)) * frames.column(message, 'delta_t'))
+        steps += frame_steps
+        return
     elif msg.topic == TOPIC_ALERT:
-        alert_time = len(time_history) * message.get('delta_t', 10)
+        alert_time = steps * message.get('delta_t', 10)
         for sensor in alerts:
             count = message['problematic_sensors'].count(sensor)
             alerts[sensor].append((alert_time, count))
     
-    time_history.append(len(time_history) * message.get('delta_t', 10))
+    time_history.append(steps * message.get('delta_t', 10))
+    steps += 1
 
 # Plot-Funktion anpassen
 def plot_data():
     global heating_status, alerts, time_history
 
-    if not time_history:
+    if not len(time_history):
         print("Keine Zeitdaten verfügbar.")
         return
 
@@ -58,14 +75,15 @@ def plot_data():
 
     # Plot heating status for each zone if data available
     for idx, zone in enumerate(['Z1', 'Z2', 'Z3']):
-        if heating_status[zone]:
-            ax.plot(time_steps, np.array(heating_status[zone]) + idx * 1.5, label=f"Heating {zone}", marker='o', color=colors_heating[idx])
+        if len(heating_status[zone]):
+            ax.plot(time_steps, heating_status[zone].values() + idx * 1.5, label=f"Heating {zone}", marker='o', color=colors_heating[idx])
         else:
             print(f"Keine Heizungsdaten für {zone} verfügbar.")
 
     # Plot alerts for each sensor if data available
     for idx, sensor in enumerate(['TA', 'TB', 'TC', 'TD']):
-        sensor_alerts = np.array([(alert[0], alert[1]) for alert in alerts[sensor] if alert[1] > 0])
+        sensor_alerts = alerts[sensor].values()
+        sensor_alerts = sensor_alerts[sensor_alerts[:, 1] > 0]
         if sensor_alerts.size > 0:
             ax.scatter(sensor_alerts[:, 0], np.ones(sensor_alerts.shape[0]) * (4.5 + idx * 0.5), label=f"Alert {sensor}", marker='x', color=colors_alerts[idx])
 
@@ -85,12 +103,10 @@ def main():
     global DELTA_T
     DELTA_T = config.Controller.SIM_DELTA_T
 
-    client = mqtt.Client()
+    client = transport.create_client()
     client.on_connect = on_connect
     client.on_message = on_message
-    client.username_pw_set(config.Mqtt.MQTT_SERVER_USER, config.Mqtt.MQTT_SERVER_PASS)
-
-    client.connect(config.Mqtt.MQTT_SERVER_URL, config.Mqtt.MQTT_SERVER_PORT, 60)
+    transport.connect(client)
 
     try:
         client.loop_start()
@@ -0,0 +1,114 @@
+import numpy as np
+
+
+class RingBuffer:
+    """Bounded history on a NumPy array with amortized O(1) append.
+
+    The array is allocated on the first append and grows geometrically up to capacity rows, so a
+    short run stays small; once full, the oldest rows are overwritten in place. window() and values()
+    return views (oldest first) while the rows are contiguous and an unwrapped copy once they wrap
+    around the end of the array. With width the rows are vectors, e.g. one column per sensor.
+    """
+    INITIAL_ROWS = 16
+
+    def __init__(self, capacity, width=None, dtype=float):
+        if capacity < 1:
+            raise ValueError("The capacity of a ring buffer must be at least 1")
+        self.capacity = capacity
+        self.width = width
+        self.dtype = np.dtype(dtype)
+        self.data = None  # allocated on first use
+        self.start = 0  # slot of the oldest row
+        self.size = 0  # stored rows
+        self.count = 0  # rows appended since creation (or clear), also beyond the capacity
+
+    def __len__(self):
+        return self.size
+
+    def _allocate(self, rows):
+        shape = (rows,) if self.width is None else (rows, self.width)
+        return np.empty(shape, dtype=object) if self.dtype == object else np.zeros(shape, dtype=self.dtype)
+
+    def _reserve(self, rows):
+        """Makes room for rows rows (at most capacity), doubling the array; the stored rows move to the front."""
+        allocated = 0 if self.data is None else len(self.data)
+        if rows <= allocated:
+            return
+        data = self._allocate(min(self.capacity, max(rows, 2 * allocated, self.INITIAL_ROWS)))
+        data[:self.size] = self.values()
+        self.data = data
+        self.start = 0
+
+    def append(self, value):
+        if self.size < self.capacity:
+            self._reserve(self.size + 1)
+            self.data[self.size] = value
+            self.size += 1
+        else:
+            self.data[self.start] = value
+            self.start = (self.start + 1) % self.capacity
+        self.count += 1
+
+    def extend(self, values):
+        """Appends many rows at once, only the newest capacity rows are stored."""
+        values = np.asarray(values, dtype=self.dtype)
+        appended = len(values)
+        values = values[-self.capacity:]
+        rows = len(values)
+        if self.size + rows <= self.capacity:
+            self._reserve(self.size + rows)
+            self.data[self.size:self.size + rows] = values
+            self.size += rows
+        else:
+            self._reserve(self.capacity)
+            end = self.start + self.size
+            self.data[(end + np.arange(rows)) % self.capacity] = values
+            self.start = (end + rows) % self.capacity
+            self.size = self.capacity
+        self.count += appended
+
+    def window(self, n):
+        """The newest n rows (fewer if not yet appended), oldest first; a view unless they wrap around."""
+        n = min(n, self.size)
+        if n == 0:
+            return self._allocate(0)
+        end = self.start + self.size
+        begin = end - n
+        allocated = len(self.data)
+        if end <= allocated:
+            return self.data[begin:end]
+        if begin >= allocated:
+            return self.data[begin - allocated:end - allocated]
+        return np.concatenate((self.data[begin:], self.data[:end - allocated]))
+
+    def values(self):
+        """All stored rows, oldest first."""
+        return self.window(self.capacity)
+
+    def latest(self, default=None):
+        """The newest row, or default if the buffer is empty."""
+        if self.size == 0:
+            return default
+        return self.data[(self.start + self.size - 1) % len(self.data)]
+
+    def oldest(self, default=None):
+        """The oldest stored row, or default if the buffer is empty."""
+        if self.size == 0:
+            return default
+        return self.data[self.start]
+
+    def clear(self):
+        """Forgets the rows, the array is kept for reuse."""
+        self.start = 0
+        self.size = 0
+        self.count = 0
+
+    def __getitem__(self, key):
+        return self.values()[key]
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.values()
+        return values if dtype is None else values.astype(dtype)
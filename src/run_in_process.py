@@ -0,0 +1,47 @@
+import argparse
+import time
+import config
+import controller
+import controller_simulation
+import dtdl2graph
+import identification
+import monitor
+import simulation
+import transport
+import twin_generator
+
+# the components run.sh starts next to the controller, without the plots
+SERVICES = [dtdl2graph, identification, monitor, simulation, controller_simulation]
+
+
+def main():
+    """Runs the whole FDIR loop in this process on the in-memory transport, no MQTT broker is needed."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--building", help="parameter file of twin_generator, default config.Model")
+    args = parser.parse_args()
+    if args.building:
+        twin_generator.use_building(twin_generator.load_building(args.building))
+    config.Transport.BACKEND = 'memory'
+    clients = [service.start() for service in SERVICES]
+    for client in clients:
+        # handles the connect, the subscriptions of on_connect exist before the controller sends anything
+        client.loop(0)
+        client.loop_start()
+
+    start_time = time.perf_counter()
+    try:
+        temperature_controller = controller.main()
+    finally:
+        # the monitor and the diagnosis finish the messages that are still on the bus
+        transport.default_broker.join()
+        for client in clients:
+            client.disconnect()
+            client.loop_stop()
+    elapsed = time.perf_counter() - start_time
+    steps = temperature_controller.steps
+    print(f"{steps} steps in {elapsed:.2f} s ({steps / max(elapsed, 1e-9):.0f} steps/s)")
+    return temperature_controller
+
+
+if __name__ == "__main__":
+    main()
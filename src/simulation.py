@@ -1,7 +1,9 @@
-import paho.mqtt.client as mqtt
 import json
 import numpy as np
 import config
+import transport
+import wire
+from thermal_model import ThermalModel
 
 class HeatingSimulation:
     def __init__(self):
@@ -9,15 +11,17 @@ class HeatingSimulation:
         self.capacity = {}
         self.heat_transfer_external = {}
         self.heat_transfer_zones = {}
-        self.zones_neighbors = {}
+        self.model = ThermalModel(config.Model.SENSOR_ZONES, config.Model.BACKEND, config.Model.DISCRETIZATION)
+        self.encoder = wire.Encoder()
+        self.decoder = wire.Decoder()
         self.current_time = 0
         initial_temperature = self.generate_environment_temperature(self.current_time)
-        self.temperatures = {'Z1': initial_temperature, 'Z2': initial_temperature, 'Z3': initial_temperature}
+        self.temperatures = {zone: initial_temperature for zone in config.Model.HEAT_CAPACITY}
 
-    def simulate_step(self, heater_status, current_temps, delta_t):
+    def simulate_step(self, heater_status, current_temps, delta_t, correlation_id=None):
         new_temps = self.calculate_new_temps(current_temps, heater_status, self.current_time, delta_t)
         self.temperatures.update(new_temps)
-        self.publish_temperatures()
+        self.publish_temperatures(correlation_id)
         self.current_time += 1
     
     def generate_environment_temperature(self, current_time):
@@ -27,53 +31,37 @@ class HeatingSimulation:
         return base_temp
 
     def calculate_new_temps(self, current_temps, heater_status, current_time, delta_t):
-        new_temps = {}
         env_temp = self.generate_environment_temperature(current_time)
-        for zone in self.capacity.keys():  # Sicherstellen, dass nur die Zonen verwendet werden, die in der Nachricht enthalten sind
-            if zone in current_temps:  # Überprüfen, ob die Zone existiert
-                heat_loss = current_temps[zone] * (
-                    self.heat_transfer_external[zone] + 
-                    sum(self.heat_transfer_zones[zone].get(nbr, 0) for nbr in self.zones_neighbors[zone])
-                )
-                heat_gain = (
-                    self.heat_transfer_external[zone] * env_temp +
-                    sum(self.heat_transfer_zones[zone].get(nbr, 0) * current_temps.get(nbr, 0) for nbr in self.zones_neighbors[zone])
-                )
-                new_temps[zone] = current_temps[zone] + (delta_t / self.capacity[zone]) * (heater_status[zone] + heat_gain - heat_loss)
-        return new_temps
+        # the matrices are only rebuilt if the parameters or delta_t changed
+        self.model.set_parameters(self.capacity, self.heat_transfer_external, self.heat_transfer_zones, delta_t)
+        # only the zones contained in the message are updated
+        return self.model.step_dict(current_temps, heater_status, env_temp)
 
     def update_heater_status(self, message):
-        status = json.loads(message.payload.decode())
+        status = self.decoder.loads(message.topic, message.payload)
         heater_status = status['heater_status']
         current_temps = status['current_temperatures']
         self.delta_t = status['delta_t']  # Make sure to assign delta_t
-        self.capacity = status['capacity']
-        self.heat_transfer_external = status['heat_transfer_external']
-        self.heat_transfer_zones = status['heat_transfer_zones']
-        self.zones_neighbors = {zone: list(self.heat_transfer_zones[zone].keys()) for zone in self.heat_transfer_zones}
-        self.simulate_step(heater_status, current_temps, self.delta_t)
+        # binary messages only carry the constants when they changed, see wire.py
+        self.capacity = status.get('capacity', self.capacity)
+        self.heat_transfer_external = status.get('heat_transfer_external', self.heat_transfer_external)
+        self.heat_transfer_zones = status.get('heat_transfer_zones', self.heat_transfer_zones)
+        self.simulate_step(heater_status, current_temps, self.delta_t, status.get('correlation_id'))
         print(status)
 
 
-    def publish_temperatures(self):
-        Z1 = self.temperatures['Z1']
-        Z2 = self.temperatures['Z2']
-        Z3 = self.temperatures['Z3']
+    def publish_temperatures(self, correlation_id=None):
+        # zone temperatures and the sensor readings through the observation matrix (config.Model.SENSOR_ZONES)
+        temp_data = dict(self.temperatures)
+        temp_data.update(self.model.observe_dict(self.temperatures))
+        #temp_data['TB'] = 25 # Faulty component
+        temp_data['environment'] = self.generate_environment_temperature(self.current_time)
+        temp_data['delta_t'] = self.delta_t
         
-        temp_data = {
-            'Z1': Z1,
-            'Z2': Z2,
-            'Z3': Z3,
-            'TA': Z1,
-            'TB': (Z1 + Z2) / 2,
-            #'TB': 25, # Faulty component
-            'TC': (Z2 + Z3) / 2,
-            'TD': Z3,
-            'environment': self.generate_environment_temperature(self.current_time),
-            'delta_t': self.delta_t
-        }
-        
-        client.publish("simulation/temperatures", json.dumps(temp_data))
+        if correlation_id is not None:
+            # lets the requester match the reply
+            temp_data['correlation_id'] = correlation_id
+        client.publish("simulation/temperatures", self.encoder.dumps("simulation/temperatures", temp_data))
 
 # MQTT Callbacks
 def on_connect(client, userdata, flags, rc):
@@ -90,21 +78,25 @@ def on_disconnect(client, userdata, rc):
 SIMULATION_DURATION = 7200  # Use this for calculating environment temperature fluctuation
 
 
-# MQTT Client setup
-client = mqtt.Client()
-client.on_connect = on_connect
-client.on_message = on_message
-client.on_disconnect = on_disconnect
-client.username_pw_set(config.Mqtt.MQTT_SERVER_USER, config.Mqtt.MQTT_SERVER_PASS)
+client = None
+simulation = None
+
+def start():
+    """Creates the simulation and connects its client, the caller runs the network loop."""
+    global client, simulation
+    simulation = HeatingSimulation()
+    client = transport.create_client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_disconnect = on_disconnect
+    return transport.connect(client)
 
-# Start simulation
-simulation = HeatingSimulation()
-client.connect(config.Mqtt.MQTT_SERVER_URL, config.Mqtt.MQTT_SERVER_PORT, 60)
-client.loop_start()
+def main():
+    start()
+    try:
+        client.loop_forever()  # Keep the script running to listen for messages
+    except KeyboardInterrupt:
+        client.disconnect()
 
-try:
-    while True:
-        pass  # Keep the script running to listen for messages
-except KeyboardInterrupt:
-    client.loop_stop()
-    client.disconnect()
+if __name__ == "__main__":
+    main()
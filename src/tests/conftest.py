@@ -0,0 +1,30 @@
+import os
+import sys
+import pytest
+
+# the modules of src/ are imported by their plain names, as the components do
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC)
+
+import config  # noqa: E402
+import twin_generator  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Compiled graphs go to a fresh directory instead of src/.dtdl_cache."""
+    monkeypatch.setattr(config.Dtdl2Graph, 'CACHE_DIR', str(tmp_path / 'dtdl_cache'))
+
+
+@pytest.fixture
+def use_twin(tmp_path, monkeypatch):
+    """Points config.Model at heating_twin.dtdl (None) or at a generated building, undone after the test."""
+    def use(*building, **options):
+        if not building:
+            monkeypatch.setattr(config.Model, 'DTDL_FILE', os.path.join(SRC, 'heating_twin.dtdl'))
+            return
+        document, parameters = twin_generator.generate_building(*building, **options)
+        path = twin_generator.write_building(document, parameters, str(tmp_path / 'building'))
+        for key, value in twin_generator.load_building(path).items():
+            monkeypatch.setattr(config.Model, key, value)
+    return use
@@ -0,0 +1,279 @@
+import numpy as np
+import pytest
+import config
+import controller
+from mqtt_rpc import RemoteError
+from thermal_model import ThermalModel
+
+
+@pytest.fixture
+def temperature_controller():
+    return controller.TemperatureController(config.Controller.TARGET_TEMP, {}, config.Controller.SIM_STOP_TIME)
+
+
+class BatchSimulation:
+    """Answers predict_heater_effects_batch in process and records every evaluated candidate with its RMSE."""
+    def __init__(self, temperature_controller, fail_at=None, error=None):
+        self.controller = temperature_controller
+        self.model = ThermalModel(config.Model.SENSOR_ZONES)
+        self.evaluated = []
+        self.calls = 0
+        self.fail_at = fail_at
+        self.error = error
+
+    def __call__(self, client, parameter_sets):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            if self.error is not None:
+                raise self.error
+            return []
+        sets = [(params['capacity'], params['heat_transfer_external'], params['heat_transfer_zones']) for params in parameter_sets]
+        matrices = self.model.compile_batch(sets, controller.DELTA_T)
+        state = self.model.to_vector(self.controller.current_temperatures)
+        heating = self.model.to_vector(self.controller.heater_status)
+        readings = self.model.observe(self.model.step_batch(matrices, state, heating, self.controller.environment_temperature))
+        predictions = [dict(zip(self.model.sensors, row)) for row in readings.tolist()]
+        measured = np.array([self.controller.comparison_temperatures[sensor] for sensor in self.model.sensors])
+        for params, row in zip(parameter_sets, readings):
+            self.evaluated.append((params, float(np.sqrt(np.mean((row - measured) ** 2)))))
+        return predictions
+
+
+def measure(temperature_controller, scale):
+    """Sets the measured readings to a step of the model with the external transfers scaled."""
+    temperature_controller.current_temperatures.update({'Z1': 24.0, 'Z2': 18.0, 'Z3': 21.0})
+    temperature_controller.heater_status = {'Z1': 0, 'Z2': config.Controller.HEATER_POWER, 'Z3': 0}
+    model = ThermalModel(config.Model.SENSOR_ZONES)
+    model.set_parameters(config.Model.HEAT_CAPACITY, {zone: value * scale for zone, value in config.Model.HEAT_TRANSFER_EXTERNAL.items()},
+                         config.Model.HEAT_TRANSFER_ZONES, controller.DELTA_T)
+    zones = model.step_dict(temperature_controller.current_temperatures, temperature_controller.heater_status,
+                            temperature_controller.environment_temperature)
+    temperature_controller.comparison_temperatures.update(model.observe_dict(zones))
+
+
+@pytest.mark.parametrize('fail_at, error', [(None, None), (3, None), (2, RemoteError("KeyError: 'candidates'"))])
+def test_gradient_descent_returns_the_best_probe(temperature_controller, monkeypatch, fail_at, error):
+    measure(temperature_controller, 8.0)
+    simulation = BatchSimulation(temperature_controller, fail_at, error)
+    monkeypatch.setattr(temperature_controller, 'predict_heater_effects_batch', simulation)
+
+    result = temperature_controller.gradient_descent(None)
+
+    assert simulation.evaluated
+    best_params, best_rmse = min(simulation.evaluated, key=lambda entry: entry[1])
+    assert result == best_params
+    # the first candidate of the first batch are the current constants, the result is never worse
+    assert best_rmse <= simulation.evaluated[0][1]
+    if fail_at is None:
+        assert best_rmse < simulation.evaluated[0][1]
+    # the controller keeps its constants, the caller applies the result
+    assert temperature_controller.heat_transfer_external_controller_simulation == config.Model.HEAT_TRANSFER_EXTERNAL
+
+
+@pytest.mark.parametrize('estimator', ['rls', 'least_squares', 'gradient_descent'])
+def test_process_step_refits_unless_rls(temperature_controller, monkeypatch, estimator):
+    temperature_controller.set_estimator(estimator)
+    refits = []
+    fitted = {'capacity': {'Z1': 1.0}, 'heat_transfer_external': {'Z1': 2.0}, 'heat_transfer_zones': {'Z1': {}}}
+    monkeypatch.setattr(temperature_controller, 'recalibrate', lambda client: refits.append(client) or fitted)
+    temperature_controller.heater_status = {'Z1': config.Controller.HEATER_POWER, 'Z2': 0, 'Z3': 0}
+    real_temperatures = {'Z1': 16.0, 'Z2': 15.5, 'Z3': 15.2, 'TA': 16.0, 'TB': 15.75, 'TC': 15.35, 'TD': 15.2, 'environment': 15}
+    # 1 K off, far above the RMSE that triggers a refit
+    predicted_temperatures = {sensor: real_temperatures[sensor] + 1 for sensor in config.Model.SENSOR_ZONES}
+
+    temperature_controller.process_step(None, predicted_temperatures, real_temperatures)
+
+    if estimator == 'rls':
+        assert refits == []
+        expected = temperature_controller.rls.parameters(config.Model.HEAT_CAPACITY, config.Model.HEAT_TRANSFER_EXTERNAL,
+                                                         config.Model.HEAT_TRANSFER_ZONES)
+        # the online estimate is applied on every step
+        assert temperature_controller.capacity_controller_simulation == expected[0]
+        assert temperature_controller.capacity_controller_simulation != config.Model.HEAT_CAPACITY
+    else:
+        assert refits == [None]
+        assert temperature_controller.capacity_controller_simulation == fitted['capacity']
+    assert temperature_controller.RMSE == pytest.approx(1.0)
+    assert temperature_controller.steps == 1
+
+
+def direct_cost(temperature_controller, on):
+    """Tracking plus energy cost of holding the heater combination over the horizon, from a plain rollout."""
+    model = temperature_controller.model
+    heating = model.to_vector({zone: config.Controller.HEATER_POWER * int(value) for zone, value in zip(model.zones, on)})
+    state = model.to_vector(temperature_controller.current_temperatures)
+    environment = np.full(config.Controller.MPC_HORIZON, float(temperature_controller.environment_temperature))
+    readings = model.observe(model.rollout(state, heating, environment))
+    tracking = np.sum((readings - temperature_controller.target_temperature) ** 2) / len(model.sensors)
+    return tracking + config.Controller.MPC_ENERGY_WEIGHT * config.Controller.MPC_HORIZON * sum(on)
+
+
+@pytest.fixture
+def mpc_controller(temperature_controller, monkeypatch):
+    monkeypatch.setattr(config.Controller, 'MPC_HORIZON', 4)
+    temperature_controller.current_temperatures.update({'Z1': 19.2, 'Z2': 20.4, 'Z3': 18.1})
+    temperature_controller.model.set_parameters(temperature_controller.capacity_controller_simulation,
+                                                temperature_controller.heat_transfer_external_controller_simulation,
+                                                temperature_controller.heat_transfer_zones_controller_simulation, controller.DELTA_T)
+    return temperature_controller
+
+
+def test_schedule_cost_equals_rollouts(mpc_controller):
+    zones = mpc_controller.model.zones
+    state = mpc_controller.model.to_vector(mpc_controller.current_temperatures)
+    _, _, constant, linear, quadratic = mpc_controller.schedule_cost_terms(state, list(range(len(zones))))
+    for combination in range(2 ** len(zones)):
+        on = np.array([(combination >> i) & 1 for i in range(len(zones))], dtype=float)
+        assert constant + linear @ on + on @ quadratic @ on == pytest.approx(direct_cost(mpc_controller, on), rel=1e-9)
+
+
+@pytest.mark.parametrize('exhaustive', [True, False])
+def test_optimizer_matches_brute_force(mpc_controller, monkeypatch, exhaustive):
+    if not exhaustive:
+        monkeypatch.setattr(config.Controller, 'MPC_MAX_EXHAUSTIVE_ZONES', 0)
+    zones = mpc_controller.model.zones
+    predicted = mpc_controller.optimize_heater_status()
+    on = [int(mpc_controller.heater_status[zone] > 0) for zone in zones]
+    costs = {combination: direct_cost(mpc_controller, [(combination >> i) & 1 for i in range(len(zones))])
+             for combination in range(2 ** len(zones))}
+    best = min(costs.values())
+    chosen = costs[sum(value << i for i, value in enumerate(on))]
+    # on three heaters the greedy search also finds the global optimum
+    assert chosen == pytest.approx(best, rel=1e-9)
+    assert 0 < sum(on) < len(zones)
+    # the prediction is the first step of the chosen combination
+    heating = mpc_controller.model.to_vector(mpc_controller.heater_status)
+    first = mpc_controller.model.step(mpc_controller.model.to_vector(mpc_controller.current_temperatures), heating,
+                                      mpc_controller.environment_temperature)
+    assert [predicted[zone] for zone in zones] == pytest.approx(first.tolist(), rel=1e-12)
+    assert [predicted[sensor] for sensor in mpc_controller.model.sensors] == pytest.approx(
+        mpc_controller.model.observe(first).tolist(), rel=1e-12)
+
+
+@pytest.mark.parametrize('exhaustive', [True, False])
+def test_broken_heaters_stay_off(mpc_controller, monkeypatch, exhaustive):
+    if not exhaustive:
+        monkeypatch.setattr(config.Controller, 'MPC_MAX_EXHAUSTIVE_ZONES', 0)
+    # far below the target, every working heater is switched on
+    mpc_controller.current_temperatures.update({'Z1': 5.0, 'Z2': 5.0, 'Z3': 5.0})
+    mpc_controller.broken_heaters = {'Z1': 0, 'Z3': 10 ** 9}
+    mpc_controller.optimize_heater_status()
+    assert mpc_controller.heater_status == {'Z1': 0, 'Z2': config.Controller.HEATER_POWER, 'Z3': config.Controller.HEATER_POWER}
+    # after the time of fault Z3 stays off as well
+    mpc_controller.steps = 10 ** 9 // controller.DELTA_T
+    mpc_controller.optimize_heater_status()
+    assert mpc_controller.heater_status == {'Z1': 0, 'Z2': config.Controller.HEATER_POWER, 'Z3': 0}
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_greedy_never_worse_than_its_starts(seed):
+    rng = np.random.default_rng(seed)
+    heaters = 30
+    responses = rng.standard_normal((heaters, 50))
+    quadratic = responses @ responses.T / 50
+    linear = rng.standard_normal(heaters) * 5
+    starts = [np.zeros(heaters), np.ones(heaters), rng.random(heaters) < 0.5]
+
+    def cost(on):
+        return linear @ on + on @ quadratic @ on
+
+    best = controller.TemperatureController.greedy_heater_status(linear, quadratic, starts)
+    assert set(best.tolist()) <= {0, 1}
+    assert cost(best) <= min(cost(np.asarray(start, dtype=float)) for start in starts) + 1e-9
+    # a local optimum: no single flip lowers the cost
+    for i in range(heaters):
+        flipped = best.astype(float)
+        flipped[i] = 1 - flipped[i]
+        assert cost(flipped) >= cost(best) - 1e-9
+
+
+def prediction(**temperatures):
+    return {'heater_status': {'Z1': 0}, 'current_temperatures': temperatures, 'delta_t': 200}
+
+
+def test_prediction_cache_hits_and_misses():
+    cache = controller.PredictionCache(8)
+    key = cache.key("controller/heater_simulation", prediction(Z1=20.0, Z2=18.0))
+    assert cache.get(key) is None
+    cache.put(key, {'TA': 20.5, 'correlation_id': 'abc'})
+    # the key does not depend on the order of the fields, the reply loses its correlation id
+    same = cache.key("controller/heater_simulation", prediction(Z2=18.0, Z1=20.0))
+    assert same == key and cache.get(same) == {'TA': 20.5}
+    cache.get(same)['TA'] = 0  # a copy
+    assert cache.get(key) == {'TA': 20.5}
+    assert cache.get(cache.key("controller/heater_simulation", prediction(Z1=20.0001, Z2=18.0))) is None
+    assert cache.get(cache.key("controller/heater_horizon", prediction(Z1=20.0, Z2=18.0))) is None
+    assert cache.cache_info() == {'hits': 3, 'misses': 3, 'size': 1, 'maxsize': 8}
+    # failed requests are not cached
+    cache.put(cache.key("controller/heater_simulation", prediction(Z1=1.0)), {})
+    assert cache.cache_info()['size'] == 1
+
+
+def test_prediction_cache_tolerance():
+    cache = controller.PredictionCache(8, tolerance=0.1)
+    cache.put(cache.key("controller/heater_simulation", prediction(Z1=20.01, Z2=18.0)), {'TA': 20.5})
+    assert cache.get(cache.key("controller/heater_simulation", prediction(Z1=20.04, Z2=17.98))) == {'TA': 20.5}
+    assert cache.get(cache.key("controller/heater_simulation", prediction(Z1=20.06, Z2=18.0))) is None
+    # only the temperatures are quantized
+    message = dict(prediction(Z1=20.01, Z2=18.0), delta_t=200.01)
+    assert cache.get(cache.key("controller/heater_simulation", message)) is None
+
+
+def test_prediction_cache_evicts_the_least_recently_used():
+    cache = controller.PredictionCache(3)
+    keys = [cache.key("controller/heater_simulation", prediction(Z1=float(i))) for i in range(4)]
+    for i, key in enumerate(keys[:3]):
+        cache.put(key, {'TA': i})
+    cache.get(keys[0])  # the oldest entry becomes the most recent
+    cache.put(keys[3], {'TA': 3})
+    assert cache.get(keys[1]) is None
+    assert [cache.get(key) for key in (keys[0], keys[2], keys[3])] == [{'TA': 0}, {'TA': 2}, {'TA': 3}]
+    assert cache.cache_info()['size'] == 3
+
+
+def test_prediction_cache_size_zero_disables_it(monkeypatch):
+    monkeypatch.setattr(config.Controller, 'PREDICTION_CACHE_SIZE', 0)
+    temperature_controller = controller.TemperatureController(config.Controller.TARGET_TEMP, {}, config.Controller.SIM_STOP_TIME)
+    requests = []
+    monkeypatch.setattr(temperature_controller, 'request', lambda topic, reply_topic, message: requests.append(topic) or {'TA': 20.0})
+    for _ in range(3):
+        assert temperature_controller.predict_heater_effects(None) == {'TA': 20.0}
+    assert requests == ["controller/heater_simulation"] * 3
+    assert temperature_controller.prediction_cache.cache_info()['size'] == 0
+
+
+def test_batch_only_sends_the_missing_candidates(temperature_controller, monkeypatch):
+    sent = []
+
+    def request(topic, reply_topic, message):
+        sent.append([candidate['capacity']['Z1'] for candidate in message['candidates']])
+        return {'predictions': [{'TA': candidate['capacity']['Z1']} for candidate in message['candidates']],
+                'correlation_id': 'abc'}
+
+    monkeypatch.setattr(temperature_controller, 'request', request)
+
+    def parameter_sets(*capacities):
+        return [{'capacity': {'Z1': capacity}, 'heat_transfer_external': {'Z1': 1.0}, 'heat_transfer_zones': {'Z1': {}}}
+                for capacity in capacities]
+
+    assert temperature_controller.predict_heater_effects_batch(None, parameter_sets(1, 2, 3)) == [{'TA': 1}, {'TA': 2}, {'TA': 3}]
+    predictions = temperature_controller.predict_heater_effects_batch(None, parameter_sets(4, 2, 5, 1))
+    assert predictions == [{'TA': 4}, {'TA': 2}, {'TA': 5}, {'TA': 1}]
+    assert sent == [[1, 2, 3], [4, 5]]
+    # fully cached, no request
+    assert temperature_controller.predict_heater_effects_batch(None, parameter_sets(5, 3)) == [{'TA': 5}, {'TA': 3}]
+    assert len(sent) == 2
+    # a new state misses again
+    temperature_controller.current_temperatures['Z1'] = 21.5
+    temperature_controller.predict_heater_effects_batch(None, parameter_sets(1))
+    assert sent[-1] == [1]
+
+
+def test_batch_shares_entries_with_single_predictions(temperature_controller, monkeypatch):
+    monkeypatch.setattr(temperature_controller, 'request', lambda topic, reply_topic, message: {'predictions': [{'TA': 20.0}]})
+    current = {'capacity': temperature_controller.capacity_controller_simulation,
+               'heat_transfer_external': temperature_controller.heat_transfer_external_controller_simulation,
+               'heat_transfer_zones': temperature_controller.heat_transfer_zones_controller_simulation}
+    temperature_controller.predict_heater_effects_batch(None, [current])
+    monkeypatch.setattr(temperature_controller, 'request', lambda topic, reply_topic, message: pytest.fail("not cached"))
+    assert temperature_controller.predict_heater_effects(None) == {'TA': 20.0}
@@ -0,0 +1,90 @@
+import json
+import numpy as np
+import pytest
+import config
+import controller_simulation
+import transport
+from mqtt_rpc import RemoteError, RpcClient
+from thermal_model import ThermalModel
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, json.loads(payload)))
+
+
+@pytest.fixture
+def simulation(monkeypatch):
+    monkeypatch.setattr(controller_simulation, 'client', RecordingClient())
+    return controller_simulation.HeatingSimulation()
+
+
+def candidate(scale=1.0, **extra):
+    return dict({'capacity': {zone: value * scale for zone, value in config.Model.HEAT_CAPACITY.items()},
+                 'heat_transfer_external': dict(config.Model.HEAT_TRANSFER_EXTERNAL),
+                 'heat_transfer_zones': config.Model.HEAT_TRANSFER_ZONES}, **extra)
+
+
+def batch_request(**request):
+    return transport.Message("controller/heater_simulation_batch", json.dumps(request).encode())
+
+
+def test_batch_equals_single_predictions(simulation):
+    temperatures = {'Z1': 18.0, 'Z2': 21.0, 'Z3': 16.0}
+    heating = {'Z1': 10000, 'Z2': 0, 'Z3': 10000}
+    candidates = [candidate(0.5), candidate(1.0), candidate(2.0, heater_status={'Z1': 0, 'Z2': 10000, 'Z3': 0}),
+                  candidate(1.5, current_temperatures={'Z1': 25.0, 'Z2': 15.0, 'Z3': 20.0})]
+    simulation.simulate_batch(batch_request(candidates=candidates, delta_t=200, current_temperatures=temperatures,
+                                            heater_status=heating, correlation_id='abc'))
+    (topic, reply), = controller_simulation.client.published
+    assert topic == "controller_simulation/batch_temperatures" and reply['correlation_id'] == 'abc'
+
+    model = ThermalModel(config.Model.SENSOR_ZONES)
+    for entry, prediction in zip(candidates, reply['predictions']):
+        model.set_parameters(entry['capacity'], entry['heat_transfer_external'], entry['heat_transfer_zones'], 200)
+        expected = model.step_dict(entry.get('current_temperatures', temperatures), entry.get('heater_status', heating), 15)
+        expected.update(model.observe_dict(expected))
+        assert prediction.pop('environment') == 15
+        assert prediction == pytest.approx(expected, rel=1e-12)
+
+
+@pytest.mark.parametrize('request_fields', [
+    {'delta_t': 200},  # no candidates
+    {'candidates': [], 'delta_t': 200},
+    {'candidates': [{'capacity': config.Model.HEAT_CAPACITY}], 'delta_t': 200},
+    {'candidates': [candidate()]},  # no delta_t
+    {'candidates': [candidate()], 'delta_t': 'a minute'},
+    {'candidates': [candidate(current_temperatures=[18.0])], 'delta_t': 200},
+])
+def test_invalid_batch_gets_an_error_reply(simulation, request_fields):
+    simulation.simulate_batch(batch_request(correlation_id='abc', **request_fields))
+    (topic, reply), = controller_simulation.client.published
+    assert topic == "controller_simulation/batch_temperatures"
+    assert reply['correlation_id'] == 'abc' and 'predictions' not in reply
+    assert reply['error']
+
+
+def test_rpc_client_raises_the_error_reply(monkeypatch):
+    broker = transport.InMemoryBroker()
+    server = transport.InMemoryClient(broker)
+    monkeypatch.setattr(controller_simulation, 'client', server)
+    monkeypatch.setattr(controller_simulation, 'simulation', controller_simulation.HeatingSimulation())
+    server.on_connect = controller_simulation.on_connect
+    server.on_message = controller_simulation.on_message
+    server.connect()
+    server.loop_start()
+    rpc = RpcClient(5, transport.InMemoryClient(broker))
+    try:
+        broker.join()
+        with pytest.raises(RemoteError, match='KeyError'):
+            rpc.request("controller/heater_simulation_batch", "controller_simulation/batch_temperatures", {'delta_t': 200})
+        reply = rpc.request("controller/heater_simulation_batch", "controller_simulation/batch_temperatures",
+                            {'delta_t': 200, 'candidates': [candidate()], 'current_temperatures': {'Z1': 20.0}})
+        assert len(reply['predictions']) == 1 and np.isfinite(reply['predictions'][0]['Z1'])
+    finally:
+        rpc.close()
+        server.disconnect()
+        server.loop_stop()
@@ -0,0 +1,94 @@
+import io
+import json
+import os
+import random
+import pytest
+import dtdl2graph
+import twin_generator
+from conftest import SRC
+
+
+def heating_twin():
+    with open(os.path.join(SRC, 'heating_twin.dtdl')) as file:
+        return json.load(file)
+
+
+def generated_twin():
+    document, _ = twin_generator.generate_building('multi_floor', 12, 2, 2, None, 2, 2)
+    # wildcard subscribers, '$' topics and a nested component
+    document['contents'] += [
+        twin_generator.component('dtmi:test:logger', 'Logger', 'Logger', [twin_generator.telemetry('All', 'Subscriber', 'sensor/+')]),
+        twin_generator.component('dtmi:test:recorder', 'Recorder', 'Recorder', [
+            twin_generator.telemetry('Everything', 'Subscriber', '#'),
+            twin_generator.component('dtmi:test:system', 'System', 'System', [twin_generator.telemetry('Sys', 'Publisher', '$SYS/load')])]),
+    ]
+    return document
+
+
+def shuffled(item, rng):
+    """The same document with the keys of every object in random order."""
+    if isinstance(item, dict):
+        keys = list(item)
+        rng.shuffle(keys)
+        return {key: shuffled(item[key], rng) for key in keys}
+    if isinstance(item, list):
+        return [shuffled(element, rng) for element in item]
+    return item
+
+
+@pytest.mark.parametrize('document', [heating_twin(), generated_twin()], ids=['heating_twin', 'generated'])
+@pytest.mark.parametrize('indent', [None, 4])
+@pytest.mark.parametrize('chunk_size', [1, 7, 65536])
+def test_stream_equals_tree_walker(document, indent, chunk_size):
+    file = io.StringIO(json.dumps(document, indent=indent))
+    assert list(dtdl2graph.iter_mqtt_endpoints_stream(file, chunk_size)) == list(dtdl2graph.iter_mqtt_endpoints(document))
+    file.seek(0)
+    assert dtdl2graph.extract_mqtt_connections_from_stream(file) == dtdl2graph.extract_mqtt_connections(document['contents'])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_stream_does_not_depend_on_key_order(seed):
+    document = shuffled(generated_twin(), random.Random(seed))
+    records = list(dtdl2graph.iter_mqtt_endpoints_stream(io.StringIO(json.dumps(document)), 16))
+    assert sorted(records) == sorted(dtdl2graph.iter_mqtt_endpoints(document))
+    connections = dtdl2graph.extract_mqtt_connections_from_stream(io.StringIO(json.dumps(document)))
+    expected = dtdl2graph.extract_mqtt_connections(document['contents'])
+    assert {key: set(value) for key, value in connections.items()} == {key: set(value) for key, value in expected.items()}
+
+
+def rebuild(events):
+    """The document described by the events of iter_json_events."""
+    root = []
+    stack, keys = [root], [None]
+    for event, value in events:
+        if event in ('end_map', 'end_array'):
+            stack.pop()
+            keys.pop()
+            continue
+        if event == 'key':
+            keys[-1] = value
+            continue
+        if event in ('start_map', 'start_array'):
+            value = {} if event == 'start_map' else []
+        if isinstance(stack[-1], list):
+            stack[-1].append(value)
+        else:
+            stack[-1][keys[-1]] = value
+        if event in ('start_map', 'start_array'):
+            stack.append(value)
+            keys.append(None)
+    return root[0]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 65536])
+def test_json_events_rebuild_the_document(chunk_size):
+    document = {'a': [1, -2.5e3, True, False, None, 'x"\\éy', {}, []], 'b': {'c': 0, 'd': 1E+2}}
+    text = json.dumps(document, ensure_ascii=False)
+    assert rebuild(dtdl2graph.iter_json_events(io.StringIO(text), chunk_size)) == document
+
+
+def test_wildcards_follow_mqtt():
+    connections = dtdl2graph.extract_mqtt_connections(generated_twin()['contents'])
+    # '#' does not match topics starting with '$'
+    assert 'System' not in connections['Recorder']
+    assert set(connections['Logger']) == set(twin_generator.generate_building('multi_floor', 12, 2, 2, None, 2, 2)[1]['SENSOR_ZONES'])
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+import config
+from estimation import LeastSquaresEstimator, RecursiveEstimator
+from thermal_model import ThermalModel
+
+DELTA_T = 200
+# the constants of the real system, 10-40 % away from config.Model where the fits start
+CAPACITY = {'Z1': 1.3e6, 'Z2': 0.8e6, 'Z3': 1.1e6}
+HEAT_TRANSFER_EXTERNAL = {'Z1': 800.0, 'Z2': 650.0, 'Z3': 1200.0}
+HEAT_TRANSFER_ZONES = {'Z1': {'Z2': 420.0}, 'Z2': {'Z1': 420.0, 'Z3': 610.0}, 'Z3': {'Z2': 610.0}}
+
+
+def history(steps, seed=0, uniform=False, discretization='euler'):
+    """Noise-free steps of the real system from random states, heater combinations and environments.
+
+    With uniform all zones start a step at the same temperature, so the zone couplings have no effect.
+    """
+    rng = np.random.default_rng(seed)
+    model = ThermalModel(config.Model.SENSOR_ZONES, discretization=discretization)
+    model.set_parameters(CAPACITY, HEAT_TRANSFER_EXTERNAL, HEAT_TRANSFER_ZONES, DELTA_T)
+    recorded = []
+    for _ in range(steps):
+        if uniform:
+            temperatures = dict.fromkeys(model.zones, float(15 + 10 * rng.random()))
+        else:
+            temperatures = dict(zip(model.zones, (15 + 10 * rng.random(len(model.zones))).tolist()))
+        heater_status = dict(zip(model.zones, rng.choice([0.0, 10000.0], len(model.zones)).tolist()))
+        environment = float(10 + 5 * rng.random())
+        new_temperatures = model.step_dict(temperatures, heater_status, environment)
+        recorded.append({'temperatures': temperatures, 'heater_status': heater_status, 'environment': environment,
+                           'measured': model.observe_dict(new_temperatures)})
+    return recorded
+
+
+def fit(steps, discretization='euler'):
+    estimator = LeastSquaresEstimator(config.Model.SENSOR_ZONES, discretization)
+    return estimator.fit(config.Model.HEAT_CAPACITY, config.Model.HEAT_TRANSFER_EXTERNAL, config.Model.HEAT_TRANSFER_ZONES,
+                         steps, DELTA_T)
+
+
+@pytest.mark.parametrize('discretization', ['euler', 'exact'])
+def test_least_squares_recovers_the_constants(discretization):
+    capacity, heat_transfer_external, heat_transfer_zones, rmse = fit(history(40, discretization=discretization), discretization)
+    assert rmse < 1e-3
+    assert capacity == pytest.approx(CAPACITY, rel=5e-3)
+    assert heat_transfer_external == pytest.approx(HEAT_TRANSFER_EXTERNAL, rel=5e-3)
+    for zone, neighbours in HEAT_TRANSFER_ZONES.items():
+        assert heat_transfer_zones[zone] == pytest.approx(neighbours, rel=5e-3)
+    values = list(capacity.values()) + list(heat_transfer_external.values())
+    values += [value for neighbours in heat_transfer_zones.values() for value in neighbours.values()]
+    assert min(values) > 0
+
+
+def test_prior_keeps_unexcited_constants():
+    # equal zone temperatures: the couplings do not change any prediction
+    capacity, heat_transfer_external, heat_transfer_zones, rmse = fit(history(40, uniform=True))
+    assert capacity == pytest.approx(CAPACITY, rel=5e-3)
+    assert heat_transfer_external == pytest.approx(HEAT_TRANSFER_EXTERNAL, rel=5e-3)
+    for zone, neighbours in config.Model.HEAT_TRANSFER_ZONES.items():
+        assert heat_transfer_zones[zone] == pytest.approx(neighbours, rel=1e-6)
+
+
+def test_empty_history_keeps_the_constants():
+    capacity, heat_transfer_external, heat_transfer_zones, rmse = fit([])
+    assert (capacity, heat_transfer_external, heat_transfer_zones) == (
+        config.Model.HEAT_CAPACITY, config.Model.HEAT_TRANSFER_EXTERNAL, config.Model.HEAT_TRANSFER_ZONES)
+    assert np.isnan(rmse)
+
+
+def track(drift, growth, steps=500, seed=0):
+    """Runs the recursive estimator on steps of the real system whose external transfers grow by growth per step.
+
+    Returns the estimated constants and the true external transfers of the last step.
+    """
+    rng = np.random.default_rng(seed)
+    model = ThermalModel(config.Model.SENSOR_ZONES)
+    estimator = RecursiveEstimator(config.Model.HEAT_CAPACITY, config.Model.HEAT_TRANSFER_EXTERNAL,
+                                   config.Model.HEAT_TRANSFER_ZONES, drift, config.Controller.RLS_NOISE)
+    heat_transfer_external = dict(HEAT_TRANSFER_EXTERNAL)
+    for step in range(steps):
+        heat_transfer_external = {zone: value * (1 + growth) for zone, value in heat_transfer_external.items()}
+        model.set_parameters(CAPACITY, heat_transfer_external, HEAT_TRANSFER_ZONES, DELTA_T)
+        temperatures = dict(zip(model.zones, (15 + 10 * rng.random(len(model.zones))).tolist()))
+        heater_status = dict(zip(model.zones, rng.choice([0.0, 10000.0], len(model.zones)).tolist()))
+        environment = float(10 + 5 * rng.random())
+        estimator.update(temperatures, heater_status, environment, model.step_dict(temperatures, heater_status, environment), DELTA_T)
+    estimate = estimator.parameters(config.Model.HEAT_CAPACITY, config.Model.HEAT_TRANSFER_EXTERNAL, config.Model.HEAT_TRANSFER_ZONES)
+    return estimate, heat_transfer_external
+
+
+def test_recursive_estimator_converges():
+    (capacity, heat_transfer_external, heat_transfer_zones), _ = track(config.Controller.RLS_DRIFT, 0.0, steps=200)
+    assert capacity == pytest.approx(CAPACITY, rel=1e-6)
+    assert heat_transfer_external == pytest.approx(HEAT_TRANSFER_EXTERNAL, rel=1e-6)
+    for zone, neighbours in HEAT_TRANSFER_ZONES.items():
+        assert heat_transfer_zones[zone] == pytest.approx(neighbours, rel=1e-6)
+
+
+def test_recursive_estimator_tracks_drift():
+    # the external transfers grow to 2.7 times their start values
+    (capacity, heat_transfer_external, heat_transfer_zones), expected = track(config.Controller.RLS_DRIFT, 0.002)
+    assert heat_transfer_external == pytest.approx(expected, rel=1e-2)
+    assert capacity == pytest.approx(CAPACITY, rel=1e-2)
+    for zone, neighbours in HEAT_TRANSFER_ZONES.items():
+        assert heat_transfer_zones[zone] == pytest.approx(neighbours, rel=1e-2)
+    # without the drift model the filter stops following
+    (_, lagging, _), _ = track(0.0, 0.002)
+    assert lagging != pytest.approx(expected, rel=0.2)
+
+
+def test_recursive_estimator_keeps_unphysical_zones():
+    estimator = RecursiveEstimator(CAPACITY, HEAT_TRANSFER_EXTERNAL, HEAT_TRANSFER_ZONES)
+    estimator.theta['Z2'][0] = -1e-6
+    capacity, heat_transfer_external, heat_transfer_zones = estimator.parameters(
+        config.Model.HEAT_CAPACITY, config.Model.HEAT_TRANSFER_EXTERNAL, config.Model.HEAT_TRANSFER_ZONES)
+    assert capacity['Z2'] == config.Model.HEAT_CAPACITY['Z2']
+    assert heat_transfer_zones['Z2'] == config.Model.HEAT_TRANSFER_ZONES['Z2']
+    assert capacity['Z1'] == pytest.approx(CAPACITY['Z1'])
@@ -0,0 +1,144 @@
+import importlib
+import json
+import random
+import threading
+import time
+import numpy as np
+import pytest
+import config
+import frames
+import monitor
+from transport import Message
+
+SENSORS = ['TA', 'TB', 'TC', 'TD']
+DELTA_T = 60
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append(Message(topic, payload.encode('utf-8') if isinstance(payload, str) else payload))
+
+
+def samples(steps, seed=0):
+    """Per-step messages of the controller without the constants, some readings missing."""
+    rng = np.random.default_rng(seed)
+    result = []
+    for step in range(steps):
+        cold = step // 60 % 2 == 1
+        temperatures = {sensor: float(17 + 2 * rng.random() if cold else 19 + 2 * rng.random()) for sensor in SENSORS}
+        temperatures.update({zone: float(15 + rng.random()) for zone in ('Z1', 'Z2', 'Z3')})
+        if rng.random() < 0.05:
+            del temperatures[SENSORS[int(rng.integers(len(SENSORS)))]]
+        result.append({'heater_status': {'Z1': step % 2 * 10000, 'Z2': 0, 'Z3': 10000}, 'current_temperatures': temperatures,
+                       'delta_t': DELTA_T, 'RMSE': 0.1 * step, 'environment': 15,
+                       **{f'Simulated Temperature Sensor {sensor[1:]}': 16.0 + step for sensor in SENSORS}})
+    return result
+
+
+def framed(messages, batch_size):
+    """The frames a BatchPublisher sends for the messages, as the controller does."""
+    client = RecordingClient()
+    publisher = frames.BatchPublisher(client, "controller/heater_status_frames", batch_size, None)
+    for step, message in enumerate(messages):
+        publisher.append(step * DELTA_T, message)
+    publisher.close()
+    return client.published
+
+
+def test_frame_columns():
+    frame = frames.to_frame([0, 60], [{'current_temperatures': {'TA': 1.0, 'TB': 2.0}, 'RMSE': 0.1},
+                                      {'current_temperatures': {'TA': 3.0}}])
+    assert frame == {'time': [0, 60], 'current_temperatures': {'TA': [1.0, 3.0], 'TB': [2.0, None]}, 'RMSE': [0.1, None]}
+    np.testing.assert_array_equal(frames.column(frame, 'RMSE'), [0.1, np.nan])
+    np.testing.assert_array_equal(frames.column(frame, 'missing'), [np.nan, np.nan])
+    np.testing.assert_array_equal(frames.columns(frame, 'current_temperatures', ['TB', 'TA', 'TX']),
+                                  [[2.0, 1.0, np.nan], [np.nan, 3.0, np.nan]])
+
+
+@pytest.mark.parametrize('batch_size', [1, 7, 50, 1000])
+def test_monitor_frames_equal_single_messages(batch_size, monkeypatch):
+    messages = samples(300)
+    alerts = []
+    monkeypatch.setattr(monitor, 'publish_alert', lambda client, sensors: alerts.append(list(sensors)))
+
+    monkeypatch.setattr(monitor, 'detector', monitor.SensorWindowDetector(SENSORS))
+    for message in messages:
+        monitor.process_alert(None, message['current_temperatures'])
+    expected, alerts[:] = list(alerts), []
+    assert expected
+
+    monkeypatch.setattr(monitor, 'detector', monitor.SensorWindowDetector(SENSORS))
+    for frame in framed(messages, batch_size):
+        monitor.process_alert_frame(None, json.loads(frame.payload.decode()))
+    assert alerts == expected
+
+
+@pytest.mark.parametrize('module_name', ['plot', 'plot_lines'])
+@pytest.mark.parametrize('batch_size', [1, 7, 1000])
+def test_plot_frames_equal_single_messages(module_name, batch_size, monkeypatch):
+    pytest.importorskip('matplotlib')
+    # a short history, so the frames also wrap the ring buffers around
+    monkeypatch.setattr(config.History, 'LENGTH', 100)
+    messages = samples(250)
+
+    single = importlib.reload(importlib.import_module(module_name))
+    for message in messages:
+        single.on_message(None, None, Message("controller/heater_status", json.dumps(message).encode()))
+    expected = {'time': np.array(single.time_history)}
+    series = single.temperature_history if module_name == 'plot' else single.heating_status
+    expected.update((name, np.array(values)) for name, values in series.items())
+
+    batched = importlib.reload(single)
+    for frame in framed(messages, batch_size):
+        batched.on_message(None, None, frame)
+    series = batched.temperature_history if module_name == 'plot' else batched.heating_status
+    assert batched.steps == len(messages)
+    np.testing.assert_array_equal(np.array(batched.time_history), expected['time'])
+    for name, values in series.items():
+        np.testing.assert_array_equal(np.array(values), expected[name], err_msg=name)
+    importlib.reload(batched)
+
+
+class SlowClient(RecordingClient):
+    """Publishes take a random moment, as on a busy connection."""
+    def __init__(self, seed):
+        super().__init__()
+        self.random = random.Random(seed)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        time.sleep(self.random.random() * 1e-3)
+        super().publish(topic, payload, qos, retain)
+
+
+@pytest.mark.parametrize('batch_size', [3, 10])
+def test_concurrent_appends_keep_the_order(batch_size):
+    client = SlowClient(batch_size)
+    publisher = frames.BatchPublisher(client, "controller/heater_status_frames", batch_size, 0.0005)
+    threads, steps = 4, 300
+
+    def append(thread):
+        for step in range(steps):
+            publisher.append(step, {'thread': thread})
+            if step % 7 == 0:
+                time.sleep(1e-3)  # lets the timer publish partly filled frames
+
+    workers = [threading.Thread(target=append, args=(thread,)) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    publisher.close()
+
+    received = {thread: [] for thread in range(threads)}
+    sizes = set()
+    for message in client.published:
+        frame = json.loads(message.payload.decode())
+        sizes.add(len(frame['time']))
+        for step, thread in zip(frame['time'], frame['thread']):
+            received[thread].append(step)
+    # every sample arrives once and the samples of each thread in the order they were appended
+    assert received == {thread: list(range(steps)) for thread in range(threads)}
+    assert min(sizes) < batch_size  # the timer published too
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from itertools import combinations
+import pytest
+import config
+import dtdl2graph
+import identification
+
+
+def diagnoses(failing, strategy, monkeypatch):
+    monkeypatch.setattr(config.Diagnosis, 'STRATEGY', strategy)
+    return sorted(sorted(diagnosis) for diagnosis in identification.indentificator(failing, 'minimal'))
+
+
+@pytest.fixture(autouse=True)
+def fresh_sessions(monkeypatch):
+    monkeypatch.setattr(identification, 'diagnoser_sessions', OrderedDict())
+
+
+# brute force enumerates every subset of the cone, the buildings stay small
+@pytest.mark.parametrize('building', [(), ('corridor', 3), ('corridor', 2, 2), ('corridor', 2, 1, 1, None, 2, 2)])
+def test_hs_tree_equals_brute_force(building, use_twin, monkeypatch):
+    use_twin(*building)
+    sensors = dtdl2graph.load_publishers(config.Model.DTDL_FILE, 'sensor/+')
+    cases = [[]] + [list(failing) for size in (1, 2) for failing in combinations(sensors, size)] + [sensors]
+    for failing in cases:
+        assert diagnoses(failing, 'hs_tree', monkeypatch) == diagnoses(failing, 'brute_force', monkeypatch), failing
+    assert diagnoses(sensors, 'hs_tree', monkeypatch) != [[]]
+
+
+def test_sessions_survive_solver_rebuilds(use_twin, monkeypatch):
+    use_twin()
+    monkeypatch.setattr(config.Diagnosis, 'SOLVER_REBUILD_AFTER', 3)
+    monkeypatch.setattr(config.Diagnosis, 'SESSION_CACHE_SIZE', 2)
+    cases = [['TA'], ['TC'], ['TA', 'TC'], ['TB', 'TD'], ['TD']]
+    expected = [diagnoses(failing, 'brute_force', monkeypatch) for failing in cases]
+    for _ in range(4):
+        assert [diagnoses(failing, 'hs_tree', monkeypatch) for failing in cases] == expected
+    assert len(identification.diagnoser_sessions) <= 2
+
+
+def test_components_are_typed_from_the_twin(use_twin):
+    use_twin()
+    components = identification.typed_components(config.Model.DTDL_FILE, ['C1', 'H3', 'TA', 'TD+1', 'Z1'])
+    assert [type(comp) for comp in components] == [identification.HeaterController, identification.Heater,
+                                                   identification.TemperatureSensor, identification.TemperatureSensor,
+                                                   identification.Component]
+    assert [comp.name for comp in components] == ['C1', 'H3', 'TA', 'TD+1', 'Z1']
+
+    # chains of a generated building, every node of the graph is a known device
+    use_twin('corridor', 2, 2, 1, None, 2, 2)
+    digest, system_model = identification.compile_system_model(config.Model.DTDL_FILE)
+    nodes = set(system_model['connections']) | {child for children in system_model['connections'].values() for child in children}
+    types = {comp.name: type(comp) for comp in identification.typed_components(config.Model.DTDL_FILE, sorted(nodes))}
+    assert identification.Component not in types.values()
+    assert types['C2_2'] is identification.HeaterController and types['H2_1'] is identification.Heater
+    assert types['T1_2+1'] is identification.TemperatureSensor and types['T1_2'] is identification.TemperatureSensor
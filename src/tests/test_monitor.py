@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import monitor
+
+SENSORS = ['TA', 'TB', 'TC', 'TD', 'T5']
+
+
+class BaselineMonitor:
+    """The per-sensor list check the monitor used before the sliding window detector."""
+    def __init__(self, window, threshold=monitor.alert_temperature, growth=1.001):
+        self.window = window
+        self.threshold = threshold
+        self.growth = growth
+        self.history = {sensor: [] for sensor in SENSORS}
+
+    def update(self, temperatures):
+        problematic = []
+        for sensor, temp in temperatures.items():
+            history = self.history[sensor]
+            history.append(temp)
+            if len(history) > self.window:
+                history.pop(0)
+            if len(history) >= self.window:
+                rising_slowly = history[-1] < (self.growth ** self.window) * history[-self.window]
+                if all(t < self.threshold for t in history[-self.window:]) and rising_slowly:
+                    problematic.append(sensor)
+        return problematic
+
+
+def readings(steps, seed, missing=0.0):
+    """Temperatures around the threshold with long cold phases, NaN for a missing reading."""
+    rng = np.random.default_rng(seed)
+    cold = (np.arange(steps) // 60 % 3 == 1)[:, None] | (rng.random((steps, len(SENSORS))) < 0.02)
+    values = np.where(cold, 17 + 2.4 * rng.random((steps, len(SENSORS))), 19 + 2 * rng.random((steps, len(SENSORS))))
+    # a slow rise in the cold phase of the last sensor, it must not be reported
+    values[:, -1] = np.where(cold[:, -1], 17 + 0.05 * (np.arange(steps) % 60), values[:, -1])
+    values[rng.random(values.shape) < missing] = np.nan
+    return values
+
+
+@pytest.mark.parametrize('window', [1, 5, monitor.alert_threshold])
+@pytest.mark.parametrize('seed', range(3))
+def test_detector_equals_baseline(window, seed):
+    detector = monitor.SensorWindowDetector(SENSORS, window)
+    baseline = BaselineMonitor(window)
+    alerts = 0
+    for row in readings(400, seed):
+        temperatures = dict(zip(SENSORS, row.tolist()))
+        expected = baseline.update(temperatures)
+        assert detector.update(temperatures) == expected
+        alerts += bool(expected)
+    assert alerts > 0
+
+
+@pytest.mark.parametrize('window', [1, 5, monitor.alert_threshold])
+@pytest.mark.parametrize('missing', [0.0, 0.01])
+def test_batches_equal_single_steps(window, missing):
+    values = readings(600, 7, missing)
+    single = monitor.SensorWindowDetector(SENSORS, window)
+    expected = [single.update({sensor: value for sensor, value in zip(SENSORS, row.tolist()) if value == value})
+                for row in values]
+    batched = monitor.SensorWindowDetector(SENSORS, window)
+    rng = np.random.default_rng(window)
+    result, start = [], 0
+    while start < len(values):
+        # batches shorter and longer than the window, and empty ones
+        size = int(rng.integers(0, 3 * window + 2))
+        result += batched.update_batch(values[start:start + size])
+        start += size
+    assert result == expected
+    np.testing.assert_array_equal(batched.below_count, single.below_count)
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import threading
+import pytest
+import config
+import controller
+import transport
+from concurrent.futures import CancelledError
+from mqtt_rpc import RpcClient, TimeoutError
+
+REQUEST_TOPIC = "test/request"
+REPLY_TOPIC = "test/reply"
+
+
+class Responder:
+    """Collects requests and answers them when told to, in any order."""
+    def __init__(self, broker):
+        self.requests = []
+        self.received = threading.Condition()
+        self.client = transport.InMemoryClient(broker)
+        self.client.on_message = self.on_message
+        self.client.connect()
+        self.client.subscribe(REQUEST_TOPIC)
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, msg):
+        with self.received:
+            self.requests.append(json.loads(msg.payload.decode()))
+            self.received.notify_all()
+
+    def wait_for(self, count):
+        with self.received:
+            assert self.received.wait_for(lambda: len(self.requests) >= count, timeout=5)
+        return list(self.requests)
+
+    def reply(self, request, **reply):
+        if 'correlation_id' in request:
+            reply['correlation_id'] = request['correlation_id']
+        self.client.publish(REPLY_TOPIC, json.dumps(reply))
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+@pytest.fixture
+def broker():
+    return transport.InMemoryBroker()
+
+
+@pytest.fixture
+def responder(broker):
+    responder = Responder(broker)
+    yield responder
+    responder.close()
+
+
+@pytest.fixture
+def rpc(broker):
+    rpc = RpcClient(5, transport.InMemoryClient(broker))
+    yield rpc
+    rpc.close()
+
+
+def test_out_of_order_replies_resolve_their_requests(rpc, responder):
+    futures = [rpc.submit(REQUEST_TOPIC, REPLY_TOPIC, {'value': i}) for i in range(20)]
+    requests = responder.wait_for(len(futures))
+    assert len({request['correlation_id'] for request in requests}) == len(futures)
+    # a broadcast on the reply topic and a reply to an unknown request are ignored
+    responder.client.publish(REPLY_TOPIC, json.dumps({'value': 'broadcast'}))
+    responder.reply({'correlation_id': 'unknown'}, value='stray')
+    for request in reversed(requests):
+        responder.reply(request, value=request['value'] * 10)
+    for i, future in enumerate(futures):
+        assert future.result(timeout=5) == {'value': i * 10, 'correlation_id': future.correlation_id}
+    assert rpc.pending == {}
+
+
+def test_concurrent_requests_from_threads(rpc, responder):
+    results = {}
+
+    def request(i):
+        results[i] = rpc.request(REQUEST_TOPIC, REPLY_TOPIC, {'value': i})['value']
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    requests = responder.wait_for(len(threads))
+    # answered from the last to the first
+    for request in sorted(requests, key=lambda request: -request['value']):
+        responder.reply(request, value=-request['value'])
+    for thread in threads:
+        thread.join(timeout=5)
+    assert results == {i: -i for i in range(8)}
+
+
+def test_timeout_and_late_reply(rpc, responder):
+    with pytest.raises(TimeoutError):
+        rpc.request(REQUEST_TOPIC, REPLY_TOPIC, {'value': 1}, timeout=0.05)
+    assert rpc.pending == {}
+    # the late reply is ignored, the next request gets its own
+    late, = responder.wait_for(1)
+    responder.reply(late, value='late')
+    future = rpc.submit(REQUEST_TOPIC, REPLY_TOPIC, {'value': 2})
+    responder.reply(responder.wait_for(2)[1], value='current')
+    assert future.result(timeout=5)['value'] == 'current'
+
+
+def test_cancel_and_close(rpc, responder):
+    cancelled = rpc.submit(REQUEST_TOPIC, REPLY_TOPIC, {'value': 1})
+    rpc.cancel(cancelled)
+    assert cancelled.cancelled() and rpc.pending == {}
+    responder.reply(responder.wait_for(1)[0], value='late')
+    pending = rpc.submit(REQUEST_TOPIC, REPLY_TOPIC, {'value': 2})
+    rpc.close()
+    with pytest.raises(CancelledError):
+        pending.result(timeout=1)
+    assert rpc.pending == {}
+
+
+def test_controller_request_returns_an_empty_reply_on_timeout(broker, responder, monkeypatch):
+    monkeypatch.setattr(config.Controller, 'REQUEST_TIMEOUT', 0.05)
+    temperature_controller = controller.TemperatureController(config.Controller.TARGET_TEMP, {}, config.Controller.SIM_STOP_TIME)
+    temperature_controller.rpc = RpcClient(client=transport.InMemoryClient(broker))
+    try:
+        assert temperature_controller.request(REQUEST_TOPIC, REPLY_TOPIC, {'value': 1}) == {}
+        assert asyncio.run(temperature_controller.request_async(REQUEST_TOPIC, REPLY_TOPIC, {'value': 2})) == {}
+        assert temperature_controller.rpc.pending == {}
+    finally:
+        temperature_controller.close()
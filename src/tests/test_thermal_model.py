@@ -0,0 +1,229 @@
+import importlib
+import json
+import numpy as np
+import pytest
+import config
+import thermal_model
+import twin_generator
+from thermal_model import ThermalModel
+from transport import Message
+
+
+def parameters(delta_t):
+    return config.Model.HEAT_CAPACITY, config.Model.HEAT_TRANSFER_EXTERNAL, config.Model.HEAT_TRANSFER_ZONES, delta_t
+
+
+def continuous(model):
+    """The continuous system matrix Ac of the model's zones, recovered from a tiny euler step."""
+    euler = ThermalModel(model.sensor_zones, backend='dense')
+    euler.set_parameters(*parameters(1.0))
+    return euler.A - np.eye(len(euler.zones))
+
+
+def augmented(model, delta_t):
+    n = len(model.zones)
+    matrix = np.zeros((2 * n, 2 * n))
+    matrix[:n, :n] = continuous(model) * delta_t
+    matrix[:n, n:] = np.eye(n) * delta_t
+    return matrix
+
+
+@pytest.mark.parametrize('scale', [1e-3, 0.4, 1.0, 10.0, 200.0])
+def test_expm_pade_random(scale):
+    scipy_linalg = pytest.importorskip('scipy.linalg')
+    rng = np.random.default_rng(int(scale * 1000))
+    for _ in range(20):
+        matrix = rng.standard_normal((6, 6))
+        matrix *= scale / np.linalg.norm(matrix, 1)
+        expected = scipy_linalg.expm(matrix)
+        np.testing.assert_allclose(thermal_model._expm_pade(matrix), expected, rtol=1e-12, atol=1e-13 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize('delta_t', [1.0, 60.0, 3600.0, 86400.0])
+def test_expm_pade_thermal(delta_t):
+    scipy_linalg = pytest.importorskip('scipy.linalg')
+    model = ThermalModel(config.Model.SENSOR_ZONES, discretization='exact')
+    model.set_parameters(*parameters(delta_t))
+    matrix = augmented(model, delta_t)
+    np.testing.assert_allclose(thermal_model._expm_pade(matrix), scipy_linalg.expm(matrix), rtol=1e-12, atol=1e-12 * delta_t)
+
+
+@pytest.mark.parametrize('use_scipy', [True, False])
+def test_exact_equals_fine_euler(use_scipy, monkeypatch):
+    if use_scipy:
+        pytest.importorskip('scipy.linalg')
+    else:
+        monkeypatch.setattr(thermal_model, 'expm', None)
+    delta_t, substeps = 600.0, 20000
+    exact = ThermalModel(config.Model.SENSOR_ZONES, discretization='exact')
+    exact.set_parameters(*parameters(delta_t))
+    fine = ThermalModel(config.Model.SENSOR_ZONES, backend='dense')
+    fine.set_parameters(*parameters(delta_t / substeps))
+
+    rng = np.random.default_rng(1)
+    temperatures = np.array([18.0, 21.0, 16.0])
+    heating = rng.choice([0.0, 10000.0], size=(6, 3))
+    environment = 15 + 5 * rng.random(6)
+    trajectory = exact.rollout(temperatures, heating, environment)
+    state = temperatures
+    for k in range(len(environment)):
+        state = fine.rollout(state, heating[k], np.full(substeps, environment[k]))[-1]
+        # euler converges with O(dt), the fine step is 0.03 s
+        np.testing.assert_allclose(trajectory[k], state, rtol=0, atol=1e-4)
+
+
+def perturbed(seed, count):
+    """Parameter sets around the configured constants."""
+    rng = np.random.default_rng(seed)
+    sets = []
+    for _ in range(count):
+        capacity = {zone: value * rng.uniform(0.5, 2) for zone, value in config.Model.HEAT_CAPACITY.items()}
+        external = {zone: value * rng.uniform(0.5, 2) for zone, value in config.Model.HEAT_TRANSFER_EXTERNAL.items()}
+        zones = {zone: {other: value * rng.uniform(0.5, 2) for other, value in neighbours.items()}
+                 for zone, neighbours in config.Model.HEAT_TRANSFER_ZONES.items()}
+        sets.append((capacity, external, zones))
+    return sets
+
+
+@pytest.mark.parametrize('discretization', ['euler', 'exact'])
+def test_step_batch_equals_single_steps(discretization):
+    delta_t = 200.0
+    parameter_sets = perturbed(2, 9)
+    rng = np.random.default_rng(3)
+    temperatures = 15 + 10 * rng.random((len(parameter_sets), 3))
+    heating = rng.choice([0.0, 10000.0], size=(len(parameter_sets), 3))
+
+    batch = ThermalModel(config.Model.SENSOR_ZONES, discretization=discretization)
+    matrices = batch.compile_batch(parameter_sets, delta_t)
+    single = ThermalModel(config.Model.SENSOR_ZONES, discretization=discretization)
+    for shared in (False, True):
+        # a (B, n) batch of states, or one state and heating shared by all members
+        state = temperatures[0] if shared else temperatures
+        power = heating[0] if shared else heating
+        result = ThermalModel.step_batch(matrices, state, power, 12.0)
+        for b, parameter_set in enumerate(parameter_sets):
+            single.set_parameters(*parameter_set, delta_t)
+            expected = single.step(temperatures[0 if shared else b], heating[0 if shared else b], 12.0)
+            np.testing.assert_allclose(result[b], expected, rtol=1e-12)
+            np.testing.assert_allclose(batch.observe(result[b]), single.observe(expected), rtol=1e-12)
+
+
+def building(topology, zones, **options):
+    document, constants = twin_generator.generate_building(topology, zones, jitter=0.3, **options)
+    return constants
+
+
+@pytest.mark.parametrize('topology, zones, options', [('grid', 64, {'sensors_per_zone': 2}), ('multi_floor', 300, {'floors': 3})])
+def test_sparse_equals_dense(topology, zones, options):
+    pytest.importorskip('scipy.sparse')
+    constants = building(topology, zones, **options)
+    models = {}
+    for backend in ('dense', 'sparse'):
+        model = models[backend] = ThermalModel(constants['SENSOR_ZONES'], backend=backend)
+        model.set_parameters(constants['HEAT_CAPACITY'], constants['HEAT_TRANSFER_EXTERNAL'], constants['HEAT_TRANSFER_ZONES'], 200)
+    dense, sparse = models['dense'], models['sparse']
+    assert sparse.sparse and not dense.sparse and sparse.zones == dense.zones
+
+    rng = np.random.default_rng(zones)
+    temperatures = 15 + 10 * rng.random(zones)
+    heating = rng.choice([0.0, 10000.0], size=(20, zones))
+    environment = 10 + 5 * rng.random(20)
+    np.testing.assert_allclose(sparse.step(temperatures, heating[0], 12.0), dense.step(temperatures, heating[0], 12.0), rtol=1e-13)
+    np.testing.assert_allclose(sparse.rollout(temperatures, heating, environment), dense.rollout(temperatures, heating, environment), rtol=1e-13)
+    # a batch of row vectors
+    batch = 15 + 10 * rng.random((5, zones))
+    np.testing.assert_allclose(sparse.step(batch, heating[:5], 12.0), dense.step(batch, heating[:5], 12.0), rtol=1e-13)
+    np.testing.assert_allclose(sparse.observe(batch), dense.observe(batch), rtol=1e-13)
+    assert sparse.memory_bytes() < dense.memory_bytes()
+
+    # compile_batch is dense for both backends
+    parameter_sets = [(constants['HEAT_CAPACITY'], constants['HEAT_TRANSFER_EXTERNAL'], constants['HEAT_TRANSFER_ZONES'])] * 2
+    results = [ThermalModel.step_batch(model.compile_batch(parameter_sets, 200), batch[:2], heating[:2], 12.0)
+               for model in (sparse, dense)]
+    np.testing.assert_allclose(results[0], results[1], rtol=1e-13)
+    np.testing.assert_allclose(results[1], dense.step(batch[:2], heating[:2], 12.0), rtol=1e-13)
+
+
+def test_auto_backend_threshold(monkeypatch):
+    pytest.importorskip('scipy.sparse')
+    def backend(constants):
+        model = ThermalModel(constants['SENSOR_ZONES'], backend='auto')
+        model.set_parameters(constants['HEAT_CAPACITY'], constants['HEAT_TRANSFER_EXTERNAL'], constants['HEAT_TRANSFER_ZONES'], 200)
+        return model.sparse
+
+    # below SPARSE_MIN_ZONES dense, from there on sparse if the coupling is sparse enough
+    assert not backend(building('grid', thermal_model.SPARSE_MIN_ZONES - 1))
+    assert backend(building('grid', thermal_model.SPARSE_MIN_ZONES))
+    # a grid has up to 5 entries per row: density (n + couplings) / n^2 of about 5 / n
+    constants = building('grid', 400)
+    couplings = sum(len(neighbours) for neighbours in constants['HEAT_TRANSFER_ZONES'].values())
+    density = (400 + couplings) / 400 ** 2
+    monkeypatch.setattr(thermal_model, 'SPARSE_MAX_DENSITY', density)
+    assert backend(constants)
+    monkeypatch.setattr(thermal_model, 'SPARSE_MAX_DENSITY', density * 0.99)
+    assert not backend(constants)
+    # the exact discretization is always dense
+    model = ThermalModel(constants['SENSOR_ZONES'], backend='sparse', discretization='exact')
+    model.set_parameters(constants['HEAT_CAPACITY'], constants['HEAT_TRANSFER_EXTERNAL'], constants['HEAT_TRANSFER_ZONES'], 200)
+    assert not model.sparse
+    # without SciPy 'auto' stays dense and 'sparse' is refused
+    monkeypatch.setattr(thermal_model, 'sparse', None)
+    monkeypatch.setattr(thermal_model, 'SPARSE_MAX_DENSITY', 1.0)
+    assert not backend(constants)
+    with pytest.raises(ValueError):
+        ThermalModel(constants['SENSOR_ZONES'], backend='sparse')
+
+
+def baseline_new_temps(current_temps, heater_status, env_temp, delta_t, capacity, heat_transfer_external, heat_transfer_zones):
+    """calculate_new_temps of simulation.py before the state-space model, the reference of the euler update."""
+    zones_neighbors = {zone: list(heat_transfer_zones[zone].keys()) for zone in heat_transfer_zones}
+    new_temps = {}
+    for zone in capacity.keys():
+        if zone in current_temps:
+            heat_loss = current_temps[zone] * (
+                heat_transfer_external[zone] +
+                sum(heat_transfer_zones[zone].get(nbr, 0) for nbr in zones_neighbors[zone])
+            )
+            heat_gain = (
+                heat_transfer_external[zone] * env_temp +
+                sum(heat_transfer_zones[zone].get(nbr, 0) * current_temps.get(nbr, 0) for nbr in zones_neighbors[zone])
+            )
+            new_temps[zone] = current_temps[zone] + (delta_t / capacity[zone]) * (heater_status[zone] + heat_gain - heat_loss)
+    return new_temps
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append(json.loads(payload))
+
+
+@pytest.mark.parametrize('module_name', ['simulation', 'controller_simulation'])
+def test_euler_reproduces_the_baseline(module_name, monkeypatch):
+    module = importlib.import_module(module_name)
+    monkeypatch.setattr(module, 'client', RecordingClient())
+    simulation = module.HeatingSimulation()
+    rng = np.random.default_rng(4)
+    parameter_sets = [(config.Model.HEAT_CAPACITY, config.Model.HEAT_TRANSFER_EXTERNAL, config.Model.HEAT_TRANSFER_ZONES)]
+    parameter_sets += perturbed(5, 3)
+    temperatures = {'Z1': 15.0, 'Z2': 15.0, 'Z3': 15.0}
+    for step in range(200):
+        capacity, heat_transfer_external, heat_transfer_zones = parameter_sets[step // 50]
+        heater_status = dict(zip(temperatures, rng.choice([0, 10000], 3).tolist()))
+        delta_t = [60, 200, 600][step % 3]
+        # now and then a zone is missing in the message, its neighbours then see 0 degrees
+        current = {zone: value for zone, value in temperatures.items() if step % 17 != 5 or zone != 'Z2'}
+        message = {'heater_status': heater_status, 'current_temperatures': current, 'delta_t': delta_t,
+                   'capacity': capacity, 'heat_transfer_external': heat_transfer_external, 'heat_transfer_zones': heat_transfer_zones}
+        simulation.update_heater_status(Message("controller/heater_status", json.dumps(message).encode()))
+
+        expected = baseline_new_temps(current, heater_status, 15, delta_t, capacity, heat_transfer_external, heat_transfer_zones)
+        reply = module.client.published[-1]
+        assert {zone: reply[zone] for zone in expected} == pytest.approx(expected, rel=1e-12, abs=1e-12)
+        # the sensors of the baseline's publish_temperatures
+        z1, z2, z3 = reply['Z1'], reply['Z2'], reply['Z3']
+        assert [reply['TA'], reply['TB'], reply['TC'], reply['TD']] == pytest.approx([z1, (z1 + z2) / 2, (z2 + z3) / 2, z3], rel=1e-12)
+        temperatures = {zone: reply[zone] for zone in temperatures}
+    assert 15 < min(temperatures.values()) and max(temperatures.values()) < 60
@@ -0,0 +1,103 @@
+import json
+import uuid
+import pytest
+import config
+import wire
+
+ZONES = ['Z1', 'Z2', 'Z3']
+SENSORS = ['TA', 'TB', 'TC', 'TD']
+PAIRS = [('Z1', 'Z2'), ('Z2', 'Z1'), ('Z2', 'Z3'), ('Z3', 'Z2')]
+
+
+@pytest.fixture
+def layout():
+    return wire.Layout(ZONES, SENSORS, PAIRS)
+
+
+def heater_status(step, capacity=1e6, **changes):
+    message = {
+        'heater_status': {zone: (step + i) % 2 * 10000 for i, zone in enumerate(ZONES)},
+        'current_temperatures': {name: 15 + 0.1 * step + i for i, name in enumerate(ZONES + SENSORS)},
+        'delta_t': 60,
+        'capacity': {zone: capacity for zone in ZONES},
+        'heat_transfer_external': {'Z1': 1000, 'Z2': 500, 'Z3': 1042},
+        'heat_transfer_zones': {'Z1': {'Z2': 500}, 'Z2': {'Z1': 500, 'Z3': 500}, 'Z3': {'Z2': 500}},
+        'RMSE': 0.5 * step,
+        **{f'Simulated Temperature Sensor {sensor[1:]}': 16.0 + step for sensor in SENSORS},
+        'environment': 15,
+        'correlation_id': uuid.UUID(int=step).hex,
+    }
+    message.update(changes)
+    return message
+
+
+def as_json(message):
+    """What a subscriber gets from the JSON format."""
+    return json.loads(json.dumps(message))
+
+
+@pytest.mark.parametrize('keyframe_interval', [1, 3, 100])
+def test_round_trip_with_static_fields_and_keyframes(layout, keyframe_interval):
+    encoder = wire.Encoder('binary', layout, keyframe_interval)
+    decoder = wire.Decoder(layout)
+    topic = "controller/heater_status"
+    capacity = 1e6
+    sizes = []
+    for step in range(12):
+        if step in (4, 9):
+            capacity *= 1.1
+        message = heater_status(step, capacity)
+        payload = encoder.dumps(topic, message)
+        assert payload.startswith(wire.MAGIC)
+        assert decoder.loads(topic, payload) == as_json(message)
+        sizes.append(len(payload))
+    if keyframe_interval == 100:
+        # the constants are only sent with the first message and when the capacity changed
+        assert sizes[1] < sizes[0] and sizes[4] > sizes[3] and sizes[5] == sizes[3]
+
+
+def test_constants_changed_in_place_are_sent(layout):
+    encoder = wire.Encoder('binary', layout, 100)
+    decoder = wire.Decoder(layout)
+    topic = "controller/heater_simulation"
+    message = {key: heater_status(0)[key] for key in ('heater_status', 'current_temperatures', 'delta_t', 'capacity',
+                                                         'heat_transfer_external', 'heat_transfer_zones')}
+    decoder.loads(topic, encoder.dumps(topic, message))
+    message['heat_transfer_zones']['Z2']['Z3'] = 750
+    assert decoder.loads(topic, encoder.dumps(topic, message))['heat_transfer_zones']['Z2']['Z3'] == 750
+
+
+def test_missing_values_and_extras(layout):
+    encoder, decoder = wire.Encoder('binary', layout), wire.Decoder(layout)
+    topic = "simulation/temperatures"
+    for message in [{'Z1': 15.5, 'TB': 16.0, 'environment': 15},
+                    {'Z1': 15.5, 'TA': 1.0, 'TB': 2.0, 'TC': 3.0, 'TD': 4.0, 'Z2': 1.0, 'Z3': 2.0, 'delta_t': 60},
+                    {'Z1': 15.5, 'note': 'extra', 'correlation_id': 'not-hex'},
+                    {}]:
+        assert decoder.loads(topic, encoder.dumps(topic, message)) == as_json(message)
+
+
+def test_json_format_and_topics_without_schema(layout):
+    message = heater_status(1)
+    assert wire.Encoder('json', layout).dumps("controller/heater_status", message) == json.dumps(message)
+    payload = wire.Encoder('binary', layout).dumps("monitor/alert", {'alert': True})
+    assert wire.Decoder(layout).loads("monitor/alert", payload) == {'alert': True}
+
+
+def test_errors(layout):
+    payload = wire.Encoder('binary', layout).dumps("simulation/temperatures", {'Z1': 15.0})
+    with pytest.raises(ValueError):
+        wire.Decoder(layout).loads("monitor/alert", payload)
+    with pytest.raises(ValueError):
+        wire.Decoder(wire.Layout(ZONES, SENSORS[:3], PAIRS)).loads("simulation/temperatures", payload)
+    with pytest.raises(ValueError):
+        wire.Encoder('msgpack', layout)
+
+
+def test_layout_of_the_twin(use_twin, monkeypatch):
+    use_twin()
+    layout = wire.Layout.from_dtdl()
+    assert layout.zones == ZONES and layout.sensors == SENSORS
+    monkeypatch.setattr(config.Model, 'HEAT_CAPACITY', {'Z1': 1e6, 'Z2': 1e6, 'Z4': 1e6})
+    with pytest.raises(ValueError):
+        wire.Layout.from_dtdl()
@@ -0,0 +1,283 @@
+import numpy as np
+
+from collections import OrderedDict
+
+try:
+    import scipy.sparse as sparse
+except ImportError:  # the sparse backend is optional
+    sparse = None
+try:
+    from scipy.linalg import expm
+except ImportError:
+    expm = None
+
+BACKENDS = ['auto', 'dense', 'sparse']
+DISCRETIZATIONS = ['euler', 'exact']
+# exact discretizations kept per (parameter set, delta_t)
+DISCRETIZATION_CACHE_SIZE = 32
+# 'auto' switches to CSR matrices from this size on, if the coupling is sparse enough
+SPARSE_MIN_ZONES = 200
+SPARSE_MAX_DENSITY = 0.05
+
+
+class ThermalModel:
+    """State-space form of the zone heat balance from doc/Heating_simulation.md.
+
+    The capacity and heat transfer dicts are compiled into matrices once (and again only when they
+    change), so that a time step is a single matrix-vector update
+
+        T[t+1] = A T[t] + G u[t] + E env[t]
+
+    with the zone temperatures T, the heating powers u and the environment temperature env.
+    The sensors are read through the observation matrix H: sensors = H T.
+
+    With the 'sparse' backend (SciPy) A and H are CSR matrices, which keeps memory and step time
+    linear in the number of couplings for large buildings. 'auto' picks it by size and density.
+
+    The 'euler' discretization is the explicit update of the documentation, it is only stable for
+    small delta_t / capacity. 'exact' uses the zero-order-hold solution A = exp(Ac dt), which is stable
+    and exact for piecewise constant heating and environment temperature at any delta_t. Its matrices
+    are dense and cached per parameter set and delta_t.
+    """
+
+    def __init__(self, sensor_zones=None, backend='auto', discretization='euler'):
+        """sensor_zones maps each sensor to the zones it observes and their weights, e.g. {'TB': {'Z1': 0.5, 'Z2': 0.5}}."""
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid backend. Available backends are: {BACKENDS}")
+        if backend == 'sparse' and sparse is None:
+            raise ValueError("The sparse backend requires scipy")
+        if discretization not in DISCRETIZATIONS:
+            raise ValueError(f"Invalid discretization. Available discretizations are: {DISCRETIZATIONS}")
+        self.backend = backend
+        self.discretization = discretization
+        self._discretizations = OrderedDict()
+        self.sparse = False
+        self.sensor_zones = sensor_zones or {}
+        self.zones = []
+        self.zone_index = {}
+        self.sensors = list(self.sensor_zones)
+        self._parameters = None
+        self.A = self.G = self.E = self.H = None
+
+    def set_parameters(self, capacity, heat_transfer_external, heat_transfer_zones, delta_t):
+        """Compiles the matrices for a parameter set, does nothing if the parameters did not change."""
+        parameters = (capacity, heat_transfer_external, heat_transfer_zones, delta_t)
+        if parameters == self._parameters:
+            return False
+        # copies, the callers are free to modify their dicts afterwards
+        self._parameters = (dict(capacity), dict(heat_transfer_external),
+                            {zone: dict(neighbours) for zone, neighbours in heat_transfer_zones.items()}, delta_t)
+
+        self._set_zones(list(capacity))
+        n = len(self.zones)
+        c, h_ext, loss, rows, columns, values = self._couplings(capacity, heat_transfer_external, heat_transfer_zones)
+        gain = delta_t / c
+
+        if self.discretization == 'exact':
+            self.sparse = False
+            self.H = self._observation_matrix()
+            self.A, self.G, self.E = self._exact_discretization(self._parameters, c, h_ext, loss, rows, columns, values)
+            return True
+
+        self.sparse = self._use_sparse(n, len(values))
+        # A = I + dt C^-1 (coupling - diag(loss))
+        diagonal = 1 - gain * loss
+        off_diagonal = gain[rows] * np.array(values, dtype=float)
+        self.A = self._matrix(np.concatenate([np.arange(n), rows]), np.concatenate([np.arange(n), columns]),
+                              np.concatenate([diagonal, off_diagonal]), (n, n))
+        self.H = self._observation_matrix()
+        self.G = gain
+        self.E = gain * h_ext
+        return True
+
+    def _set_zones(self, zones):
+        if zones != self.zones:
+            self.zones = zones
+            self.zone_index = {zone: i for i, zone in enumerate(zones)}
+
+    def _couplings(self, capacity, heat_transfer_external, heat_transfer_zones):
+        """Capacity, external transfer and loss vectors, and the zone couplings as (row, column, value) triplets."""
+        c = np.array([capacity[zone] for zone in self.zones], dtype=float)
+        h_ext = np.array([heat_transfer_external[zone] for zone in self.zones], dtype=float)
+        # the loss term uses every neighbour listed for a zone
+        rows, columns, values = [], [], []
+        loss = h_ext.copy()
+        for zone, neighbours in heat_transfer_zones.items():
+            if zone not in self.zone_index:
+                continue
+            i = self.zone_index[zone]
+            for neighbour, transfer in neighbours.items():
+                loss[i] += transfer
+                if neighbour in self.zone_index:
+                    rows.append(i)
+                    columns.append(self.zone_index[neighbour])
+                    values.append(transfer)
+        return c, h_ext, loss, np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64), values
+
+    def _exact_discretization(self, parameters, c, h_ext, loss, rows, columns, values):
+        """Zero-order-hold discretization: A = exp(Ac dt), [G E] = integral_0^dt exp(Ac s) ds [Bc Ec]."""
+        capacity, heat_transfer_external, heat_transfer_zones, delta_t = parameters
+        key = (tuple(capacity.items()), tuple(heat_transfer_external.items()),
+               tuple((zone, tuple(neighbours.items())) for zone, neighbours in heat_transfer_zones.items()), delta_t)
+        if key in self._discretizations:
+            self._discretizations.move_to_end(key)
+            return self._discretizations[key]
+
+        n = len(c)
+        # continuous system dT/dt = Ac T + Bc u + Ec env with Ac = C^-1 (coupling - diag(loss)), Bc = C^-1, Ec = C^-1 h_ext
+        continuous = np.zeros((n, n))
+        np.add.at(continuous, (rows, columns), np.array(values, dtype=float))
+        continuous[np.arange(n), np.arange(n)] -= loss
+        continuous /= c[:, None]
+        # exp([[Ac, I], [0, 0]] dt) = [[exp(Ac dt), integral_0^dt exp(Ac s) ds], [0, I]]
+        augmented = np.zeros((2 * n, 2 * n))
+        augmented[:n, :n] = continuous * delta_t
+        augmented[:n, n:] = np.eye(n) * delta_t
+        exponential = (expm or _expm_pade)(augmented)
+        integral = exponential[:n, n:]
+        discretization = (exponential[:n, :n], integral / c[None, :], integral @ (h_ext / c))
+
+        self._discretizations[key] = discretization
+        if len(self._discretizations) > DISCRETIZATION_CACHE_SIZE:
+            self._discretizations.popitem(last=False)
+        return discretization
+
+    def _use_sparse(self, n, couplings):
+        if self.backend != 'auto':
+            return self.backend == 'sparse'
+        if sparse is None or n < SPARSE_MIN_ZONES:
+            return False
+        return (n + couplings) / n ** 2 <= SPARSE_MAX_DENSITY
+
+    def _matrix(self, rows, columns, values, shape):
+        if self.sparse:
+            return sparse.csr_matrix((values, (rows, columns)), shape=shape)
+        matrix = np.zeros(shape)
+        np.add.at(matrix, (rows, columns), values)
+        return matrix
+
+    def _observation_matrix(self):
+        rows, columns, values = [], [], []
+        for s, sensor in enumerate(self.sensors):
+            for zone, weight in self.sensor_zones[sensor].items():
+                if zone in self.zone_index:
+                    rows.append(s)
+                    columns.append(self.zone_index[zone])
+                    values.append(weight)
+        return self._matrix(np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64),
+                            np.array(values, dtype=float), (len(self.sensors), len(self.zones)))
+
+    @staticmethod
+    def _apply(matrix, vectors):
+        # matrix times a vector, or times every row of a batch
+        if vectors.ndim == 1:
+            return matrix @ vectors
+        return (matrix @ vectors.T).T
+
+    def step(self, temperatures, heating, environment_temperature):
+        """One time step on vectors (zone order of self.zones), also works on a batch of row vectors."""
+        # G is diagonal (a vector) for euler, a full matrix for the exact discretization
+        heating = heating * self.G if self.G.ndim == 1 else self._apply(self.G, np.asarray(heating, dtype=float))
+        return self._apply(self.A, temperatures) + heating + environment_temperature * self.E
+
+    def observe(self, temperatures):
+        """Sensor readings for zone temperature vector(s)."""
+        return self._apply(self.H, temperatures)
+
+    def rollout(self, temperatures, heating, environment_temperatures):
+        """Trajectory of len(environment_temperatures) steps; heating holds one row per step (or one row for all).
+
+        Returns a (K, n) array of the zone temperatures after every step, the initial state is not included.
+        """
+        environment_temperatures = np.asarray(environment_temperatures, dtype=float)
+        heating = np.broadcast_to(np.asarray(heating, dtype=float), (len(environment_temperatures), len(self.zones)))
+        trajectory = np.empty((len(environment_temperatures), len(self.zones)))
+        state = np.asarray(temperatures, dtype=float)
+        for k, environment_temperature in enumerate(environment_temperatures):
+            state = self.step(state, heating[k], environment_temperature)
+            trajectory[k] = state
+        return trajectory
+
+    def compile_batch(self, parameter_sets, delta_t):
+        """Stacks the step matrices of many parameter sets into (B, n, n) A, G and (B, n) E arrays.
+
+        parameter_sets is a list of (capacity, heat_transfer_external, heat_transfer_zones) tuples over
+        the same zones. The batch is dense; the model's own parameters are not changed.
+        """
+        zones = list(parameter_sets[0][0])
+        if zones != self.zones:
+            # the single-step matrices belong to the old zones
+            self._parameters = None
+            self._set_zones(zones)
+        self.H = self._observation_matrix()
+        if self.discretization == 'exact':
+            discretizations = [self._exact_discretization(tuple(parameters) + (delta_t,), *self._couplings(*parameters))
+                               for parameters in parameter_sets]
+            return tuple(np.stack(matrices) for matrices in zip(*discretizations))
+
+        n = len(self.zones)
+        batch = len(parameter_sets)
+        couplings = [self._couplings(*parameters) for parameters in parameter_sets]
+        gain = delta_t / np.array([coupling[0] for coupling in couplings])
+        h_ext = np.array([coupling[1] for coupling in couplings])
+        loss = np.array([coupling[2] for coupling in couplings])
+        A = np.zeros((batch, n, n))
+        diagonal = np.arange(n)
+        A[:, diagonal, diagonal] = 1 - gain * loss
+        for b, (_, _, _, rows, columns, values) in enumerate(couplings):
+            A[b, rows, columns] += gain[b, rows] * np.array(values, dtype=float)
+        return A, gain, gain * h_ext
+
+    @staticmethod
+    def step_batch(matrices, temperatures, heating, environment_temperature):
+        """One time step of every member of a batch compiled by compile_batch, in a single vectorized update.
+
+        temperatures and heating are (B, n) arrays or single (n,) vectors shared by the whole batch.
+        """
+        A, G, E = matrices
+        temperatures = np.broadcast_to(temperatures, E.shape)
+        heating = np.broadcast_to(heating, E.shape)
+        heating = heating * G if G.ndim == 2 else np.einsum('bij,bj->bi', G, heating)
+        return np.einsum('bij,bj->bi', A, temperatures) + heating + environment_temperature * E
+
+    def memory_bytes(self):
+        """Memory used by the step and observation matrices."""
+        total = 0
+        for matrix in (self.A, self.H, self.G):
+            if sparse is not None and sparse.issparse(matrix):
+                total += matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+            else:
+                total += matrix.nbytes
+        return total
+
+    def to_vector(self, values, default=0.0):
+        return np.array([values.get(zone, default) for zone in self.zones], dtype=float)
+
+    def step_dict(self, current_temps, heater_status, environment_temperature):
+        """One time step on the dicts of the MQTT messages, returns the new temperatures of the zones present in current_temps."""
+        new_temps = self.step(self.to_vector(current_temps), self.to_vector(heater_status), environment_temperature)
+        return {zone: float(new_temps[i]) for i, zone in enumerate(self.zones) if zone in current_temps}
+
+    def observe_dict(self, zone_temperatures):
+        readings = self.observe(self.to_vector(zone_temperatures))
+        return {sensor: float(readings[s]) for s, sensor in enumerate(self.sensors)}
+
+
+def _expm_pade(matrix):
+    """Matrix exponential by scaling and squaring with a (6, 6) Pade approximant, used without SciPy."""
+    norm = np.linalg.norm(matrix, 1)
+    squarings = max(0, int(np.ceil(np.log2(norm / 0.5)))) if norm > 0 else 0
+    scaled = matrix / 2 ** squarings
+    identity = np.eye(len(matrix))
+    coefficients = [1.0, 1 / 2, 5 / 44, 1 / 66, 1 / 792, 1 / 15840, 1 / 665280]
+    power = identity
+    numerator = coefficients[0] * identity
+    denominator = coefficients[0] * identity
+    for k in range(1, len(coefficients)):
+        power = power @ scaled
+        numerator = numerator + coefficients[k] * power
+        denominator = denominator + (-1) ** k * coefficients[k] * power
+    result = np.linalg.solve(denominator, numerator)
+    for _ in range(squarings):
+        result = result @ result
+    return result
@@ -0,0 +1,204 @@
+import queue
+import threading
+import config
+import dtdl2graph
+
+TRANSPORTS = ['mqtt', 'memory']
+
+
+class Message:
+    """A received message, with the attributes of paho's MQTTMessage the components use."""
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class InMemoryBroker:
+    """Routes the messages of the clients of one process, in publish order and without copies of the payload."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}  # client -> set of topic filters
+        # topic -> subscribed clients, cleared when the subscriptions change; wildcards as in the DTDL graph
+        self._routes = {}
+
+    def attach(self, client):
+        with self.lock:
+            self.subscriptions.setdefault(client, set())
+            self._routes.clear()
+
+    def detach(self, client):
+        with self.lock:
+            self.subscriptions.pop(client, None)
+            self._routes.clear()
+
+    def subscribe(self, client, topic_filter):
+        with self.lock:
+            self.subscriptions.setdefault(client, set()).add(topic_filter)
+            self._routes.clear()
+
+    def unsubscribe(self, client, topic_filter):
+        with self.lock:
+            self.subscriptions.get(client, set()).discard(topic_filter)
+            self._routes.clear()
+
+    def join(self):
+        """Waits until the clients handled every message, also the ones published while waiting."""
+        while True:
+            with self.lock:
+                clients = list(self.subscriptions)
+            for client in clients:
+                client.inbox.join()
+            if all(client.inbox.unfinished_tasks == 0 for client in clients):
+                return
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.lock:
+            clients = self._routes.get(topic)
+            if clients is None:
+                clients = self._routes[topic] = [client for client, filters in self.subscriptions.items()
+                                                 if any(dtdl2graph.topic_matches(topic_filter, topic) for topic_filter in filters)]
+        message = Message(topic, payload, qos, retain)
+        for client in clients:
+            client.deliver(message)
+
+
+class InMemoryClient:
+    """Client of an InMemoryBroker with the publish/subscribe surface of paho.mqtt.client.Client.
+
+    Like paho, the callbacks run in the network loop (loop_start, loop_forever or loop) and never
+    inside publish, so a component behaves the same on both transports.
+    """
+    def __init__(self, broker=None, userdata=None):
+        self.broker = default_broker if broker is None else broker
+        self.userdata = userdata
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.inbox = queue.Queue()
+        self.connected = False
+        self.thread = None
+
+    def username_pw_set(self, username, password=None):
+        """There is no authentication in process."""
+
+    def user_data_set(self, userdata):
+        self.userdata = userdata
+
+    def connect(self, host=None, port=None, keepalive=60):
+        self.broker.attach(self)
+        self.connected = True
+        self.inbox.put(('connect', None))
+        return 0
+
+    def disconnect(self):
+        if self.connected:
+            self.broker.detach(self)
+            self.connected = False
+            self.inbox.put(('disconnect', None))
+        return 0
+
+    def subscribe(self, topic, qos=0):
+        """Subscribes to a topic filter or a list of (topic filter, qos) tuples."""
+        topics = [topic] if isinstance(topic, str) else [entry[0] for entry in topic]
+        for topic_filter in topics:
+            self.broker.subscribe(self, topic_filter)
+        return 0, None
+
+    def unsubscribe(self, topic):
+        topics = [topic] if isinstance(topic, str) else topic
+        for topic_filter in topics:
+            self.broker.unsubscribe(self, topic_filter)
+        return 0, None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        # paho sends text as UTF-8 and numbers as their text
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode('ascii')
+        self.broker.publish(topic, payload, qos, retain)
+        return 0, None
+
+    def deliver(self, message):
+        self.inbox.put(('message', message))
+
+    def loop(self, timeout=1.0):
+        """Handles the events that are waiting, waits up to timeout for the first one."""
+        try:
+            event = self.inbox.get(timeout=timeout) if timeout else self.inbox.get_nowait()
+        except queue.Empty:
+            return 0
+        while True:
+            if not self._handle(event):
+                return 0
+            try:
+                event = self.inbox.get_nowait()
+            except queue.Empty:
+                return 0
+
+    def loop_forever(self):
+        """Handles the events in this thread until the client disconnects."""
+        while self._handle(self.inbox.get()) or self.connected:
+            pass
+
+    def loop_start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def loop_stop(self):
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            self.inbox.put(('stop', None))
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def _run(self):
+        while self._handle(self.inbox.get()):
+            pass
+
+    def _handle(self, event):
+        """Runs the callback of one event, returns False if the loop has to end."""
+        kind, message = event
+        try:
+            if kind == 'message':
+                if self.on_message is not None:
+                    self.on_message(self, self.userdata, message)
+            elif kind == 'connect':
+                if self.on_connect is not None:
+                    self.on_connect(self, self.userdata, {}, 0)
+            elif kind == 'disconnect':
+                if self.on_disconnect is not None:
+                    self.on_disconnect(self, self.userdata, 0)
+                return False
+            elif kind == 'stop':
+                return False
+            return True
+        finally:
+            self.inbox.task_done()
+
+
+# the broker of the clients created in this process
+default_broker = InMemoryBroker()
+
+
+def create_client(backend=None):
+    """A client for the configured transport (config.Transport.BACKEND), paho MQTT or the in-process bus."""
+    backend = config.Transport.BACKEND if backend is None else backend
+    if backend == 'mqtt':
+        import paho.mqtt.client as mqtt
+        return mqtt.Client()
+    if backend == 'memory':
+        return InMemoryClient()
+    raise ValueError(f"Invalid transport. Available transports are: {TRANSPORTS}")
+
+
+def connect(client):
+    """Connects the client to the broker of config.Mqtt, the in-process bus ignores the address."""
+    client.username_pw_set(config.Mqtt.MQTT_SERVER_USER, config.Mqtt.MQTT_SERVER_PASS)
+    client.connect(config.Mqtt.MQTT_SERVER_URL, config.Mqtt.MQTT_SERVER_PORT, 60)
+    return client
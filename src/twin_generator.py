@@ -0,0 +1,201 @@
+"""Generates buildings of any size: a DTDL instance file and the matching config.Model constants.
+
+The zones sit on a grid of floors x rows x columns; a corridor is one row, a grid one floor and
+multi_floor stacks grids. Every zone has a chain of controllers that reads the zone's sensors (and the
+first sensor of each neighbouring zone) and a chain of heaters that heats it; the sensors read the
+heaters of their zone and of the neighbouring zones. The last heater of zone Zn publishes on heater/Hn
+and the sensors on sensor/<name>, in the same order as config.Model, as wire and the monitor expect.
+
+    python twin_generator.py --topology multi_floor --zones 1000 --floors 4 --sensors-per-zone 2 --output tower
+    python run_in_process.py --building tower.json
+"""
+import argparse
+import json
+import math
+import os
+import numpy as np
+import config
+
+TOPOLOGIES = ['corridor', 'grid', 'multi_floor']
+SERVER = "localhost:1883"
+
+
+def floor_plan(topology, zones, floors=1, width=None):
+    """Floors, zones per floor and zones per row; the rows of a floor follow from these."""
+    if topology not in TOPOLOGIES:
+        raise ValueError(f"Invalid topology. Available topologies are: {TOPOLOGIES}")
+    if topology != 'multi_floor':
+        floors = 1
+    per_floor = math.ceil(zones / floors)
+    if width is None:
+        width = per_floor if topology == 'corridor' else max(1, round(math.sqrt(per_floor)))
+    return floors, per_floor, width
+
+
+def neighbours(topology, zones, floors=1, width=None):
+    """Horizontal and vertical neighbour pairs (i, j), i < j, of the zone indices."""
+    floors, per_floor, width = floor_plan(topology, zones, floors, width)
+    horizontal, vertical = [], []
+    for i in range(zones):
+        position = i % per_floor
+        if (position + 1) % width and position + 1 < per_floor and i + 1 < zones:
+            horizontal.append((i, i + 1))
+        if position + width < per_floor and i + width < zones:
+            horizontal.append((i, i + width))
+        if i + per_floor < zones:
+            vertical.append((i, i + per_floor))
+    return horizontal, vertical
+
+
+def telemetry(name, kind, topic):
+    return {
+        "@type": "InstanceTelemetry",
+        "name": name,
+        "schema": "double",
+        "realization": {
+            "@type": f"TelemetryRealizationMQTT{kind}",
+            "server": SERVER,
+            "topic": topic,
+            "dataFormat": "json"
+        }
+    }
+
+
+def component(identifier, name, display_name, contents):
+    return {"@type": "InstanceComponent", "@id": identifier, "name": name, "displayName": display_name, "contents": contents}
+
+
+def chain_names(prefix, zone, length):
+    """Names of a chain of one zone, 'H4' for a single heater, 'H4_1', 'H4_2' for a chain of two."""
+    if length == 1:
+        return [f'{prefix}{zone}']
+    return [f'{prefix}{zone}_{stage}' for stage in range(1, length + 1)]
+
+
+def sensor_names(zone, sensors_per_zone):
+    """Sensor names start with 'T', the diagnosis looks at them one step later."""
+    return chain_names('T', zone, sensors_per_zone)
+
+
+def generate_building(topology, zones, sensors_per_zone=1, floors=1, width=None, controller_chain=1, heater_chain=1,
+                      capacity=1e6, heat_transfer_external=500.0, heat_transfer_zones=500.0,
+                      heat_transfer_floors=250.0, jitter=0.0, seed=0):
+    """Returns the DTDL instance document and the config.Model constants of a building.
+
+    jitter varies capacities and heat transfers uniformly by up to this fraction (seeded), couplings
+    stay symmetric. Zones on different floors are coupled with heat_transfer_floors.
+    """
+    if zones < 1 or sensors_per_zone < 1 or controller_chain < 1 or heater_chain < 1:
+        raise ValueError("A building needs at least one zone and one sensor, controller and heater per zone")
+    horizontal, vertical = neighbours(topology, zones, floors, width)
+    random = np.random.default_rng(seed)
+
+    def vary(value, size):
+        return (value * (1 + jitter * random.uniform(-1, 1, size))).tolist()
+
+    names = [f'Z{i + 1}' for i in range(zones)]
+    adjacent = [[] for _ in range(zones)]
+    heat_transfer = {name: {} for name in names}
+    for (i, j), value in zip(horizontal + vertical, vary(heat_transfer_zones, len(horizontal))
+                                                    + vary(heat_transfer_floors, len(vertical))):
+        adjacent[i].append(j)
+        adjacent[j].append(i)
+        heat_transfer[names[i]][names[j]] = value
+        heat_transfer[names[j]][names[i]] = value
+    for neighbour_list in adjacent:
+        neighbour_list.sort()
+
+    sensors = [sensor_names(i + 1, sensors_per_zone) for i in range(zones)]
+    heaters = [chain_names('H', i + 1, heater_chain) for i in range(zones)]
+    controllers = [chain_names('C', i + 1, controller_chain) for i in range(zones)]
+    parameters = {
+        'HEAT_CAPACITY': dict(zip(names, vary(capacity, zones))),
+        'HEAT_TRANSFER_EXTERNAL': dict(zip(names, vary(heat_transfer_external, zones))),
+        'HEAT_TRANSFER_ZONES': heat_transfer,
+        'SENSOR_ZONES': {sensor: {names[i]: 1.0} for i in range(zones) for sensor in sensors[i]},
+    }
+
+    heater_contents, controller_contents, sensor_contents = [], [], []
+    for i in range(zones):
+        zone = i + 1
+        # controller chain: sensors -> C_1 -> ... -> C_k -> heater chain
+        controller_topics = [f'controller/C{zone}/stage{stage}' for stage in range(1, controller_chain)] + [f'controller/C{zone}/heater{zone}']
+        inputs = [telemetry(f'TemperatureSensor{sensor}', 'Subscriber', f'sensor/{sensor}')
+                  for sensor in sensors[i] + [sensors[j][0] for j in adjacent[i]]]
+        for stage, (name, topic) in enumerate(zip(controllers[i], controller_topics)):
+            controller_contents.append(component(f'dtmi:building:controller{zone}:{stage + 1}', name, f'Controller {stage + 1} for Zone {zone}',
+                                                 inputs + [telemetry(f'Heater{zone}', 'Publisher', topic)]))
+            inputs = [telemetry('ControllerInput', 'Subscriber', topic)]
+        source = controller_topics[-1]
+        # heater chain: C_k -> H_1 -> ... -> H_k, the last one on heater/Hn
+        heater_topics = [f'heater/H{zone}/stage{stage}' for stage in range(1, heater_chain)] + [f'heater/H{zone}']
+        for stage, (name, topic) in enumerate(zip(heaters[i], heater_topics)):
+            heater_contents.append(component(f'dtmi:building:heater{zone}:{stage + 1}', name, f'Heater {stage + 1} for Zone {zone}', [
+                telemetry(f'Heater{zone}Request', 'Subscriber', source),
+                telemetry(f'Heater{zone}Response', 'Publisher', topic)]))
+            source = topic
+        for sensor in sensors[i]:
+            sensor_contents.append(component(f'dtmi:building:sensor{sensor}', sensor, f'Temperature Sensor {sensor}', [
+                telemetry('TemperatureReading', 'Publisher', f'sensor/{sensor}')] + [
+                telemetry(f'Heater{j + 1}Output', 'Subscriber', f'heater/H{j + 1}') for j in [i] + adjacent[i]]))
+
+    document = {
+        "@context": "dtmi:dtdl:extension:instantiation",
+        "@type": "Instance",
+        "@id": f"dtmi:building:{topology}{zones}",
+        "description": f"A generated {topology.replace('_', ' ')} building with {zones} heating zones, "
+                       f"{sensors_per_zone} sensors, {controller_chain} controllers and {heater_chain} heaters per zone.",
+        "displayName": f"Generated Building ({topology}, {zones} zones)",
+        # same order as heating_twin.dtdl: heaters, controllers, sensors
+        "contents": heater_contents + controller_contents + sensor_contents,
+    }
+    return document, parameters
+
+
+def write_building(document, parameters, path):
+    """Writes <path>.dtdl and <path>.json (the constants and the name of the DTDL file), returns the JSON path."""
+    dtdl_file_path = f'{path}.dtdl'
+    with open(dtdl_file_path, 'w') as file:
+        json.dump(document, file)
+    parameters_file_path = f'{path}.json'
+    with open(parameters_file_path, 'w') as file:
+        json.dump(dict(parameters, DTDL_FILE=os.path.basename(dtdl_file_path)), file)
+    return parameters_file_path
+
+
+def load_building(parameters_file_path):
+    """The constants of a written building, DTDL_FILE resolved next to the JSON file."""
+    with open(parameters_file_path) as file:
+        parameters = json.load(file)
+    parameters['DTDL_FILE'] = os.path.join(os.path.dirname(os.path.abspath(parameters_file_path)), parameters['DTDL_FILE'])
+    return parameters
+
+
+def use_building(parameters):
+    """Sets config.Model to a building; call before the components are started."""
+    for key, value in parameters.items():
+        setattr(config.Model, key, value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--topology", choices=TOPOLOGIES, default="grid")
+    parser.add_argument("--zones", type=int, default=100)
+    parser.add_argument("--sensors-per-zone", type=int, default=1)
+    parser.add_argument("--floors", type=int, default=1, help="multi_floor only")
+    parser.add_argument("--width", type=int, help="zones per row, default square floors (corridor: one row)")
+    parser.add_argument("--controller-chain", type=int, default=1, help="controllers in series per zone")
+    parser.add_argument("--heater-chain", type=int, default=1, help="heaters in series per zone")
+    parser.add_argument("--jitter", type=float, default=0.0, help="relative variation of capacities and heat transfers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="path without extension, default <topology>_<zones>")
+    args = parser.parse_args()
+
+    document, parameters = generate_building(args.topology, args.zones, args.sensors_per_zone, args.floors, args.width,
+                                             args.controller_chain, args.heater_chain, jitter=args.jitter, seed=args.seed)
+    parameters_file_path = write_building(document, parameters, args.output or f'{args.topology}_{args.zones}')
+    print(f"{len(document['contents'])} components, {len(parameters['SENSOR_ZONES'])} sensors written to {parameters_file_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import json
+import struct
+import zlib
+from operator import itemgetter
+import numpy as np
+import config
+import dtdl2graph
+
+FORMATS = ['json', 'binary']
+
+# a JSON payload starts with '{', a binary one with a zero byte
+MAGIC = b'\x00FDW'
+VERSION = 1
+# magic, version, flags, mask of the static fields in the message, layout id
+HEADER = struct.Struct('<4sBBHI')
+HAS_CORRELATION_ID = 1
+HAS_EXTRAS = 2
+
+# Fields of the per-step messages: (key, group, static). The group names the layout vector the values are
+# packed in; key None puts the names of the group directly into the message. Static fields (the constants)
+# are only sent when they changed, or every config.Wire.KEYFRAME_INTERVAL messages.
+SCHEMAS = {
+    "controller/heater_status": [
+        ('heater_status', 'zones', False), ('current_temperatures', 'temperatures', False), ('delta_t', 'scalar', False),
+        ('RMSE', 'scalar', False), (None, 'predictions', False), ('environment', 'scalar', False),
+        ('capacity', 'zones', True), ('heat_transfer_external', 'zones', True), ('heat_transfer_zones', 'pairs', True)],
+    "controller/heater_simulation": [
+        ('heater_status', 'zones', False), ('current_temperatures', 'temperatures', False), ('delta_t', 'scalar', False),
+        ('capacity', 'zones', True), ('heat_transfer_external', 'zones', True), ('heat_transfer_zones', 'pairs', True)],
+    "simulation/temperatures": [
+        (None, 'temperatures', False), ('environment', 'scalar', False), ('delta_t', 'scalar', False)],
+    "controller_simulation/temperatures": [
+        (None, 'temperatures', False), ('environment', 'scalar', False)],
+}
+
+
+class Layout:
+    """Order of the packed values: zones, sensors and zone couplings of the twin.
+
+    Zones and sensors come from the DTDL file, in document order: heater Hn (publishing on heater/+)
+    heats zone Zn, the sensors are the components publishing on sensor/+. Their names have to match
+    config.Model, the couplings follow config.Model.HEAT_TRANSFER_ZONES. Sender and receiver check
+    that they use the same layout.
+    """
+    def __init__(self, zones, sensors, pairs):
+        self.zones = list(zones)
+        self.sensors = list(sensors)
+        self.pairs = list(pairs)
+        self.groups = {
+            'zones': self.zones,
+            'sensors': self.sensors,
+            'temperatures': self.zones + self.sensors,
+            # the controller's predictions for the plots, 'Simulated Temperature Sensor A' for TA
+            'predictions': [f'Simulated Temperature Sensor {sensor[1:]}' for sensor in self.sensors],
+        }
+        self.id = zlib.crc32(json.dumps([self.zones, self.sensors, self.pairs]).encode())
+
+    @classmethod
+    def from_dtdl(cls, dtdl_file_path=None):
+        dtdl_file_path = config.Model.DTDL_FILE if dtdl_file_path is None else dtdl_file_path
+        zones = [f'Z{heater[1:]}' for heater in dtdl2graph.load_publishers(dtdl_file_path, 'heater/+')]
+        sensors = dtdl2graph.load_publishers(dtdl_file_path, 'sensor/+')
+        for kind, names, configured in [('zones', zones, config.Model.HEAT_CAPACITY), ('sensors', sensors, config.Model.SENSOR_ZONES)]:
+            if set(names) != set(configured):
+                raise ValueError(f"The {kind} of the twin {dtdl_file_path} do not match config.Model: "
+                                 f"only in the twin {sorted(set(names) - set(configured))}, "
+                                 f"only in config.Model {sorted(set(configured) - set(names))}")
+        pairs = [(zone, neighbour) for zone, neighbours in config.Model.HEAT_TRANSFER_ZONES.items() for neighbour in neighbours]
+        return cls(zones, sensors, pairs)
+
+    def size(self, group):
+        return len(self.pairs) if group == 'pairs' else 1 if group == 'scalar' else len(self.groups[group])
+
+
+_default_layout = None
+
+
+def default_layout():
+    """The layout of config.Model.DTDL_FILE, read on first use."""
+    global _default_layout
+    if _default_layout is None:
+        _default_layout = Layout.from_dtdl()
+    return _default_layout
+
+
+def _pack(layout, group, value):
+    """The values of one field as float64, NaN where the message has no value."""
+    if group == 'scalar':
+        return np.array([np.nan if value is None else value], dtype=float)
+    if value is None:
+        return np.full(layout.size(group), np.nan)
+    if group == 'pairs':
+        return np.array([value.get(zone, {}).get(neighbour, np.nan) for zone, neighbour in layout.pairs], dtype=float)
+    names = layout.groups[group]
+    try:
+        values = itemgetter(*names)(value) if len(names) > 1 else [value[name] for name in names]
+        return np.fromiter(values, dtype=float, count=len(names))
+    except KeyError:
+        return np.array([value.get(name, np.nan) for name in names], dtype=float)
+
+
+def _unpack(layout, group, values):
+    """The field as it was in the message; names without a value (NaN) are left out, None if none has one
+    or the scalar is missing."""
+    if group == 'scalar':
+        value = values[0]
+        return None if value != value else float(value)
+    names = layout.pairs if group == 'pairs' else layout.groups[group]
+    present = ~np.isnan(values)
+    if not present.any():
+        return None
+    if not present.all():
+        names = [name for name, keep in zip(names, present.tolist()) if keep]
+        values = values[present]
+    if group != 'pairs':
+        return dict(zip(names, values.tolist()))
+    nested = {zone: {} for zone in dict.fromkeys(zone for zone, _ in layout.pairs)}
+    for (zone, neighbour), value in zip(names, values.tolist()):
+        nested[zone][neighbour] = value
+    return nested
+
+
+class Encoder:
+    """Serializes the messages of one sender, as JSON or (config.Wire.FORMAT 'binary') packed float64 arrays.
+
+    A binary message is the header, the 16 bytes of the correlation id if there is one, the dynamic
+    fields of the topic's schema as one float64 vector, the static fields that changed, and the keys
+    the schema does not cover as JSON. Topics without a schema are always sent as JSON.
+    """
+    def __init__(self, wire_format=None, layout=None, keyframe_interval=None):
+        self.format = config.Wire.FORMAT if wire_format is None else wire_format
+        if self.format not in FORMATS:
+            raise ValueError(f"Invalid wire format. Available formats are: {FORMATS}")
+        self.layout = layout
+        self.keyframe_interval = config.Wire.KEYFRAME_INTERVAL if keyframe_interval is None else keyframe_interval
+        self.sent = {}  # topic -> number of messages
+        self.static = {}  # (topic, key) -> last sent value
+        self._covered = {}
+
+    def covered(self, topic):
+        """The keys of a message on topic that are packed, the others go to the JSON part."""
+        if topic not in self._covered:
+            keys = {'correlation_id'}
+            for key, group, is_static in SCHEMAS[topic]:
+                keys.update(self.layout.groups[group] if key is None else [key])
+            self._covered[topic] = frozenset(keys)
+        return self._covered[topic]
+
+    def dumps(self, topic, message):
+        schema = SCHEMAS.get(topic)
+        if self.format == 'json' or schema is None:
+            return json.dumps(message)
+        if self.layout is None:
+            self.layout = default_layout()
+        count = self.sent.get(topic, 0)
+        self.sent[topic] = count + 1
+        keyframe = count % self.keyframe_interval == 0
+
+        dynamic, static, mask = [], [], 0
+        for position, (key, group, is_static) in enumerate(schema):
+            if key is None:
+                dynamic.append(_pack(self.layout, group, message))
+                continue
+            value = message.get(key)
+            if not is_static:
+                dynamic.append(_pack(self.layout, group, value))
+            elif value is not None and (keyframe or self.static.get((topic, key)) != value):
+                static.append(_pack(self.layout, group, value))
+                mask |= 1 << position
+                # a copy, the sender may change its dicts in place
+                self.static[(topic, key)] = {k: dict(v) if isinstance(v, dict) else v for k, v in value.items()}
+
+        flags, tail = 0, b''
+        correlation_id = message.get('correlation_id')
+        extras = {key: message[key] for key in message.keys() - self.covered(topic)}
+        if correlation_id is not None:
+            try:
+                tail = bytes.fromhex(correlation_id)
+                if len(tail) != 16:
+                    raise ValueError
+                flags |= HAS_CORRELATION_ID
+            except (TypeError, ValueError):
+                tail = b''
+                extras['correlation_id'] = correlation_id
+        parts = [HEADER.pack(MAGIC, VERSION, flags | (HAS_EXTRAS if extras else 0), mask, self.layout.id), tail]
+        parts.extend(array.tobytes() for array in dynamic + static)
+        if extras:
+            parts.append(json.dumps(extras).encode('utf-8'))
+        return b''.join(parts)
+
+
+class Decoder:
+    """Reads JSON and binary messages of any sender; keeps the last static fields per topic.
+
+    Use one decoder per subscriber, messages of a topic have to be decoded in order. The static
+    dicts are shared between the decoded messages and must not be changed.
+    """
+    def __init__(self, layout=None):
+        self.layout = layout
+        self.static = {}  # (topic, key) -> last received value
+
+    def loads(self, topic, payload):
+        if isinstance(payload, str):
+            return json.loads(payload)
+        if not payload.startswith(MAGIC):
+            return json.loads(payload.decode())
+        magic, version, flags, mask, layout_id = HEADER.unpack_from(payload)
+        if version != VERSION:
+            raise ValueError(f"Unsupported wire format version {version}, expected {VERSION}")
+        if self.layout is None:
+            self.layout = default_layout()
+        if layout_id != self.layout.id:
+            raise ValueError(f"The message on {topic} uses a different layout of the twin")
+        schema = SCHEMAS.get(topic)
+        if schema is None:
+            raise ValueError(f"Binary message on {topic}, which has no wire schema. Topics with a schema are: {list(SCHEMAS)}")
+        offset = HEADER.size
+        message = {}
+        if flags & HAS_CORRELATION_ID:
+            message['correlation_id'] = payload[offset:offset + 16].hex()
+            offset += 16
+
+        dynamic = [(key, group) for key, group, is_static in schema if not is_static]
+        static = [(key, group) for position, (key, group, is_static) in enumerate(schema) if is_static and mask >> position & 1]
+        sizes = [self.layout.size(group) for _, group in dynamic + static]
+        values = np.frombuffer(payload, dtype='<f8', count=sum(sizes), offset=offset)
+        offset += values.nbytes
+        start = 0
+        for (key, group), size in zip(dynamic + static, sizes):
+            field = _unpack(self.layout, group, values[start:start + size])
+            start += size
+            if field is None:
+                # not in the message
+                continue
+            if key is None:
+                message.update(field)
+            elif (key, group) in static:
+                self.static[(topic, key)] = field
+            else:
+                message[key] = field
+        for key, group, is_static in schema:
+            if is_static and (topic, key) in self.static:
+                message[key] = self.static[(topic, key)]
+        if flags & HAS_EXTRAS:
+            message.update(json.loads(payload[offset:].decode('utf-8')))
+        return message